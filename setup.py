@@ -22,6 +22,9 @@ setup(
     platforms=('Any'),
     packages=find_packages(),
     install_requires=install_requires,
+    entry_points={
+        'console_scripts': ['turbokit-bulk = turbokit.bulk:main'],
+    },
     keywords='tornado motor odm schematics models async future'.split(),
     include_package_data=True,
     license='BSD License',
@@ -2,11 +2,13 @@
 from datetime import datetime
 from turbokit.models import BaseModel, SimpleMongoModel
 from turbokit.types import (ModelReferenceType, GenericModelReferenceType,
-    DynamicType, LocaleDateTimeType, DO_NOTHING, NULLIFY, CASCADE, DENY, PULL)
+    DynamicType, LocaleDateTimeType, memoized_serializable,
+    DO_NOTHING, NULLIFY, CASCADE, DENY, PULL)
 from schematics import types
 from schematics.types import compound
 from schematics.types.serializable import serializable
 from schematics.models import Model
+from schematics.transforms import blacklist
 
 
 class SimpleModel(BaseModel):
@@ -92,6 +94,30 @@ class Plan(BaseModel):
         return self.ends_at < datetime.now()
 
 
+class Invoice(BaseModel):
+    amount = types.IntType(default=0)
+    tax_rate = types.FloatType(default=0)
+    lines = compound.ListType(types.IntType, default=list)
+    customer = ModelReferenceType(SimpleModel)
+    total_calls = 0
+
+    @memoized_serializable(depends_on=('amount', 'tax_rate'))
+    def total(self):
+        self.total_calls += 1
+        return self.amount * (1 + self.tax_rate)
+
+    @memoized_serializable(depends_on=('lines', 'amount'))
+    def lines_sum(self):
+        return sum(self.lines) + self.amount
+
+    @memoized_serializable(depends_on=('customer',))
+    def customer_title(self):
+        return self.customer.title if self.customer else None
+
+    class Options:
+        roles = {'short': blacklist('lines', 'lines_sum')}
+
+
 class Topic(BaseModel):
     title = types.StringType(default='best')
     ancestor = ModelReferenceType('self')
@@ -146,6 +172,10 @@ class ParentD(BaseModel):
     child = ModelReferenceType(ChildA, reverse_delete_rule=DENY)
 
 
+class ParentCGuard(BaseModel):
+    parent = ModelReferenceType(ParentC, reverse_delete_rule=DENY)
+
+
 class ParentE(BaseModel):
     childs = compound.ListType(ModelReferenceType(ChildA, reverse_delete_rule=DO_NOTHING))
 
@@ -193,6 +223,86 @@ class ParentSublcassed(ParentBase):
     guru = ModelReferenceType(ChildC, reverse_delete_rule=NULLIFY)
 
 
+class TreeNode(BaseModel):
+    title = types.StringType()
+    parent = ModelReferenceType('self', reverse_delete_rule=CASCADE)
+
+
+class Ticket(BaseModel):
+    title = types.StringType()
+    owner = ModelReferenceType(User)
+
+    class Options:
+        client_side_ids = True
+
+
+class Country(BaseModel):
+    code = types.StringType()
+    title = types.StringType()
+
+    class Options:
+        document_cache = {'max_size': 10, 'ttl': 60}
+
+
+class City(BaseModel):
+    title = types.StringType()
+    country = ModelReferenceType(Country)
+
+
+class UserEventStats(BaseModel):
+    """Materialized view: _id is id of User"""
+    events = types.IntType()
+
+    class Options:
+        materialized_view = {
+            'source': Event,
+            'pipeline': [{'$group': {'_id': '$user', 'events': {'$sum': 1}}}],
+            'refresh_interval': 60,
+        }
+
+
+class Blog(BaseModel):
+    title = types.StringType()
+    posts_count = types.IntType(default=0)
+    featured_count = types.IntType(default=0)
+
+
+class Post(BaseModel):
+    title = types.StringType()
+    blog = ModelReferenceType(Blog, counter_cache='posts_count')
+    featured_in = compound.ListType(
+        ModelReferenceType(Blog, counter_cache='featured_count'))
+
+
+class Comment(BaseModel):
+    text = types.StringType()
+    author = ModelReferenceType(User, snapshot=('name',))
+    likers = compound.ListType(ModelReferenceType(User, snapshot=('name',),
+        reverse_delete_rule=PULL))
+
+    class Options:
+        indexes = (
+            {'fields': ('author.name',)},
+        )
+
+
+class Currency(BaseModel):
+    code = types.StringType()
+    title = types.StringType()
+    position = types.IntType()
+
+    class Options:
+        in_memory = {'indexes': ('code',), 'refresh_interval': 60}
+
+
+class Category(BaseModel):
+    title = types.StringType()
+    position = types.IntType()
+
+    class Options:
+        query_cache = {'max_size': 10, 'ttl': 60, 'max_documents': 5}
+
+
 class SchematicsFieldsModel(BaseModel):
     # base fields
     type_string = types.StringType()
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
+from tornado import gen
 from tornado.testing import gen_test
-from example_app.models import RecordSeries
+from example_app.models import RecordSeries, UserEventStats
+from turbokit.views import ViewScheduler
 from .base import BaseSerializationTest
 
 
@@ -21,3 +23,39 @@ class TestAggregate(BaseSerializationTest):
             s_id = unwind_data['simplies']
             rs_id = unwind_data['_id']
             self.assertEqual(simplies_mapping[s_id], rs_id)
+
+
+class TestMaterializedView(BaseSerializationTest):
+    MODEL_CLASS = UserEventStats
+
+    @gen_test
+    def test_refresh(self):
+        user = yield self._create_user()
+        for i in range(3):
+            yield self._create_event(user)
+        objects = self.model.objects.set_db(self.db)
+        stats = yield objects.get({'id': user.pk})
+        self.assertEqual(stats, None)
+        yield objects.refresh_view()
+        stats = yield objects.get({'id': user.pk})
+        self.assertEqual(stats.events, 3)
+        yield self._create_event(user)
+        stats = yield objects.get({'id': user.pk})
+        self.assertEqual(stats.events, 3)
+        yield objects.refresh_view()
+        stats = yield objects.get({'id': user.pk})
+        self.assertEqual(stats.events, 4)
+        self.assertEqual(objects.view_stats()['failures'], 0)
+
+    @gen_test
+    def test_scheduler(self):
+        user = yield self._create_user()
+        yield self._create_event(user)
+        refreshes = self.model.objects.view_stats()['refreshes']
+        scheduler = ViewScheduler(self.db, [self.model])
+        scheduler.start()
+        while self.model.objects.view_stats()['refreshes'] == refreshes:
+            yield gen.Task(self.io_loop.add_timeout, self.io_loop.time() + 0.01)
+        scheduler.stop()
+        count = yield self.model.objects.set_db(self.db).filter({}).count()
+        self.assertEqual(count, 1)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+from io import BytesIO
+from multiprocessing import Pool
+from datetime import datetime
+from unittest import TestCase
+from bson import ObjectId
+from pymongo import MongoClient
+from example_app.models import SimpleModel, Action
+from turbokit.bulk import (read_records, encode_documents, convert_records,
+    read_checkpoint, write_checkpoint, batches, ordered_results, load_model,
+    model_path, import_collection, export_collection, FORMATS)
+from .base import BaseTest
+
+
+class TestBulkFormats(TestCase):
+
+    def setUp(self):
+        self.raw_docs = [{'_id': ObjectId(), 'title': 'doc {0}'.format(i),
+            'secret': str(i)} for i in range(3)]
+
+    def round_trip(self, fmt):
+        data = encode_documents(SimpleModel, self.raw_docs, fmt)
+        records = list(read_records(BytesIO(data), fmt))
+        self.assertEqual(len(records), 3)
+        docs, errors = convert_records(SimpleModel, records, fmt)
+        self.assertEqual(errors, [])
+        self.assertEqual(docs, self.raw_docs)
+
+    def test_ndjson(self):
+        self.round_trip('ndjson')
+
+    def test_bson(self):
+        self.round_trip('bson')
+
+    def test_datetimes(self):
+        raw_docs = [{'_id': ObjectId(), 'start_at': datetime(2014, 1, 1, 12, 30)}]
+        for fmt in FORMATS:
+            data = encode_documents(Action, raw_docs, fmt)
+            docs, errors = convert_records(Action,
+                list(read_records(BytesIO(data), fmt)), fmt)
+            self.assertEqual(errors, [])
+            self.assertEqual(docs, raw_docs)
+
+    def test_invalid_records_are_reported(self):
+        records = ['{"title": "ok"}\n', 'not json\n', '{"title": ["a"]}\n']
+        docs, errors = convert_records(SimpleModel, records, 'ndjson')
+        self.assertEqual([d['title'] for d in docs], ['ok'])
+        self.assertEqual(len(errors), 2)
+
+    def test_load_model(self):
+        self.assertIs(load_model(model_path(SimpleModel)), SimpleModel)
+
+
+class TestBulkPipeline(TestCase):
+
+    def test_batches(self):
+        self.assertEqual(list(batches(range(5), 2)), [[0, 1], [2, 3], [4]])
+
+    def test_ordered_results(self):
+        pool = Pool(2)
+        try:
+            tasks = batches(range(10), 3)
+            self.assertEqual(list(ordered_results(pool, sum, tasks, 2)),
+                [3, 12, 21, 9])
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def test_checkpoint(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'checkpoint')
+        self.assertEqual(read_checkpoint(path), {})
+        state = {'records': 10, 'last_id': ObjectId(), 'size': 100}
+        write_checkpoint(path, state)
+        self.assertEqual(read_checkpoint(path), state)
+
+
+class Interrupted(Exception):
+    pass
+
+
+def interrupt(done, total):
+    raise Interrupted()
+
+
+class TestBulkCollections(BaseTest):
+
+    def setUp(self):
+        super(TestBulkCollections, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.db_name = self.DATABASES[0]
+        self.collection = MongoClient()[self.db_name][
+            Action._options.namespace]
+        self.docs = [{'_id': ObjectId(), 'start_at': datetime(2014, 1, i + 1)}
+            for i in range(5)]
+        self.collection.insert(self.docs)
+
+    def stored_docs(self):
+        return list(self.collection.find().sort('_id', 1))
+
+    def test_export_import(self):
+        for fmt in FORMATS:
+            path = os.path.join(self.tmp_dir, 'actions.' + fmt)
+            result = export_collection(Action, path, self.db_name,
+                processes=2, batch_size=2)
+            self.assertEqual(result['records'], 5)
+            self.collection.remove()
+            result = import_collection(Action, path, self.db_name,
+                processes=2, batch_size=2)
+            self.assertEqual((result['inserted'], result['error_count']),
+                (5, 0))
+            self.assertEqual(self.stored_docs(), self.docs)
+
+    def test_resume_from_checkpoint(self):
+        path = os.path.join(self.tmp_dir, 'actions.ndjson')
+        checkpoint = os.path.join(self.tmp_dir, 'export.checkpoint')
+        with self.assertRaises(Interrupted):
+            export_collection(Action, path, self.db_name, processes=2,
+                batch_size=2, checkpoint=checkpoint, progress=interrupt)
+        self.assertEqual(read_checkpoint(checkpoint)['records'], 2)
+        result = export_collection(Action, path, self.db_name, processes=2,
+            batch_size=2, checkpoint=checkpoint)
+        self.assertEqual(result['records'], 5)
+        with open(path, 'rb') as f:
+            self.assertEqual(len(list(read_records(f, 'ndjson'))), 5)
+
+        self.collection.remove()
+        checkpoint = os.path.join(self.tmp_dir, 'import.checkpoint')
+        with self.assertRaises(Interrupted):
+            import_collection(Action, path, self.db_name, processes=2,
+                batch_size=2, checkpoint=checkpoint, progress=interrupt)
+        self.assertEqual(read_checkpoint(checkpoint)['records'], 2)
+        result = import_collection(Action, path, self.db_name, processes=2,
+            batch_size=2, checkpoint=checkpoint)
+        self.assertEqual(result['records'], 5)
+        self.assertEqual(self.stored_docs(), self.docs)
@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import socket
+import tempfile
+from multiprocessing import Process
+from unittest import TestCase
+from bson import ObjectId
+from tornado.concurrent import Future
+from tornado.testing import AsyncTestCase, gen_test
+from tornado import gen
+from example_app.models import Country, City, Category, Currency
+from turbokit.cache import (LRUCache, get_document_cache, get_query_cache,
+    normalize, get_generation)
+from turbokit.shared_cache import start_cache_server, SharedCacheBackend
+from turbokit.memory import InMemoryCollection, get_in_memory_collection
+from .base import BaseTest
+
+
+class TestLRUCache(TestCase):
+
+    def test_eviction(self):
+        cache = LRUCache(max_size=2, ttl=None)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)  # 'b' is least recently used now
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats['evictions'], 1)
+        self.assertEqual(cache.stats['hits'], 2)
+        self.assertEqual(cache.stats['misses'], 1)
+
+    def test_ttl(self):
+        cache = LRUCache(max_size=2, ttl=0.01)
+        cache.set('a', 1)
+        time.sleep(0.02)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.stats['expirations'], 1)
+        self.assertEqual(len(cache), 0)
+
+
+    def test_normalize(self):
+        self.assertEqual(normalize({'a': 1, 'b': {'$in': [1, 2]}}),
+            normalize({'b': {'$in': [1, 2]}, 'a': 1}))
+        self.assertNotEqual(normalize({'b': {'$in': [1, 2]}}),
+            normalize({'b': {'$in': [2, 1]}}))
+
+
+class PendingDatabase(object):
+    """Answers queries with `future`, resolved by the test"""
+    name = 'test'
+
+    def __init__(self, future):
+        self.future = future
+
+    def __getitem__(self, collection):
+        return self
+
+    def find_one(self, *args, **kwargs):
+        return self.future
+
+    def find(self, *args, **kwargs):
+        return self
+
+    def to_list(self, length):
+        return self.future
+
+    def clone(self):
+        return self
+
+
+class TestDocumentCacheRace(AsyncTestCase):
+
+    def setUp(self):
+        super(TestDocumentCacheRace, self).setUp()
+        self.cache = get_document_cache(Country)
+        self.cache.clear()
+        self.addCleanup(self.cache.clear)
+
+    @gen_test
+    def test_document_read_before_write_is_not_cached(self):
+        pk, response = ObjectId(), Future()
+        db = PendingDatabase(response)
+        objects = Country.objects.set_db(db)
+        read = objects.get({'id': pk})
+        objects.invalidate_cache(ids=[pk])  # concurrent save
+        response.set_result({'_id': pk, 'title': 'old'})
+        country = yield read
+        self.assertEqual(country.title, 'old')
+        self.assertIsNone(self.cache.get(db, pk))
+        # without writes the document is cached
+        response = Future()
+        response.set_result({'_id': pk, 'title': 'new'})
+        yield Country.objects.set_db(PendingDatabase(response)).get({'id': pk})
+        self.assertEqual(self.cache.get(db, pk)['title'], 'new')
+
+    @gen_test
+    def test_prefetched_before_write_is_not_cached(self):
+        pk, response = ObjectId(), Future()
+        db = PendingDatabase(response)
+        city = City(dict(title='Moscow', country=pk))
+        read = City.objects.set_db(db).fetch_related_objects([city],
+            related_fields=['country'])
+        Country.objects.set_db(db).invalidate_cache(ids=[pk])
+        response.set_result([{'_id': pk, 'title': 'old'}])
+        yield read
+        self.assertEqual(city.country.title, 'old')
+        self.assertIsNone(self.cache.get(db, pk))
+
+
+class TestGeneration(TestCase):
+
+    def test_bumped_only_for_collections_with_query_cache(self):
+        db = FakeDB()
+        country = get_generation(Country._options.namespace)
+        Country.objects.set_db(db).invalidate_cache(ids=[ObjectId()])
+        self.assertEqual(get_generation(Country._options.namespace), country)
+        category = get_generation(Category._options.namespace)
+        Category.objects.set_db(db).invalidate_cache(ids=[ObjectId()])
+        self.assertEqual(get_generation(Category._options.namespace),
+            category + 1)
+
+
+class TestDocumentCache(BaseTest):
+
+    def setUp(self):
+        super(TestDocumentCache, self).setUp()
+        get_document_cache(Country).clear()
+
+    @gen_test
+    def test_get_by_id_is_cached(self):
+        c = yield Country(dict(code='ru', title='Russia')).save(self.db)
+        objects = Country.objects.set_db(self.db)
+        c_db = yield objects.get({'id': c.pk})
+        hits = objects.cache_stats()['hits']
+        # change document bypassing turbokit, cached version is returned
+        yield self.db[Country._options.namespace].update(
+            {'_id': c.pk}, {'$set': {'title': 'Changed'}})
+        c_cached = yield objects.get({'id': c.pk})
+        self.assertEqual(objects.cache_stats()['hits'], hits + 1)
+        self.assertEqual(c_cached.title, 'Russia')
+        self.assertFalse(c_cached is c_db)
+        # other queries are not cached
+        c_other = yield objects.get({'code': 'ru'})
+        self.assertEqual(c_other.title, 'Changed')
+
+    @gen_test
+    def test_invalidation(self):
+        c = yield Country(dict(code='ru', title='Russia')).save(self.db)
+        objects = Country.objects.set_db(self.db)
+        yield objects.get({'id': c.pk})
+        yield objects.update({'id': c.pk}, {'$set': {'title': 'Updated'}})
+        c_db = yield objects.get({'id': c.pk})
+        self.assertEqual(c_db.title, 'Updated')
+        c_db.title = 'Saved'
+        yield c_db.save(self.db)
+        c_db = yield objects.get({'id': c.pk})
+        self.assertEqual(c_db.title, 'Saved')
+        yield objects.update({'code': 'ru'}, {'$set': {'title': 'Multi'}}, multi=True)
+        c_db = yield objects.get({'id': c.pk})
+        self.assertEqual(c_db.title, 'Multi')
+        yield c_db.remove(self.db)
+        c_db = yield objects.get({'id': c.pk})
+        self.assertEqual(c_db, None)
+
+    @gen_test
+    def test_prefetch_related_uses_cache(self):
+        c = yield Country(dict(code='ru', title='Russia')).save(self.db)
+        yield City(dict(title='Moscow', country=c)).save(self.db)
+        cities = City.objects.set_db(self.db).prefetch_related('country')
+        city = yield cities.get({'title': 'Moscow'})
+        self.assertEqual(city.country.title, 'Russia')
+        misses = Country.objects.cache_stats()['misses']
+        yield self.db[Country._options.namespace].update(
+            {'_id': c.pk}, {'$set': {'title': 'Changed'}})
+        city = yield cities.get({'title': 'Moscow'})
+        self.assertEqual(city.country.title, 'Russia')
+        self.assertEqual(Country.objects.cache_stats()['misses'], misses)
+        # saving of referenced document invalidates it
+        c.title = 'Saved'
+        yield c.save(self.db)
+        city = yield cities.get({'title': 'Moscow'})
+        self.assertEqual(city.country.title, 'Saved')
+
+
+class TestQueryCache(BaseTest):
+
+    def setUp(self):
+        super(TestQueryCache, self).setUp()
+        get_query_cache(Category).clear()
+
+    @gen.coroutine
+    def _create_categories(self, count=3):
+        for i in range(count):
+            yield Category(dict(title=str(i), position=i)).save(self.db)
+
+    @gen.coroutine
+    def _first_two(self):
+        result = yield Category.objects.set_db(self.db).filter({})\
+            .sort('position', 1).limit(2).all()
+        raise gen.Return([c.title for c in result])
+
+    @gen_test
+    def test_filter_is_cached_until_write(self):
+        yield self._create_categories()
+        titles = yield self._first_two()
+        self.assertEqual(titles, ['0', '1'])
+        stats = Category.objects.query_cache_stats()
+        # change bypassing turbokit is not visible
+        yield self.db[Category._options.namespace].update(
+            {'position': 0}, {'$set': {'title': 'changed'}})
+        titles = yield self._first_two()
+        self.assertEqual(titles, ['0', '1'])
+        self.assertEqual(Category.objects.query_cache_stats()['hits'],
+            stats['hits'] + 1)
+        # any write through turbokit drops cached results of collection
+        yield Category(dict(title='new', position=10)).save(self.db)
+        titles = yield self._first_two()
+        self.assertEqual(titles, ['changed', '1'])
+
+    @gen_test
+    def test_key_includes_cursor_spec(self):
+        yield self._create_categories()
+        objects = Category.objects.set_db(self.db)
+        first = yield objects.filter({}).sort('position', 1).limit(1).all()
+        last = yield objects.filter({}).sort('position', -1).limit(1).all()
+        skipped = yield objects.filter({}).sort('position', 1).skip(1).limit(1).all()
+        self.assertEqual([first[0].title, last[0].title, skipped[0].title],
+            ['0', '2', '1'])
+        cnt = yield objects.filter({'position': {'$gt': 0}}).count()
+        self.assertEqual(cnt, 2)
+        yield objects.update({'position': 0}, {'$set': {'position': 5}})
+        cnt = yield objects.filter({'position': {'$gt': 0}}).count()
+        self.assertEqual(cnt, 3)
+
+    @gen_test
+    def test_large_results_are_not_cached(self):
+        yield self._create_categories(count=6)
+        yield Category.objects.set_db(self.db).all()
+        self.assertEqual(Category.objects.query_cache_stats()['size'], 0)
+
+
+class TestSharedCacheBackend(TestCase):
+
+    def setUp(self):
+        self.address = os.path.join(tempfile.mkdtemp(), 'cache.sock')
+        self.manager = start_cache_server(self.address)
+
+    def tearDown(self):
+        self.manager.shutdown()
+
+    def test_shared_between_processes(self):
+        backend = SharedCacheBackend(self.address)
+        storage = backend.create_storage('document:test', max_size=10, ttl=60)
+
+        def worker():
+            other = SharedCacheBackend(self.address)
+            other.create_storage('document:test', max_size=10, ttl=60)\
+                .set(('db', 1), {'_id': 1})
+            other.bump_generation('test')
+
+        process = Process(target=worker)
+        process.start()
+        process.join()
+        self.assertEqual(storage.get(('db', 1)), {'_id': 1})
+        self.assertEqual(backend.get_generation('test'), 1)
+        storage.delete(('db', 1))
+        self.assertEqual(storage.get(('db', 1)), None)
+        self.assertEqual(storage.stats['hits'], 1)
+
+    def test_server_unavailable(self):
+        backend = SharedCacheBackend(self.address + '.missing')
+        storage = backend.create_storage('document:test')
+        storage.set('a', 1)
+        self.assertEqual(storage.get('a'), None)
+        self.assertEqual(backend.get_generation('test'), 0)
+
+    def test_lost_invalidation_clears_caches(self):
+        backend = SharedCacheBackend(self.address, retry_interval=0.01)
+        storage = backend.create_storage('document:test', max_size=10, ttl=60)
+        other = SharedCacheBackend(self.address).create_storage(
+            'document:test', max_size=10, ttl=60)
+        other.set('a', 1)
+        # server is unavailable for backend, invalidation can't be sent
+        backend._unavailable_until = time.time() + 0.01
+        storage.delete('b')
+        self.assertEqual(other.get('a'), 1)
+        time.sleep(0.02)
+        # the next call clears caches, before it is executed
+        self.assertEqual(storage.get('c'), None)
+        self.assertEqual(other.get('a'), None)
+
+    def test_server_not_answering(self):
+        # accepts connections, but never answers
+        address = self.address + '.hung'
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(address)
+        sock.listen(5)
+        try:
+            backend = SharedCacheBackend(address, timeout=0.05)
+            started_at = time.time()
+            self.assertEqual(backend.get_generation('test'), 0)
+            self.assertFalse(backend.available)
+            # no more waiting until retry interval passes
+            storage = backend.create_storage('document:test')
+            self.assertEqual(storage.get('a'), None)
+            self.assertLess(time.time() - started_at, 0.5)
+        finally:
+            sock.close()
+
+
+class FakeDB(object):
+    name = 'test'
+
+
+class TestInMemoryCollection(TestCase):
+
+    def setUp(self):
+        self.memory = InMemoryCollection(Currency, indexes=('code',))
+        self.memory._build([
+            {'_id': 1, 'code': 'usd', 'position': 2, 'tags': ['a', 'b']},
+            {'_id': 2, 'code': 'eur', 'position': 1, 'tags': ['b']},
+            {'_id': 3, 'code': 'rub', 'position': 3},
+        ])
+        self.memory.db_name = 'test'
+        self.memory._loaded_version = self.memory._version
+
+    def find_ids(self, query, **kwargs):
+        docs = self.memory.find(FakeDB(), query, **kwargs)
+        return [d['_id'] for d in docs] if docs is not None else None
+
+    def test_find(self):
+        self.assertEqual(self.find_ids({}), [1, 2, 3])
+        self.assertEqual(self.find_ids({'_id': 2}), [2])
+        self.assertEqual(self.find_ids({'code': {'$in': ['rub', 'usd']}}), [1, 3])
+        self.assertEqual(self.find_ids({'code': 'usd', 'position': 1}), [])
+        self.assertEqual(self.find_ids({'tags': 'b'}), [1, 2])
+        self.assertEqual(self.find_ids({},
+            sort=(('position', -1), {}), skip=1, limit=1), [1])
+        self.assertEqual(self.memory.stats['hits'], 6)
+
+    def test_fallback(self):
+        self.assertEqual(self.find_ids({'position': {'$gt': 1}}), None)
+        self.assertEqual(self.find_ids({'a.b': 1}), None)
+        self.assertEqual(self.find_ids({}, fields={'code': True}), None)
+        self.memory.invalidate()
+        self.assertEqual(self.find_ids({}), None)
+        self.assertFalse(self.memory.stats['fresh'])
+
+
+    def test_apply_changed_documents(self):
+        self.memory._apply([1, 3, 4], [
+            {'_id': 4, 'code': 'usd'},
+            {'_id': 1, 'code': 'gbp', 'tags': ['b']},
+        ])
+        self.assertEqual(self.find_ids({}), [1, 2, 4])
+        self.assertEqual(self.find_ids({'code': 'usd'}), [4])
+        self.assertEqual(self.find_ids({'code': 'gbp'}), [1])
+        self.assertEqual(self.find_ids({'tags': 'a'}), [])
+        self.assertEqual(sorted(self.memory.indexes['code']),
+            ['eur', 'gbp', 'usd'])
+        self.assertEqual(self.memory.size,
+            sum(self.memory.sizes[pk] for pk in [1, 2, 4]))
+
+
+class TestInMemoryCollectionWrites(AsyncTestCase):
+
+    @gen_test
+    def test_written_documents_are_read_again(self):
+        memory = InMemoryCollection(Currency, indexes=('code',))
+        memory._build([{'_id': 1, 'code': 'usd'}, {'_id': 2, 'code': 'eur'}])
+        memory.db_name = 'test'
+        memory._loaded_version = memory._version
+        response = Future()
+        memory._db = PendingDatabase(response)
+        memory.invalidate(ids=[1])
+        memory.invalidate(ids=[2])
+        self.assertIsNone(memory.find(FakeDB(), {'code': 'usd'}))
+        yield gen.moment
+        response.set_result([{'_id': 1, 'code': 'gbp'}])
+        while not memory.stats['fresh']:
+            yield gen.moment
+        docs = memory.find(FakeDB(), {})
+        self.assertEqual(docs, [{'_id': 1, 'code': 'gbp'}])
+        self.assertEqual(memory.stats['fetches'], 1)
+        self.assertEqual(memory.stats['loads'], 0)
+
+
+class TestInMemoryCollectionDB(BaseTest):
+
+    @gen_test
+    def test_served_from_memory(self):
+        for i, code in enumerate(['usd', 'eur']):
+            yield Currency(dict(code=code, position=i)).save(self.db)
+        objects = Currency.objects.set_db(self.db)
+        yield objects.load_in_memory()
+        memory = get_in_memory_collection(Currency)
+        hits, loads = memory.hits, memory.loads
+        usd = yield objects.get({'code': 'usd'})
+        currencies = yield objects.filter({'code': {'$in': ['usd', 'eur']}}).all()
+        self.assertEqual(len(currencies), 2)
+        self.assertEqual(memory.hits, hits + 2)
+        self.assertTrue(objects.memory_stats()['size'] > 0)
+        # write is visible immediately, saved document is read again
+        usd.title = 'Dollar'
+        yield usd.save(self.db)
+        usd = yield objects.get({'code': 'usd'})
+        self.assertEqual(usd.title, 'Dollar')
+        while not objects.memory_stats()['fresh']:
+            yield gen.moment
+        usd = yield objects.get({'code': 'usd'})
+        self.assertEqual(usd.title, 'Dollar')
+        self.assertEqual(memory.hits, hits + 3)
+        self.assertEqual(memory.loads, loads)
+        memory.stop()
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.testing import AsyncTestCase, gen_test
+from turbokit.models import BaseModel
+from turbokit.concurrency import (SingleFlight, coalesced, get_single_flight,
+    ConcurrencyLimiter, get_concurrency_limiter)
+from turbokit.errors import LimitExceeded
+from turbokit.retry import with_retry
+from turbokit.cursors import AsyncManagerCursor
+
+
+class CoalescedModel(BaseModel):
+    class Options:
+        namespace = 'coalesced_test'
+        coalesce_reads = True
+
+
+class SlowRead(object):
+    def __init__(self, result):
+        self.result = result
+        self.calls = 0
+
+    @gen.coroutine
+    def __call__(self, *args):
+        self.calls += 1
+        yield gen.Task(IOLoop.current().add_timeout, timedelta(seconds=0.01))
+        raise gen.Return(self.result)
+
+
+class TestSingleFlight(AsyncTestCase):
+
+    @gen_test
+    def test_concurrent_calls_share_result(self):
+        read = SlowRead([{'_id': 1, 'name': 'a'}])
+        results = yield [coalesced(CoalescedModel, 'key', read) for _ in range(3)]
+        self.assertEqual(read.calls, 1)
+        self.assertEqual(results, [read.result] * 3)
+        # every caller has its own copy
+        results[0][0]['name'] = 'changed'
+        self.assertEqual(results[1][0]['name'], 'a')
+        self.assertEqual(get_single_flight(CoalescedModel).in_flight, 0)
+
+    @gen_test
+    def test_sequential_calls_are_not_shared(self):
+        read = SlowRead({'_id': 1})
+        yield coalesced(CoalescedModel, 'key', read)
+        yield coalesced(CoalescedModel, 'key', read)
+        self.assertEqual(read.calls, 2)
+
+    @gen_test
+    def test_different_keys(self):
+        read = SlowRead({'_id': 1})
+        yield [coalesced(CoalescedModel, 'a', read),
+            coalesced(CoalescedModel, 'b', read)]
+        self.assertEqual(read.calls, 2)
+
+    @gen_test
+    def test_disabled(self):
+        read = SlowRead({'_id': 1})
+        yield [coalesced(BaseModel, 'key', read) for _ in range(2)]
+        self.assertEqual(read.calls, 2)
+        # no extra coroutine around the call
+        future = read()
+        self.assertIs(coalesced(BaseModel, 'key', lambda: future), future)
+        yield future
+
+    @gen_test
+    def test_error_is_shared(self):
+        flight = SingleFlight('test')
+
+        @gen.coroutine
+        def fail():
+            yield gen.moment
+            raise ValueError('failed')
+        futures = [flight.do('key', fail) for _ in range(2)]
+        for future in futures:
+            with self.assertRaises(ValueError):
+                yield future
+        self.assertEqual(flight.stats,
+            {'in_flight': 0, 'executed': 1, 'coalesced': 1})
+
+
+class LimitedModel(BaseModel):
+    class Options:
+        namespace = 'limited_test'
+        concurrency_limit = {'max_concurrent': 2, 'max_queue': 1,
+            'queue_timeout': 0.05}
+
+
+class TestConcurrencyLimiter(AsyncTestCase):
+
+    @gen.coroutine
+    def sleep(self, seconds):
+        yield gen.Task(IOLoop.current().add_timeout, timedelta(seconds=seconds))
+        raise gen.Return(seconds)
+
+    @gen_test
+    def test_limit_and_queue(self):
+        limiter = ConcurrencyLimiter('test', max_concurrent=2, max_queue=1,
+            queue_timeout=1)
+        futures = [limiter.run(self.sleep, 0.01) for _ in range(3)]
+        self.assertEqual((limiter.in_flight, limiter.stats['waiting']), (2, 1))
+        with self.assertRaises(LimitExceeded):
+            limiter.acquire()
+        results = yield futures
+        self.assertEqual(results, [0.01] * 3)
+        stats = limiter.stats
+        self.assertEqual((stats['in_flight'], stats['executed'],
+            stats['queued'], stats['rejected']), (0, 3, 1, 1))
+        self.assertEqual(stats['max_in_flight'], 2)
+
+    @gen_test
+    def test_queue_timeout(self):
+        limiter = ConcurrencyLimiter('test', max_concurrent=1, queue_timeout=0.01)
+        running = limiter.run(self.sleep, 0.05)
+        with self.assertRaises(LimitExceeded):
+            yield limiter.run(self.sleep, 0)
+        yield running
+        self.assertEqual(limiter.stats['timed_out'], 1)
+        self.assertEqual(limiter.in_flight, 0)
+
+    @gen_test
+    def test_with_retry_is_limited(self):
+        read = SlowRead([])
+        calls = [with_retry(LimitedModel, 'limited_test', 'all', read)
+            for _ in range(3)]
+        with self.assertRaises(LimitExceeded):
+            yield with_retry(LimitedModel, 'limited_test', 'all', read)
+        yield calls
+        self.assertEqual(read.calls, 3)
+        stats = get_concurrency_limiter(LimitedModel, 'limited_test').stats
+        self.assertEqual(stats['rejected'], 1)
+
+
+class TestReadKey(AsyncTestCase):
+
+    def test_key_is_built_only_when_used(self):
+        self.assertIsNone(AsyncManagerCursor(BaseModel, None, None,
+            query={}).get_read_key('all'))
+        db = type('DB', (object,), {'name': 'test'})()
+        cursor = type('Cursor', (object,), {'collection': db})()
+        key = AsyncManagerCursor(CoalescedModel, cursor, db,
+            query={'a': 1}).get_read_key('all')
+        self.assertEqual(key[0], 'test')
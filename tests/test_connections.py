@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+from unittest import TestCase
+from bson import ObjectId
+from tornado.concurrent import Future
+from tornado.testing import AsyncTestCase, gen_test
+from pymongo import ReadPreference
+from schematics.types import StringType
+from turbokit import connections
+from turbokit.models import BaseModel
+from turbokit.types import ModelReferenceType
+from turbokit.errors import NotRegistered
+from turbokit.connections import (register_connection, disconnect,
+    get_database, get_model_database, get_related_database)
+
+
+class DefaultRoutedModel(BaseModel):
+    name = StringType()
+
+    class Options:
+        namespace = 'routed_default'
+
+
+class LogModel(BaseModel):
+    message = StringType()
+
+    class Options:
+        namespace = 'routed_logs'
+        database = 'logs'
+        read_preference = ReadPreference.SECONDARY_PREFERRED
+        write_concern = {'w': 0}
+
+
+class EntryModel(BaseModel):
+    log = ModelReferenceType(LogModel)
+
+    class Options:
+        namespace = 'routed_entries'
+
+
+class FakeCursor(object):
+    def __init__(self, docs):
+        self.docs = docs
+
+    def to_list(self, length):
+        future = Future()
+        future.set_result(self.docs)
+        return future
+
+
+class FakeDatabase(object):
+    """Records queried collections"""
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.queried = []
+
+    def __getitem__(self, collection):
+        self.queried.append(collection)
+        return self
+
+    def find(self, query):
+        return FakeCursor(self.docs)
+
+
+class TestConnections(TestCase):
+
+    def setUp(self):
+        # client connects only on first operation
+        register_connection(uri='mongodb://localhost:27017', database='app')
+        register_connection('logs', uri='mongodb://localhost:27017',
+            database='app_logs')
+        self.addCleanup(disconnect)
+
+    def test_model_database(self):
+        db = DefaultRoutedModel.objects.db
+        self.assertEqual(db.name, 'app')
+        self.assertIs(DefaultRoutedModel().db, db)
+        logs_db = LogModel.objects.db
+        self.assertEqual(logs_db.name, 'app_logs')
+        self.assertEqual(logs_db.read_preference,
+            ReadPreference.SECONDARY_PREFERRED)
+        self.assertEqual(logs_db.write_concern, {'w': 0})
+        # client of alias is shared, configured databases are reused
+        self.assertIs(get_database().connection, db.connection)
+        self.assertIsNot(logs_db.connection, db.connection)
+        self.assertIs(get_model_database(LogModel), logs_db)
+
+    def test_overrides(self):
+        explicit_db = get_database('logs', 'other')
+        self.assertIs(LogModel.objects.set_db(explicit_db).db, explicit_db)
+        manager = LogModel.objects.only('message').with_options(
+            read_preference=ReadPreference.PRIMARY)
+        self.assertEqual(manager.db.read_preference, ReadPreference.PRIMARY)
+        self.assertEqual(manager.db.write_concern, {'w': 0})
+        self.assertEqual(manager.fields, {'message': True})
+        # model database is not changed
+        self.assertEqual(LogModel.objects.db.read_preference,
+            ReadPreference.SECONDARY_PREFERRED)
+        self.assertEqual(LogModel.objects.using('default').db.name, 'app')
+
+    def test_not_registered(self):
+        disconnect()
+        self.assertIsNone(DefaultRoutedModel.objects.db)
+        self.assertRaises(NotRegistered, lambda: LogModel.objects.db)
+
+
+class TestRelatedDatabase(AsyncTestCase):
+
+    def setUp(self):
+        super(TestRelatedDatabase, self).setUp()
+        register_connection(uri='mongodb://localhost:27017', database='app')
+        register_connection('logs', uri='mongodb://localhost:27017',
+            database='app_logs')
+        self.addCleanup(disconnect)
+
+    def test_related_model_uses_own_database(self):
+        app_db = get_database()
+        other_db = get_database(name='other')
+        self.assertIs(get_related_database(LogModel, app_db),
+            LogModel.objects.db)
+        self.assertIs(get_related_database(DefaultRoutedModel, other_db),
+            other_db)
+        manager = EntryModel.objects.set_db(other_db)
+        self.assertIs(manager.related_objects(LogModel).db,
+            LogModel.objects.db)
+        self.assertIs(manager.related_objects(DefaultRoutedModel).db, other_db)
+
+    @gen_test
+    def test_prefetch_from_database_of_related_model(self):
+        pk = ObjectId()
+        app_db = FakeDatabase([])
+        logs_db = FakeDatabase([{'_id': pk, 'message': 'hi'}])
+        connections._model_databases[LogModel] = logs_db
+        entry = EntryModel(dict(log=pk))
+        result = yield EntryModel.objects.set_db(app_db).fetch_related_objects(
+            [entry], related_fields=['log'])
+        self.assertEqual(result[0].log.message, 'hi')
+        self.assertEqual(logs_db.queried, ['routed_logs'])
+        self.assertEqual(app_db.queried, [])
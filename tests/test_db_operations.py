@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import logging
 import pymongo
+from unittest import TestCase
 from datetime import datetime, timedelta
 from base import BaseTest
 from tornado.testing import gen_test
@@ -8,7 +9,12 @@ from tornado import gen
 from example_app import models
 from turbokit.errors import OperationError
 from turbokit.models import BaseModel
+from turbokit.types import NULLIFY, CASCADE, DENY, PULL
+from turbokit.delete_rules import get_delete_rules_graph
+from turbokit.counters import check_counter_update
+from turbokit.snapshots import wait_for_propagation, changed_snapshot_values
 from schematics import types
+from schematics.exceptions import ModelValidationError
 
 l = logging.getLogger(__name__)
 
@@ -576,3 +582,321 @@ class TestReverseDeleteRulesListField(BaseTest):
         guru = yield self._create_child(models.ChildC)
         parent = model(dict(friends=friends, guru=guru))
         raise gen.Return((parent, guru, friends))
+
+
+class TestRemovePlan(BaseTest):
+
+    @gen_test
+    def test_plan_counts(self):
+        childs = []
+        for i in range(2):
+            child = models.ChildA()
+            yield child.save(self.db)
+            childs.append(child)
+        for M in [models.ParentB, models.ParentC, models.ParentC]:
+            yield M(dict(child=childs[0])).save(self.db)
+        plan = yield models.ChildA.objects.set_db(self.db).plan_remove(
+            {"id": childs[0].pk})
+        steps = dict(((s.model, s.rule), s.count) for s in plan)
+        self.assertEqual(steps[(models.ChildA, None)], 1)
+        self.assertEqual(steps[(models.ParentB, NULLIFY)], 1)
+        self.assertEqual(steps[(models.ParentC, CASCADE)], 2)
+        self.assertEqual(steps[(models.ParentD, DENY)], 0)
+        self.assertFalse(plan.denied)
+        # nothing is removed by dry run
+        cnt = yield models.ParentC.objects.set_db(self.db).count()
+        self.assertEqual(cnt, 2)
+
+    @gen_test
+    def test_plan_denied(self):
+        child = models.ChildA()
+        yield child.save(self.db)
+        yield models.ParentD(dict(child=child)).save(self.db)
+        plan = yield models.ChildA.objects.set_db(self.db).plan_remove({})
+        self.assertTrue(plan.denied)
+
+    @gen_test
+    def test_plan_cascade_tree(self):
+        M = models.TreeNode
+        root = yield M(dict(title='root')).save(self.db)
+        parent = root
+        for i in range(3):
+            parent = yield M(dict(title=str(i), parent=parent)).save(self.db)
+        plan = yield M.objects.set_db(self.db).plan_remove({"id": root.pk})
+        self.assertEqual(plan.total, 4)
+        self.assertEqual([s.depth for s in plan], [0, 1, 2, 3, 4])
+
+    @gen_test
+    def test_plan_in_batches(self):
+        childs = []
+        for i in range(3):
+            child = yield models.ChildA().save(self.db)
+            childs.append(child)
+        yield models.ParentI(dict(childs=childs)).save(self.db)
+        for child in childs:
+            yield models.ParentC(dict(child=child)).save(self.db)
+        graph = get_delete_rules_graph()
+        graph.batch_size = 2
+        self.addCleanup(delattr, graph, 'batch_size')
+        plan = yield models.ChildA.objects.set_db(self.db).plan_remove({})
+        steps = dict(((s.model, s.rule), s.count) for s in plan)
+        self.assertEqual(steps[(models.ParentI, PULL)], 1)
+        self.assertEqual(steps[(models.ParentC, CASCADE)], 3)
+
+    @gen_test
+    def test_nested_deny_stops_remove(self):
+        child = yield models.ChildA().save(self.db)
+        parent = yield models.ParentC(dict(child=child)).save(self.db)
+        yield models.ParentCGuard(dict(parent=parent)).save(self.db)
+        objects = models.ChildA.objects.set_db(self.db)
+        plan = yield objects.plan_remove({'id': child.pk})
+        self.assertTrue(plan.denied)
+        with self.assertRaises(OperationError):
+            yield objects.remove({'id': child.pk})
+
+    def test_graph_cycles(self):
+        graph = get_delete_rules_graph()
+        self.assertIn([models.TreeNode, models.TreeNode], graph.cycles)
+        self.assertEqual(graph.cascade_order(models.ChildA)[0], models.ChildA)
+        self.assertIn(models.ParentC, graph.cascade_order(models.ChildA))
+
+
+class TestAtomicOperators(BaseTest):
+
+    @gen_test
+    def test_inc(self):
+        u = yield models.User(dict(name='Igor', age=15)).save(self.db)
+        yield u.inc(self.db, {'age': 2})
+        self.assertEqual(u.age, 17)
+        u_db = yield models.User.objects.set_db(self.db).get({'id': u.pk})
+        self.assertEqual(u_db.age, 17)
+        yield models.User.objects.set_db(self.db).inc({'id': u.pk}, {'age': -7})
+        u_db = yield models.User.objects.set_db(self.db).get({'id': u.pk})
+        self.assertEqual(u_db.age, 10)
+
+    @gen_test
+    def test_list_operators(self):
+        sms = []
+        for i in range(3):
+            sm = yield models.SimpleModel(dict(title=str(i))).save(self.db)
+            sms.append(sm)
+        rs = yield models.RecordSeries(dict(simplies=[sms[0]])).save(self.db)
+        yield rs.push(self.db, {'simplies': sms[1]})
+        yield rs.add_to_set(self.db, {'simplies': [sms[1], str(sms[2].pk)]})
+        self.assertEqual(rs.simplies, [s.pk for s in sms])
+        yield rs.pull(self.db, {'simplies': sms[1].pk})
+        yield rs.pop(self.db, {'simplies': -1})
+        self.assertEqual(rs.simplies, [sms[2].pk])
+        rs_db = yield models.RecordSeries.objects.set_db(self.db).get({'id': rs.pk})
+        self.assertEqual(rs_db.simplies, rs.simplies)
+
+    @gen_test
+    def test_max_min_locale_datetime(self):
+        a = yield models.Action(dict(start_at=datetime(2014, 1, 1))).save(self.db)
+        start_at = a.start_at
+        yield a.max(self.db, {'start_at': datetime(2014, 2, 1)})
+        yield a.min(self.db, {'start_at': datetime(2014, 3, 1)})
+        self.assertTrue(a.start_at > start_at)
+        self.assertEqual(a.start_at.month, 2)
+        a_db = yield models.Action.objects.set_db(self.db).get({'id': a.pk})
+        self.assertEqual(a_db.start_at, a.start_at)
+
+    @gen_test
+    def test_unknown_field(self):
+        u = yield models.User(dict(name='Igor', age=15)).save(self.db)
+        with self.assertRaises(OperationError):
+            yield u.push(self.db, {'age': 1})
+
+
+class TestPatch(BaseTest):
+
+    @gen_test
+    def test_patch_nested_and_list_items(self):
+        M = models.SchematicsFieldsModel
+        m = M(dict(type_string='a', type_int=1,
+            type_model=dict(type_string='n', type_int=2),
+            type_list_model=[dict(type_string='l0'), dict(type_string='l1')]))
+        yield m.save(self.db)
+        yield M.objects.set_db(self.db).patch({'id': m.pk}, {
+            'type_int': None,
+            'type_model': {'type_int': '3'},
+            'type_list_model': {'1': {'type_int': 4}},
+        })
+        m_db = yield M.objects.set_db(self.db).get({'id': m.pk})
+        self.assertEqual(m_db.type_string, 'a')
+        self.assertEqual(m_db.type_int, None)
+        self.assertEqual(m_db.type_model.type_string, 'n')
+        self.assertEqual(m_db.type_model.type_int, 3)
+        self.assertEqual(m_db.type_list_model[0].type_string, 'l0')
+        self.assertEqual(m_db.type_list_model[1].type_string, 'l1')
+        self.assertEqual(m_db.type_list_model[1].type_int, 4)
+
+    @gen_test
+    def test_patch_validation(self):
+        M = models.SchematicsFieldsModel
+        m = yield M(dict(type_int=1)).save(self.db)
+        with self.assertRaises(ModelValidationError) as ctx:
+            yield M.objects.set_db(self.db).patch({'id': m.pk},
+                {'type_int': 'abc', 'type_email': 'no'})
+        self.assertEqual(set(ctx.exception.messages), set(['type_int', 'type_email']))
+        m_db = yield M.objects.set_db(self.db).get({'id': m.pk})
+        self.assertEqual(m_db.type_int, 1)
+
+    def test_flatten_data(self):
+        data = BaseModel.get_data_for_update(
+            {'a': 1, 'b': {'c': 2, 'd': {'e': 3}}, 'l': [{'x': 1}]},
+            flatten_data=True)
+        self.assertEqual(data, {'a': 1, 'b.c': 2, 'b.d.e': 3, 'l': [{'x': 1}]})
+
+
+class TestClientSideIds(BaseTest):
+
+    @gen_test
+    def test_reference_before_insert(self):
+        owner = models.User(dict(name='Igor'))
+        owner.assign_id()
+        tickets = [models.Ticket(dict(title=str(i), owner=owner)) for i in range(3)]
+        ids = yield models.Ticket.objects.set_db(self.db).insert(tickets)
+        self.assertEqual(ids, [t.pk for t in tickets])
+        yield owner.insert(self.db)
+        ts_db = yield models.Ticket.objects.set_db(self.db).filter(
+            {'owner': owner.pk}).all()
+        self.assertEqual(len(ts_db), 3)
+
+    @gen_test
+    def test_save_assigns_id_before_insert(self):
+        t = models.Ticket(dict(title='t'))
+        yield t.insert(self.db)
+        self.assertTrue(t.pk)
+        with self.assertRaises(pymongo.errors.DuplicateKeyError):
+            yield models.Ticket(dict(_id=t.pk)).insert(self.db)
+
+
+class TestCounterCache(BaseTest):
+
+    @gen.coroutine
+    def _get_counts(self, *blogs):
+        result = []
+        for blog in blogs:
+            blog_db = yield models.Blog.objects.set_db(self.db).get({'id': blog.pk})
+            result.append((blog_db.posts_count, blog_db.featured_count))
+        raise gen.Return(result)
+
+    @gen_test
+    def test_counters_are_maintained(self):
+        first = yield models.Blog(dict(title='first')).save(self.db)
+        second = yield models.Blog(dict(title='second')).save(self.db)
+        post = yield models.Post(dict(title='p1', blog=first,
+            featured_in=[first, second, second])).save(self.db)
+        yield models.Post.objects.set_db(self.db).insert(
+            [models.Post(dict(title='p2', blog=first))])
+        counts = yield self._get_counts(first, second)
+        self.assertEqual(counts, [(2, 1), (0, 1)])
+        # re-point reference
+        post.blog = second
+        post.featured_in = [first]
+        yield post.save(self.db)
+        counts = yield self._get_counts(first, second)
+        self.assertEqual(counts, [(1, 1), (1, 0)])
+        yield post.remove(self.db)
+        counts = yield self._get_counts(first, second)
+        self.assertEqual(counts, [(1, 0), (0, 0)])
+
+    @gen_test
+    def test_update_of_reference_is_rejected(self):
+        blog = yield models.Blog(dict(title='blog')).save(self.db)
+        post = yield models.Post(dict(title='p1', blog=blog)).save(self.db)
+        objects = models.Post.objects.set_db(self.db)
+        with self.assertRaises(OperationError):
+            yield objects.patch({'id': post.pk}, {'blog': None})
+        with self.assertRaises(OperationError):
+            yield post.push(self.db, {'featured_in': blog})
+        yield objects.update({'_id': post.pk}, {'$set': {'title': 'p2'}})
+        counts = yield self._get_counts(blog)
+        self.assertEqual(counts, [(1, 0)])
+
+    @gen_test
+    def test_rebuild(self):
+        blog = yield models.Blog(dict(title='blog')).save(self.db)
+        for i in range(3):
+            yield models.Post(dict(title=str(i), blog=blog,
+                featured_in=[blog])).save(self.db)
+        yield self.db[models.Blog._options.namespace].update({'_id': blog.pk},
+            {'$set': {'posts_count': 10, 'featured_count': 10}})
+        yield models.Post.objects.set_db(self.db).rebuild_counters()
+        counts = yield self._get_counts(blog)
+        self.assertEqual(counts, [(3, 3)])
+
+
+class TestCounterUpdateCheck(TestCase):
+
+    def test_reference_changes_are_rejected(self):
+        for raw_data in [
+                {'$set': {'blog': 1}},
+                {'$unset': {'blog': ''}},
+                {'$set': {'blog._id': 1}},
+                {'$push': {'featured_in': 1}},
+                {'$set': {'featured_in.$': 1}},
+                {'$set': {'featured_in.0._id': 1}},
+                {'$rename': {'title': 'blog'}},
+                {'title': 'replacement'}]:
+            with self.assertRaises(OperationError):
+                check_counter_update(models.Post, raw_data)
+
+    def test_other_changes_are_allowed(self):
+        check_counter_update(models.Post, {'$set': {'title': 'post',
+            'blog.title': 'snapshot', 'featured_in.$.title': 'snapshot'}})
+        check_counter_update(models.Post, {'$inc': {'blogger': 1}})
+        check_counter_update(models.Blog, {'title': 'replacement'})
+
+
+class TestSnapshotReference(BaseTest):
+
+    def test_snapshot_conversion(self):
+        user = models.User(dict(name='Igor'))
+        user.assign_id()
+        comment = models.Comment(dict(author=user, likers=[user]))
+        data = comment.to_mongo()
+        self.assertEqual(data['author'], {'_id': user.pk, 'name': 'Igor'})
+        self.assertEqual(data['likers'], [{'_id': user.pk, 'name': 'Igor'}])
+        comment = models.Comment(data, from_mongo=True)
+        self.assertEqual(comment.author, user.pk)
+        self.assertEqual(comment.author.name, 'Igor')
+        self.assertEqual(comment.likers[0].name, 'Igor')
+        self.assertEqual(comment.to_mongo(), data)
+        self.assertEqual(comment.to_primitive()['author'], str(user.pk))
+
+    @gen_test
+    def test_snapshot_is_filled_and_propagated(self):
+        igor = yield models.User(dict(name='Igor')).save(self.db)
+        anna = yield models.User(dict(name='Anna')).save(self.db)
+        comment = models.Comment(dict(text='hi', author=igor.pk,
+            likers=[igor.pk, anna.pk]))
+        yield comment.save(self.db)
+        comments = models.Comment.objects.set_db(self.db)
+        comment_db = yield comments.get({'author': igor})
+        self.assertEqual(comment_db.author.name, 'Igor')
+        self.assertEqual([u.name for u in comment_db.likers], ['Igor', 'Anna'])
+        igor.name = 'Igor Jr'
+        yield igor.save(self.db)
+        yield wait_for_propagation()
+        comment_db = yield comments.get({'author.name': 'Igor Jr'})
+        self.assertEqual(comment_db.pk, comment.pk)
+        self.assertEqual(comment_db.likers[0].name, 'Igor Jr')
+        # delete rules and prefetch work by id of snapshot
+        comment_db = yield comments.prefetch_related('author').get({'id': comment.pk})
+        self.assertEqual(comment_db.author.pk, igor.pk)
+        yield anna.remove(self.db)
+        comment_db = yield comments.get({'likers': igor.pk})
+        self.assertEqual(len(comment_db.likers), 1)
+
+    @gen_test
+    def test_unchanged_snapshot_is_not_propagated_again(self):
+        igor = yield models.User(dict(name='Igor')).save(self.db)
+        igor.name = 'Igor Jr'
+        yield igor.save(self.db)
+        self.assertEqual(changed_snapshot_values(igor,
+            igor.get_data_for_save()), {})
+        igor.name = 'Igor'
+        self.assertEqual(len(changed_snapshot_values(igor,
+            igor.get_data_for_save())), 2)
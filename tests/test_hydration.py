@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+from tornado.concurrent import dummy_executor
+from tornado.ioloop import IOLoop
+from tornado.testing import AsyncTestCase, gen_test
+from schematics.types import StringType
+from turbokit.models import BaseModel
+from turbokit.hydration import (should_offload, hydrate, hydrate_async,
+    serialize_async, get_hydration_stats)
+
+
+class ChunkedModel(BaseModel):
+    name = StringType()
+
+    class Options:
+        namespace = 'hydration_chunked_test'
+        hydration = {'threshold': 3, 'chunk_size': 2}
+
+
+class ExecutorModel(BaseModel):
+    name = StringType()
+
+    class Options:
+        namespace = 'hydration_executor_test'
+        hydration = {'threshold': 3, 'executor': dummy_executor}
+
+
+class TestHydration(AsyncTestCase):
+
+    def raw_docs(self, count):
+        return [{'name': str(i)} for i in range(count)]
+
+    def test_threshold(self):
+        self.assertFalse(should_offload(ChunkedModel, 2))
+        self.assertTrue(should_offload(ChunkedModel, 3))
+        self.assertFalse(should_offload(BaseModel, 10000))
+
+    @gen_test
+    def test_chunks_let_other_callbacks_run(self):
+        calls = []
+        IOLoop.current().add_callback(calls.append, 'other')
+        future = hydrate_async(ChunkedModel, self.raw_docs(5))
+        self.assertEqual(calls, [])  # first chunk is converted synchronously
+        result = yield future
+        self.assertEqual(calls, ['other'])
+        self.assertEqual([m.name for m in result], ['0', '1', '2', '3', '4'])
+        stats = get_hydration_stats(ChunkedModel).stats
+        self.assertEqual((stats['chunked'], stats['documents']), (1, 5))
+        self.assertGreater(stats['blocking_total'], 0)
+
+    @gen_test
+    def test_executor(self):
+        result = yield hydrate_async(ExecutorModel, self.raw_docs(3))
+        self.assertTrue(all(isinstance(m, ExecutorModel) for m in result))
+        raw = yield serialize_async(ExecutorModel, result)
+        self.assertEqual([d['name'] for d in raw], ['0', '1', '2'])
+        self.assertEqual(get_hydration_stats(ExecutorModel).offloaded, 2)
+
+    def test_sync_hydration_is_measured(self):
+        hydrate(BaseModel, [{}])
+        stats = get_hydration_stats(BaseModel).stats
+        self.assertGreaterEqual(stats['calls'], 1)
+        self.assertGreaterEqual(stats['blocking_max'], 0)
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+from tornado.testing import AsyncTestCase, gen_test
+from tornado.concurrent import Future
+from pymongo.errors import AutoReconnect, DuplicateKeyError, OperationFailure
+from turbokit.models import BaseModel
+from turbokit.retry import (RetryPolicy, CircuitBreaker, with_retry,
+    get_retry_policy, DEFAULT_RETRY_POLICY)
+from turbokit.errors import CircuitOpen
+from example_app.models import Ticket
+
+
+class RetryModel(BaseModel):
+    class Options:
+        namespace = 'retry_test'
+        retry_policy = RetryPolicy(max_retries=3, base_delay=0.001,
+            max_delay=0.01, deadline=1)
+        circuit_breaker = {'failure_threshold': 100, 'reset_timeout': 1}
+
+
+class RetryWritesModel(BaseModel):
+    class Options:
+        namespace = 'retry_writes_test'
+        retry_policy = RetryPolicy(max_retries=3, base_delay=0.001,
+            max_delay=0.01, deadline=1, retry_writes=True)
+        circuit_breaker = None
+
+
+class LegacyRetryModel(BaseModel):
+    RECONNECT_TRIES = 2
+    RECONNECT_TIMEOUT = 0.001
+
+    class Options:
+        namespace = 'legacy_retry_test'
+
+
+class FlakyOperation(object):
+    def __init__(self, errors, result='ok'):
+        self.errors = list(errors)
+        self.result = result
+        self.calls = 0
+
+    def __call__(self, *args, **kwargs):
+        self.calls += 1
+        future = Future()
+        if self.errors:
+            future.set_exception(self.errors.pop(0))
+        else:
+            future.set_result(self.result)
+        return future
+
+
+class FakeCollection(object):
+    def __init__(self, **operations):
+        self.__dict__.update(operations)
+
+
+class TestRetryPolicy(AsyncTestCase):
+
+    @gen_test
+    def test_retry_until_success(self):
+        op = FlakyOperation([AutoReconnect('down'), AutoReconnect('down')])
+        result = yield with_retry(RetryModel, 'retry_test_1', 'get', op)
+        self.assertEqual(result, 'ok')
+        self.assertEqual(op.calls, 3)
+
+    @gen_test
+    def test_retries_exceeded(self):
+        op = FlakyOperation([AutoReconnect('down')] * 10)
+        with self.assertRaises(AutoReconnect):
+            yield with_retry(RetryModel, 'retry_test_2', 'get', op)
+        self.assertEqual(op.calls, 4)
+
+    @gen_test
+    def test_not_retryable(self):
+        op = FlakyOperation([DuplicateKeyError('dup', code=11000)])
+        with self.assertRaises(DuplicateKeyError):
+            yield with_retry(RetryModel, 'retry_test_3', 'insert', op, write=True)
+        self.assertEqual(op.calls, 1)
+
+    @gen_test
+    def test_writes_are_not_retried_by_default(self):
+        op = FlakyOperation([AutoReconnect('down')])
+        with self.assertRaises(AutoReconnect):
+            yield with_retry(RetryModel, 'retry_test_6', 'update', op,
+                write=True)
+        self.assertEqual(op.calls, 1)
+        op = FlakyOperation([AutoReconnect('down')])
+        result = yield with_retry(RetryWritesModel, 'retry_test_6', 'update',
+            op, write=True)
+        self.assertEqual(result, 'ok')
+        self.assertEqual(op.calls, 2)
+
+    @gen_test
+    def test_legacy_reconnect_settings(self):
+        self.assertIs(get_retry_policy(BaseModel), DEFAULT_RETRY_POLICY)
+        policy = get_retry_policy(LegacyRetryModel)
+        self.assertEqual(policy.max_retries, 2)
+        self.assertEqual(policy.get_delay(1), 0.001)
+        self.assertEqual(list(LegacyRetryModel.reconnect_amount()), [0, 1, 2])
+        exceeded = yield LegacyRetryModel.check_reconnect_tries_and_wait(1,
+            'save')
+        self.assertFalse(exceeded)
+        exceeded = yield LegacyRetryModel.check_reconnect_tries_and_wait(2,
+            'save')
+        self.assertTrue(exceeded)
+
+    @gen_test
+    def test_save_with_id_is_retried(self):
+        op = FlakyOperation([AutoReconnect('down')] * 2)
+        db = {'retry_test': FakeCollection(save=op)}
+        instance = RetryModel()
+        instance.assign_id()
+        yield instance.save(db)
+        self.assertEqual(op.calls, 3)
+        # the same for models with deprecated reconnect settings
+        op = FlakyOperation([AutoReconnect('down')])
+        db = {'legacy_retry_test': FakeCollection(save=op)}
+        instance = LegacyRetryModel()
+        instance.assign_id()
+        yield instance.save(db)
+        self.assertEqual(op.calls, 2)
+
+    @gen_test
+    def test_save_with_client_side_id_is_retried(self):
+        op = FlakyOperation([AutoReconnect('down')])
+        db = {Ticket.get_collection(): FakeCollection(save=op)}
+        ticket = Ticket(dict(title='retried'))
+        yield ticket.save(db)
+        self.assertEqual(op.calls, 2)
+        self.assertIsNotNone(ticket.pk)
+
+    @gen_test
+    def test_not_master_is_retryable(self):
+        op = FlakyOperation([OperationFailure('not master', code=10107)])
+        result = yield with_retry(RetryModel, 'retry_test_4', 'update', op)
+        self.assertEqual(result, 'ok')
+
+    @gen_test
+    def test_duplicate_id_after_retry(self):
+        dup = DuplicateKeyError(
+            'E11000 duplicate key error index: test.retry_test.$_id_  dup key',
+            code=11000)
+        op = FlakyOperation([AutoReconnect('down'), dup])
+        result = yield with_retry(RetryModel, 'retry_test_5', 'insert', op,
+            write=True, ignore_duplicate_id=True)
+        self.assertEqual(result, None)
+        # duplicate on the first attempt is a real conflict
+        op = FlakyOperation([dup])
+        with self.assertRaises(DuplicateKeyError):
+            yield with_retry(RetryModel, 'retry_test_5', 'insert', op,
+                write=True, ignore_duplicate_id=True)
+
+    def test_delay(self):
+        policy = RetryPolicy(base_delay=0.1, max_delay=1, jitter=0)
+        self.assertEqual([policy.get_delay(i) for i in range(5)],
+            [0.1, 0.2, 0.4, 0.8, 1])
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=0)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+        breaker.before_call()  # trial call
+        with self.assertRaises(CircuitOpen):
+            breaker.before_call()
+        breaker.record_success()
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        breaker.reset_timeout = 60
+        breaker.record_failure()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, breaker.OPEN)
+        with self.assertRaises(CircuitOpen):
+            breaker.before_call()
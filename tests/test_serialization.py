@@ -5,9 +5,11 @@ import re
 from datetime import datetime, timedelta
 from tornado.testing import gen_test
 from tornado import gen
+from unittest import TestCase
 from example_app.models import (SchematicsFieldsModel, SimpleModel, User,
     Event, Record, Transaction, Page, Topic, Action, ActionDefaultDate,
-    ActionWithMixin, ActionSubclassed)
+    ActionWithMixin, ActionSubclassed, Invoice)
+from turbokit.types import memoized_serializable
 from .base import BaseSerializationTest, BaseTest
 
 
@@ -552,3 +554,57 @@ class TestSerializationGenericModelReference(BaseTest):
     @gen_test
     def test_generic_model_prefetch_related_filter_child_fields(self):
         pass
+
+
+class TestMemoizedSerializable(TestCase):
+
+    def test_value_is_cached_until_dependency_changes(self):
+        invoice = Invoice(dict(amount=100, tax_rate=0.5))
+        self.assertEqual(invoice.to_primitive()['total'], 150)
+        self.assertEqual(invoice.to_primitive(role='short')['total'], 150)
+        self.assertEqual(invoice.total, 150)
+        self.assertEqual(invoice.total_calls, 1)
+        invoice.tax_rate = 0.25
+        self.assertEqual(invoice.to_primitive()['total'], 125)
+        self.assertEqual(invoice.total_calls, 2)
+        # not a dependency
+        invoice.lines = [1]
+        self.assertEqual(invoice.total, 125)
+        self.assertEqual(invoice.total_calls, 2)
+
+    def test_in_place_changes_are_noticed(self):
+        invoice = Invoice(dict(amount=1, lines=[1, 2]))
+        self.assertEqual(invoice.lines_sum, 4)
+        invoice.lines.append(3)
+        self.assertEqual(invoice.to_primitive()['lines_sum'], 7)
+        self.assertNotIn('lines_sum', invoice.to_primitive(role='short'))
+
+    def test_depends_on_is_required(self):
+        with self.assertRaises(TypeError):
+            @memoized_serializable
+            def title(self):
+                return None
+        with self.assertRaises(TypeError):
+            @memoized_serializable(depends_on=())
+            def name(self):
+                return None
+
+    def test_cache_is_per_instance(self):
+        first = Invoice(dict(amount=1))
+        second = Invoice(dict(amount=2))
+        self.assertEqual((first.total, second.total), (1, 2))
+
+    def test_referenced_instances_are_not_copied(self):
+        class UncopyableDB(object):
+            def __deepcopy__(self, memo):
+                raise TypeError("Database can't be copied")
+        customer = SimpleModel(dict(title='first'), db=UncopyableDB())
+        customer.assign_id()
+        invoice = Invoice(dict(amount=1, customer=customer))
+        self.assertEqual(invoice.customer_title, 'first')
+        self.assertIs(invoice.customer, customer)
+        other = SimpleModel(dict(title='second'), db=UncopyableDB())
+        other.assign_id()
+        invoice.customer = other
+        self.assertEqual(invoice.customer_title, 'second')
+        self.assertIs(invoice.customer, other)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+from unittest import TestCase
+from tornado import gen
+from tornado.testing import gen_test
+from example_app.models import Blog, Post, Country, City
+from turbokit import signals
+from turbokit.session import Session, dependency_order
+from .base import BaseTest
+
+
+class TestSessionTracking(TestCase):
+
+    def test_dependency_order(self):
+        self.assertEqual(dependency_order([City, Post, Country, Blog]),
+            [Country, City, Blog, Post])
+
+    def test_tracking(self):
+        session = Session()
+        country = Country({'code': 'fr'})
+        city = City({'id': '5400e8a5bfd7040b2f4f2b1c', 'title': 'Paris'})
+        session.add_all([country, city, country])
+        self.assertEqual(session.new, [country])
+        self.assertEqual(session.dirty, [city])
+        session.remove(city)
+        self.assertEqual(session.dirty, [])
+        self.assertEqual(session.removed, [city])
+        self.assertIn(city, session)
+        session.clear()
+        self.assertNotIn(country, session)
+
+
+class TestSessionFlush(BaseTest):
+
+    @gen_test
+    def test_flush(self):
+        saved = []
+
+        @gen.coroutine
+        def on_bulk_save(sender, documents):
+            saved.append([d.title for d in documents])
+        signals.post_bulk_save.connect(on_bulk_save, sender=City)
+        self.addCleanup(signals.post_bulk_save.disconnect, on_bulk_save,
+            sender=City)
+        session = Session(self.db)
+        country = Country({'code': 'fr'})
+        cities = [City({'title': t, 'country': country})
+            for t in ('Paris', 'Lyon')]
+        session.add_all(cities + [country])  # country is inserted first
+        stats = yield session.flush()
+        self.assertEqual(stats['inserted'], 3)
+        objects = City.objects.set_db(self.db)
+        paris = yield objects.get({'title': 'Paris'})
+        self.assertEqual(paris.country, country.pk)
+        lyon = yield objects.get({'title': 'Lyon'})
+        paris.title = 'Paris, France'
+        session.add_all([paris, lyon])
+        session.remove(country)
+        stats = yield session.flush()
+        self.assertEqual((stats['updated'], stats['skipped'], stats['removed']),
+            (1, 1, 1))
+        self.assertEqual(saved, [['Paris, France']])
+        titles = yield objects.filter({}).sort('title').all()
+        self.assertEqual([c.title for c in titles], ['Lyon', 'Paris, France'])
+        count = yield Country.objects.set_db(self.db).count()
+        self.assertEqual(count, 0)
+
+    @gen_test
+    def test_counters(self):
+        blog = Blog({'title': 'b'})
+        yield blog.save(self.db)
+        session = Session(self.db)
+        posts = [Post({'title': str(i), 'blog': blog}) for i in range(3)]
+        session.add_all(posts)
+        yield session.flush()
+        posts[0].blog = None
+        session.add(posts[0])
+        yield session.flush()
+        blog = yield Blog.objects.set_db(self.db).get({'id': blog.pk})
+        self.assertEqual(blog.posts_count, 2)
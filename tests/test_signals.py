@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
 from base import BaseTest
-from tornado.testing import gen_test
+from datetime import timedelta
+from tornado.testing import gen_test, AsyncTestCase
 from tornado import gen
+from tornado.ioloop import IOLoop
 from example_app import models
 from turbokit import signals
+from turbokit.errors import SignalError
+from turbokit.concurrency import DeferredQueue
 
 
 class TestSignals(BaseTest):
@@ -86,3 +90,223 @@ class TestSignals(BaseTest):
         self.assertFalse(self.signal_called)
         yield sm.remove(self.db)
         self.assertTrue(self.signal_called)
+
+
+class TestBulkSignals(BaseTest):
+
+    def setUp(self):
+        super(TestBulkSignals, self).setUp()
+        self.calls = []
+
+    def connect(self, signal, sender):
+        @gen.coroutine
+        def receiver(sender, **kwargs):
+            documents = kwargs.get('documents') or [kwargs.get('document')]
+            self.calls.append((signal.name,
+                [d.secret for d in documents if d is not None]))
+        signal.connect(receiver, sender=sender)
+        self.addCleanup(signal.disconnect, receiver, sender=sender)
+
+    @gen_test
+    def test_bulk_insert_and_remove(self):
+        M = models.SimpleModel
+        for signal in (signals.pre_bulk_insert, signals.post_bulk_insert,
+                signals.pre_bulk_remove, signals.post_bulk_remove,
+                signals.post_remove):
+            self.connect(signal, M)
+        objects = M.objects.set_db(self.db)
+        docs = [M(dict(secret=str(i))) for i in range(3)]
+        yield objects.insert(docs)
+        self.assertTrue(all(d.pk for d in docs))
+        self.assertEqual(self.calls, [('pre_bulk_insert', ['0', '1', '2']),
+            ('post_bulk_insert', ['0', '1', '2'])])
+        self.calls = []
+        yield objects.remove({'secret': {'$in': ['0', '1']}},
+            document_signals=False)
+        self.assertEqual(self.calls, [('pre_bulk_remove', ['0', '1']),
+            ('post_bulk_remove', ['0', '1'])])
+        self.calls = []
+        yield objects.remove({'secret': '2'})
+        self.assertEqual(self.calls, [('pre_bulk_remove', ['2']),
+            ('post_remove', ['2']), ('post_bulk_remove', ['2'])])
+
+    @gen_test
+    def test_bulk_update(self):
+        M = models.SimpleModel
+        calls = []
+
+        @gen.coroutine
+        def receiver(sender, query, update, multi, **kwargs):
+            calls.append((query, update, multi, 'result' in kwargs))
+        signals.post_bulk_update.connect(receiver, sender=M)
+        self.addCleanup(signals.post_bulk_update.disconnect, receiver, sender=M)
+        yield M.objects.set_db(self.db).update({'secret': 'a'},
+            {'$set': {'secret': 'b'}}, multi=True)
+        self.assertEqual(calls, [({'secret': 'a'}, {'$set': {'secret': 'b'}},
+            True, True)])
+
+
+class TestConcurrentSignal(AsyncTestCase):
+
+    def setUp(self):
+        super(TestConcurrentSignal, self).setUp()
+        self.calls = []
+
+    def receiver(self, name, delay=0.01, error=None):
+        @gen.coroutine
+        def receive(sender, **kwargs):
+            self.calls.append(('start', name))
+            yield gen.Task(IOLoop.current().add_timeout, timedelta(seconds=delay))
+            self.calls.append(('end', name))
+            if error:
+                raise error
+            raise gen.Return(name)
+        receive.__name__ = name
+        return receive
+
+    @gen_test
+    def test_receivers_run_concurrently_by_priority(self):
+        signal = signals.AsyncSignal(concurrent=True)
+        receivers = [self.receiver('first', delay=0.02), self.receiver('second'),
+            self.receiver('last')]
+        signal.connect(receivers[0], priority=1)
+        signal.connect(receivers[1], priority=1)
+        signal.connect(receivers[2])
+        results = yield signal.send(None)
+        self.assertEqual([r for _, r in results], ['first', 'second', 'last'])
+        self.assertEqual(self.calls, [('start', 'first'), ('start', 'second'),
+            ('end', 'second'), ('end', 'first'), ('start', 'last'), ('end', 'last')])
+
+    @gen_test
+    def test_sequential_by_priority(self):
+        signal = signals.AsyncSignal()
+        receivers = [self.receiver('low'), self.receiver('high')]
+        signal.connect(receivers[0], priority=-1)
+        signal.connect(receivers[1], priority=5)
+        results = yield signal.send(None)
+        self.assertEqual([r for _, r in results], ['high', 'low'])
+        signal.disconnect(receivers[1])
+        self.assertEqual([p for p, _ in signal._priorities.values()], [-1])
+
+    @gen_test
+    def test_errors_are_aggregated(self):
+        signal = signals.AsyncSignal(concurrent=True)
+        receivers = [self.receiver('ok'), self.receiver('bad', error=ValueError()),
+            self.receiver('worse', error=KeyError()), self.receiver('next')]
+        for r in receivers[:3]:
+            signal.connect(r, priority=1)
+        signal.connect(receivers[3])
+        with self.assertRaises(SignalError) as cm:
+            yield signal.send(None)
+        self.assertEqual(sorted(type(e).__name__ for _, e in cm.exception.errors),
+            ['KeyError', 'ValueError'])
+        self.assertEqual([r for _, r in cm.exception.results], ['ok'])
+        self.assertNotIn(('start', 'next'), self.calls)
+
+
+class TestReceiversCache(AsyncTestCase):
+
+    @gen_test
+    def test_cache_is_invalidated(self):
+        signal = signals.AsyncSignal()
+
+        class Sender(object):
+            pass
+
+        @gen.coroutine
+        def receiver(sender, **kwargs):
+            raise gen.Return('called')
+        self.assertFalse(signal.has_receivers(Sender))
+        signal.connect(receiver, sender=Sender)
+        self.assertTrue(signal.has_receivers(Sender))
+        self.assertFalse(signal.has_receivers(object))
+        results = yield signal.send(Sender)
+        self.assertEqual(results, [(receiver, 'called')])
+        signal.disconnect(receiver, sender=Sender)
+        self.assertFalse(signal.has_receivers(Sender))
+        signal.connect(receiver)
+        self.assertTrue(signal.has_receivers(object))
+        signal.disconnect(receiver)
+
+        @gen.coroutine
+        def weak_receiver(sender, **kwargs):
+            pass
+        signal.connect(weak_receiver, sender=Sender)
+        self.assertTrue(signal.has_receivers(Sender))
+        del weak_receiver
+        results = yield signal.send(Sender)
+        self.assertEqual(results, [])
+        self.assertFalse(signal.has_receivers(Sender))
+
+
+class TestDeferredReceivers(AsyncTestCase):
+
+    def setUp(self):
+        super(TestDeferredReceivers, self).setUp()
+        self.queue = DeferredQueue(maxsize=2, workers=1, retries=1,
+            retry_delay=0.01)
+        signals.set_deferred_queue(self.queue)
+        self.addCleanup(signals.set_deferred_queue, None)
+        self.calls = []
+
+    @gen.coroutine
+    def slow_receiver(self, sender, **kwargs):
+        yield gen.Task(IOLoop.current().add_timeout, timedelta(seconds=0.01))
+        self.calls.append(kwargs['n'])
+
+    @gen_test
+    def test_send_does_not_wait_for_deferred_receivers(self):
+        signal = signals.AsyncSignal()
+        signal.connect(self.slow_receiver, deferred=True)
+        results = yield signal.send(None, n=1)
+        self.assertEqual(results, [(self.slow_receiver, None)])
+        self.assertEqual(self.calls, [])
+        drained = yield self.queue.drain(timeout=1)
+        self.assertTrue(drained)
+        self.assertEqual(self.calls, [1])
+        self.assertEqual(self.queue.stats['processed'], 1)
+
+    @gen_test
+    def test_backpressure(self):
+        for n in range(5):
+            yield self.queue.put(self.slow_receiver, None, n=n)
+            self.assertLessEqual(self.queue.depth, 2)
+        yield self.queue.drain()
+        self.assertEqual(self.calls, range(5))
+        self.assertEqual(self.queue.stats['max_depth'], 2)
+
+    @gen_test
+    def test_failed_call_is_retried(self):
+        attempts = []
+
+        @gen.coroutine
+        def flaky(sender, **kwargs):
+            attempts.append(1)
+            if len(attempts) < 2:
+                raise ValueError()
+        yield self.queue.put(flaky, None)
+        yield self.queue.drain()
+        self.assertEqual(len(attempts), 2)
+        stats = self.queue.stats
+        self.assertEqual((stats['processed'], stats['retried'], stats['failed']),
+            (1, 1, 0))
+        self.queue.stop()
+
+    @gen_test
+    def test_reentrant_send(self):
+        # the only worker sends deferred signals, while the queue is full
+        self.queue.put_timeout = 0.05
+        inner = signals.AsyncSignal()
+        inner.connect(self.slow_receiver, deferred=True)
+
+        @gen.coroutine
+        def outer_receiver(sender, **kwargs):
+            for n in range(3):
+                yield inner.send(None, n=n)
+        outer = signals.AsyncSignal()
+        outer.connect(outer_receiver, deferred=True)
+        yield outer.send(None)
+        drained = yield self.queue.drain(timeout=1)
+        self.assertTrue(drained)
+        self.assertEqual(sorted(self.calls), [0, 1, 2])
+        self.assertEqual(self.queue.stats['inline'], 1)
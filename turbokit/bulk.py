@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+"""
+Parallel import and export of model collections as NDJSON (MongoDB
+extended JSON, one document per line) or BSON files.
+
+File is read (or collection is iterated) in the main process, batches are
+converted by pool of worker processes, imported batches are inserted by
+workers too. Progress is saved into checkpoint file after every batch, so
+interrupted run continues from the last saved batch.
+
+    turbokit-bulk export myapp.models.Event events.ndjson --db app
+    turbokit-bulk import myapp.models.Event events.ndjson --db app \\
+        --processes 8 --checkpoint events.checkpoint
+"""
+import os
+import sys
+import json
+import time
+import struct
+import argparse
+import importlib
+from datetime import datetime
+from collections import deque
+from itertools import islice
+from multiprocessing import Pool, cpu_count
+from bson import BSON, json_util
+from bson.tz_util import utc
+from pymongo import MongoClient
+from pymongo.errors import DuplicateKeyError
+from schematics.exceptions import BaseError
+
+FORMATS = ('ndjson', 'bson')
+# amount of error messages, kept in result of import
+MAX_ERRORS = 100
+
+
+def load_model(path):
+    """Model class by dotted path: 'myapp.models.Event'"""
+    module, name = path.rsplit('.', 1)
+    return getattr(importlib.import_module(module), name)
+
+
+def model_path(cls):
+    return '{0}.{1}'.format(cls.__module__, cls.__name__)
+
+
+def guess_format(path):
+    return 'bson' if path.endswith('.bson') else 'ndjson'
+
+
+def read_records(fileobj, fmt):
+    """Encoded documents of file: lines of NDJSON or BSON documents"""
+    if fmt == 'ndjson':
+        for line in fileobj:
+            if line.strip():
+                yield line
+        return
+    while True:
+        header = fileobj.read(4)
+        if not header:
+            return
+        if len(header) < 4:
+            raise ValueError("Truncated BSON file")
+        size = struct.unpack('<i', header)[0]
+        yield header + fileobj.read(size - 4)
+
+
+def _object_hook(dct):
+    """
+    json_util hook, that returns naive UTC datetimes, as BSON decoding
+    and pymongo do by default (models expect them from mongo)
+    """
+    value = json_util.object_hook(dct)
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        value = value.astimezone(utc).replace(tzinfo=None)
+    return value
+
+
+def decode_record(record, fmt):
+    if fmt == 'ndjson':
+        return json.loads(record, object_hook=_object_hook)
+    return BSON(record).decode()
+
+
+def encode_document(doc, fmt):
+    if fmt == 'ndjson':
+        return json.dumps(doc, default=json_util.default) + '\n'
+    return BSON.encode(doc)
+
+
+def convert_records(cls, records, fmt, validate=True):
+    """
+    Raw documents for database from encoded records, passed through
+    the model. Returns (documents, error messages).
+    """
+    docs, errors = [], []
+    for record in records:
+        try:
+            instance = cls(decode_record(record, fmt), from_mongo=True)
+            if validate:
+                instance.validate()
+            docs.append(instance.to_mongo())
+        except (ValueError, BaseError) as e:
+            errors.append(u"{0}: {1}".format(e.__class__.__name__, e))
+    return docs, errors
+
+
+def encode_documents(cls, raw_docs, fmt, primitive=False):
+    """File content for raw documents of `cls` collection"""
+    chunks = []
+    for raw in raw_docs:
+        instance = cls(raw, from_mongo=True)
+        doc = instance.to_primitive() if primitive else instance.to_mongo()
+        chunks.append(encode_document(doc, fmt))
+    return ''.join(chunks)
+
+
+def read_checkpoint(path):
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f, object_hook=json_util.object_hook)
+
+
+def write_checkpoint(path, state):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, default=json_util.default)
+    os.rename(tmp_path, path)
+
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def ordered_results(pool, func, tasks, window):
+    """
+    Results of `func` for every task, computed by `pool`, in order of
+    tasks. At most `window` tasks are submitted at once, so the source is
+    read not faster than it is processed.
+    """
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(func, (task,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+# state of worker process
+_worker = {}
+
+
+def _init_worker(path, uri, db_name, fmt, options):
+    cls = load_model(path)
+    _worker.update(cls=cls, fmt=fmt, options=options)
+    if db_name:
+        _worker['collection'] = \
+            MongoClient(uri)[db_name][cls._options.namespace]
+
+
+def _import_batch(records):
+    docs, errors = convert_records(_worker['cls'], records, _worker['fmt'],
+        validate=_worker['options'].get('validate', True))
+    if docs:
+        try:
+            _worker['collection'].insert(docs, continue_on_error=True)
+        except DuplicateKeyError:
+            pass  # inserted before interruption, the rest is inserted
+    return len(records), len(docs), errors
+
+
+def _export_batch(raw_docs):
+    data = encode_documents(_worker['cls'], raw_docs, _worker['fmt'],
+        primitive=_worker['options'].get('primitive', False))
+    return data, len(raw_docs), raw_docs[-1]['_id']
+
+
+def _run_pool(cls, uri, db_name, fmt, options, processes):
+    processes = processes or cpu_count()
+    return Pool(processes, _init_worker,
+        (model_path(cls), uri, db_name, fmt, options)), processes
+
+
+def import_collection(cls, path, db_name, uri=None, fmt=None, processes=None,
+        batch_size=1000, checkpoint=None, validate=True, progress=None):
+    """
+    Insert documents from file into collection of `cls`. Documents are
+    converted and validated by the model, invalid ones are skipped and
+    reported in 'errors'. Signals, caches and counters are not involved.
+    After interruption documents without `_id` of the last batches can be
+    inserted twice.
+
+    `progress(done, total)` is called after every batch.
+    """
+    fmt = fmt or guess_format(path)
+    state = read_checkpoint(checkpoint)
+    result = {'records': state.get('records', 0),
+        'inserted': state.get('inserted', 0), 'errors': []}
+    error_count = state.get('error_count', 0)
+    started_at = time.time()
+    pool, processes = _run_pool(cls, uri, db_name, fmt,
+        {'validate': validate}, processes)
+    try:
+        with open(path, 'rb') as f:
+            records = islice(read_records(f, fmt), result['records'], None)
+            for count, inserted, errors in ordered_results(pool,
+                    _import_batch, batches(records, batch_size),
+                    processes * 2):
+                result['records'] += count
+                result['inserted'] += inserted
+                error_count += len(errors)
+                result['errors'].extend(
+                    errors[:MAX_ERRORS - len(result['errors'])])
+                if checkpoint:
+                    write_checkpoint(checkpoint, {'records': result['records'],
+                        'inserted': result['inserted'],
+                        'error_count': error_count})
+                if progress:
+                    progress(result['records'], None)
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    result['error_count'] = error_count
+    result['seconds'] = time.time() - started_at
+    return result
+
+
+def export_collection(cls, path, db_name, uri=None, fmt=None, query=None,
+        processes=None, batch_size=1000, checkpoint=None, primitive=False,
+        progress=None):
+    """
+    Write documents of `cls` collection, matching `query`, into file in
+    order of `_id`. With `primitive=True` documents are exported by
+    `to_primitive` (can't be imported back). Resumed export truncates file
+    to the size, saved in checkpoint, and continues after the saved `_id`.
+    """
+    fmt = fmt or guess_format(path)
+    state = read_checkpoint(checkpoint)
+    spec = dict(query or {})
+    if state:
+        spec = {'$and': [spec, {'_id': {'$gt': state['last_id']}}]}
+    collection = MongoClient(uri)[db_name][cls._options.namespace]
+    done = state.get('records', 0)
+    total = done + collection.find(spec).count()
+    started_at = time.time()
+    pool, processes = _run_pool(cls, None, None, fmt,
+        {'primitive': primitive}, processes)
+    try:
+        with open(path, 'r+b' if state else 'wb') as f:
+            if state:
+                f.truncate(state['size'])
+                f.seek(state['size'])
+            cursor = collection.find(spec).sort('_id', 1) \
+                .batch_size(batch_size)
+            for data, count, last_id in ordered_results(pool, _export_batch,
+                    batches(cursor, batch_size), processes * 2):
+                f.write(data)
+                f.flush()
+                done += count
+                if checkpoint:
+                    write_checkpoint(checkpoint, {'records': done,
+                        'last_id': last_id, 'size': f.tell()})
+                if progress:
+                    progress(done, total)
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return {'records': done, 'seconds': time.time() - started_at}
+
+
+def print_progress(done, total):
+    if total:
+        sys.stderr.write('\r{0}/{1} documents'.format(done, total))
+    else:
+        sys.stderr.write('\r{0} documents'.format(done))
+    sys.stderr.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Import or export collection of TurboKit model')
+    parser.add_argument('command', choices=('import', 'export'))
+    parser.add_argument('model', help='dotted path, e.g. myapp.models.Event')
+    parser.add_argument('path', help='NDJSON or BSON (*.bson) file')
+    parser.add_argument('--db', required=True, help='database name')
+    parser.add_argument('--uri', default='mongodb://localhost:27017')
+    parser.add_argument('--format', choices=FORMATS)
+    parser.add_argument('--processes', type=int)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--checkpoint', help='file to save progress into')
+    parser.add_argument('--query', type=lambda s: json.loads(s,
+        object_hook=json_util.object_hook), help='export: JSON query')
+    parser.add_argument('--primitive', action='store_true',
+        help='export: use to_primitive instead of to_mongo')
+    parser.add_argument('--no-validate', action='store_true',
+        help="import: don't validate documents")
+    args = parser.parse_args(argv)
+    sys.path.insert(0, os.getcwd())
+    cls = load_model(args.model)
+    common = dict(uri=args.uri, fmt=args.format, processes=args.processes,
+        batch_size=args.batch_size, checkpoint=args.checkpoint,
+        progress=print_progress)
+    if args.command == 'import':
+        result = import_collection(cls, args.path, args.db,
+            validate=not args.no_validate, **common)
+        sys.stderr.write('\n{0} of {1} documents inserted in {2:.1f}s\n'
+            .format(result['inserted'], result['records'], result['seconds']))
+        for error in result['errors']:
+            sys.stderr.write(error + '\n')
+        return 1 if result['error_count'] else 0
+    result = export_collection(cls, args.path, args.db, query=args.query,
+        primitive=args.primitive, **common)
+    sys.stderr.write('\n{0} documents exported in {1:.1f}s\n'.format(
+        result['records'], result['seconds']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
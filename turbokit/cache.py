@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+import time
+from copy import deepcopy
+from collections import OrderedDict, defaultdict
+from bson.objectid import ObjectId
+from .utils import _document_registry
+
+
+class CacheStorage(object):
+    """
+    Interface of storage, used by document and query caches. Storages
+    are created by cache backend (see `set_cache_backend`).
+    """
+
+    def get(self, key, default=None):
+        raise NotImplementedError
+
+    def set(self, key, value):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    @property
+    def stats(self):
+        raise NotImplementedError
+
+
+class LRUCache(CacheStorage):
+    """
+    Dict-like storage with bounded size and time to live. The least
+    recently used entry is evicted, when size is exceeded.
+    """
+
+    def __init__(self, max_size=1000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        try:
+            expires_at, value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        if self.ttl and expires_at < time.time():
+            self.expirations += 1
+            self.misses += 1
+            return default
+        self._data[key] = (expires_at, value)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = (time.time() + (self.ttl or 0), value)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    @property
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / total if total else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+
+class DocumentCache(object):
+    """
+    Raw documents of one collection by their _id. Raw documents are
+    stored and copied on every read, so every reader gets its own fresh
+    model instance and can't change cached data.
+
+    `version` changes on every invalidation: reader takes it before the
+    query and passes to `set`, so document, that was read before
+    concurrent write, isn't cached.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.version = 0
+
+    @staticmethod
+    def make_key(db, _id):
+        return (db.name, _id)
+
+    def get(self, db, _id):
+        doc = self.storage.get(self.make_key(db, _id))
+        return deepcopy(doc) if doc is not None else None
+
+    def set(self, db, doc, version=None):
+        if version is not None and version != self.version:
+            return  # invalidated while document was read
+        self.storage.set(self.make_key(db, doc['_id']), deepcopy(doc))
+
+    def invalidate(self, db, _id):
+        self.version += 1
+        self.storage.delete(self.make_key(db, _id))
+
+    def clear(self):
+        self.version += 1
+        self.storage.clear()
+
+    @property
+    def stats(self):
+        return self.storage.stats
+
+
+_document_caches = {}
+
+
+def get_document_cache(cls):
+    """
+    Cache of `cls` collection, if model enables it in Options:
+
+        class Options:
+            document_cache = {'max_size': 1000, 'ttl': 60}
+    """
+    settings = getattr(cls._options, 'document_cache', None)
+    if not settings:
+        return None
+    collection = cls._options.namespace
+    cache = _document_caches.get(collection)
+    if cache is None:
+        storage = _backend.create_storage('document:' + collection, **settings)
+        cache = _document_caches.setdefault(collection, DocumentCache(storage))
+    return cache
+
+
+def id_from_query(query):
+    """ObjectId, if query is a lookup by _id only, None otherwise"""
+    if len(query) == 1 and isinstance(query.get('_id'), ObjectId):
+        return query['_id']
+    return None
+
+
+class QueryCache(object):
+    """
+    Raw results of cursor queries. Key includes generation of the
+    collection, so any write through TurboKit makes previous results
+    unreachable (they are evicted later as least recently used).
+    Results longer than `max_documents` are not cached to bound memory.
+    """
+
+    def __init__(self, storage, max_documents=1000):
+        self.storage = storage
+        self.max_documents = max_documents
+
+    def get(self, key):
+        result = self.storage.get(key)
+        return deepcopy(result) if result is not None else None
+
+    def set(self, key, result):
+        if isinstance(result, list) and len(result) > self.max_documents:
+            return
+        self.storage.set(key, deepcopy(result))
+
+    def clear(self):
+        self.storage.clear()
+
+    @property
+    def stats(self):
+        return self.storage.stats
+
+
+_query_caches = {}
+
+
+def get_query_cache(cls):
+    """
+    Cache of cursor results for `cls` collection, if model enables it:
+
+        class Options:
+            query_cache = {'max_size': 500, 'ttl': 60, 'max_documents': 1000}
+    """
+    settings = getattr(cls._options, 'query_cache', None)
+    if not settings:
+        return None
+    collection = cls._options.namespace
+    cache = _query_caches.get(collection)
+    if cache is None:
+        settings = dict(settings)
+        max_documents = settings.pop('max_documents', 1000)
+        storage = _backend.create_storage('query:' + collection, **settings)
+        cache = _query_caches.setdefault(collection,
+            QueryCache(storage, max_documents=max_documents))
+    return cache
+
+
+class LocalCacheBackend(object):
+    """
+    Caches and generations live in memory of the process. With several
+    worker processes each one has its own copy and doesn't see
+    invalidations made by others (until `ttl`), use SharedCacheBackend
+    from turbokit.shared_cache there.
+    """
+
+    def __init__(self):
+        self.generations = defaultdict(int)
+
+    def create_storage(self, name, max_size=1000, ttl=60):
+        return LRUCache(max_size=max_size, ttl=ttl)
+
+    def get_generation(self, collection):
+        return self.generations[collection]
+
+    def bump_generation(self, collection):
+        self.generations[collection] += 1
+
+
+_backend = LocalCacheBackend()
+
+
+def set_cache_backend(backend):
+    """
+    Replace backend of all document and query caches. Caches, created by
+    previous backend, are dropped.
+    """
+    global _backend
+    _backend = backend
+    _document_caches.clear()
+    _query_caches.clear()
+
+
+def get_cache_backend():
+    return _backend
+
+
+def get_generation(collection):
+    return _backend.get_generation(collection)
+
+
+def bump_generation(collection):
+    _backend.bump_generation(collection)
+
+
+# (size of document registry, collections, whose read keys use generation)
+_generation_collections = (None, frozenset())
+
+
+def uses_generation(collection):
+    """
+    True, if some model of `collection` has query cache or coalesced
+    reads: only their keys include generation, so writes to other
+    collections don't need to bump it
+    """
+    global _generation_collections
+    size, collections = _generation_collections
+    if size != len(_document_registry):
+        collections = frozenset(getattr(cls._options, 'namespace', None)
+            for cls in _document_registry.values()
+            if getattr(cls._options, 'query_cache', None)
+            or getattr(cls._options, 'coalesce_reads', False))
+        _generation_collections = (len(_document_registry), collections)
+    return collection in collections
+
+
+def make_query_key(db, collection, *spec):
+    """
+    Key of read operation: includes generation of the collection, so it
+    changes after every write through TurboKit.
+    """
+    return (db.name, collection, get_generation(collection), normalize(spec))
+
+
+def normalize(value):
+    """
+    Hashable representation of query, that doesn't depend on order of
+    keys in dicts.
+    """
+    if isinstance(value, dict):
+        return ('{}', tuple(sorted((k, normalize(v)) for k, v in value.iteritems())))
+    if isinstance(value, (list, tuple)):
+        return ('[]', tuple(normalize(v) for v in value))
+    return value
@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+import time
+import logging
+from copy import deepcopy
+from collections import deque
+from datetime import timedelta
+from tornado import gen, ioloop
+from tornado.concurrent import Future
+from .errors import LimitExceeded
+
+l = logging.getLogger(__name__)
+
+
+class SingleFlight(object):
+    """
+    Identical operations, started while the first one is in flight,
+    share its future instead of starting their own.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key, func, *args, **kwargs):
+        future = self._calls.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return future
+        self.executed += 1
+        future = func(*args, **kwargs)
+        self._calls[key] = future
+        future.add_done_callback(lambda f: self._forget(key, f))
+        return future
+
+    def _forget(self, key, future):
+        if self._calls.get(key) is future:
+            del self._calls[key]
+
+    @property
+    def in_flight(self):
+        return len(self._calls)
+
+    @property
+    def stats(self):
+        return {
+            'in_flight': self.in_flight,
+            'executed': self.executed,
+            'coalesced': self.coalesced,
+        }
+
+
+_single_flights = {}
+
+
+def get_single_flight(cls):
+    """
+    Group of coalesced reads of `cls` collection, if model enables it:
+
+        class Options:
+            coalesce_reads = True
+    """
+    if not getattr(cls._options, 'coalesce_reads', False):
+        return None
+    collection = cls._options.namespace
+    flight = _single_flights.get(collection)
+    if flight is None:
+        flight = _single_flights.setdefault(collection, SingleFlight(collection))
+    return flight
+
+
+def coalesced(cls, key, func, *args, **kwargs):
+    """
+    Call `func` or join identical call in flight. Raw result is copied for
+    every caller, as hydration of model instances can modify it.
+    Without coalescing future of `func` is returned as is.
+    """
+    flight = get_single_flight(cls)
+    if flight is None or key is None:
+        return func(*args, **kwargs)
+    return _copy_result(flight.do(key, func, *args, **kwargs))
+
+
+@gen.coroutine
+def _copy_result(future):
+    result = yield future
+    raise gen.Return(deepcopy(result))
+
+
+class ConcurrencyLimiter(object):
+    """
+    Lets at most `max_concurrent` operations run at once. Others wait in
+    queue of at most `max_queue` operations, not longer than
+    `queue_timeout` seconds; when queue is full or timeout is over,
+    LimitExceeded is raised.
+    """
+
+    def __init__(self, name, max_concurrent=10, max_queue=100,
+            queue_timeout=1):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self._waiters = deque()
+        self.executed = 0
+        self.queued = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.max_in_flight = 0
+        self.max_queued = 0
+        self.total_wait = 0.0
+
+    def acquire(self):
+        """Future, resolved when operation can start"""
+        future = Future()
+        if self.in_flight < self.max_concurrent and not self._waiters:
+            self._start()
+            future.set_result(None)
+            return future
+        if len(self._waiters) >= self.max_queue:
+            self.rejected += 1
+            raise LimitExceeded(u"{0}: {1} operations are running, {2} are "
+                u"waiting".format(self.name, self.in_flight, len(self._waiters)))
+        io_loop = ioloop.IOLoop.current()
+        timeout = io_loop.add_timeout(timedelta(seconds=self.queue_timeout),
+            lambda: self._expire(future))
+        self._waiters.append((future, time.time(), timeout))
+        self.queued += 1
+        self.max_queued = max(self.max_queued, len(self._waiters))
+        return future
+
+    def release(self):
+        self.in_flight -= 1
+        while self._waiters:
+            future, queued_at, timeout = self._waiters.popleft()
+            if future.done():
+                continue
+            ioloop.IOLoop.current().remove_timeout(timeout)
+            self.total_wait += time.time() - queued_at
+            self._start()
+            future.set_result(None)
+            break
+
+    def _start(self):
+        self.in_flight += 1
+        self.executed += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def _expire(self, future):
+        if future.done():
+            return
+        self._waiters = deque(w for w in self._waiters if w[0] is not future)
+        self.timed_out += 1
+        future.set_exception(LimitExceeded(u"{0}: operation waited longer than "
+            u"{1} seconds".format(self.name, self.queue_timeout)))
+
+    @gen.coroutine
+    def run(self, func, *args, **kwargs):
+        """Call `func` (returning future), when limit allows"""
+        yield self.acquire()
+        try:
+            result = yield func(*args, **kwargs)
+        finally:
+            self.release()
+        raise gen.Return(result)
+
+    @property
+    def stats(self):
+        return {
+            'in_flight': self.in_flight,
+            'waiting': len(self._waiters),
+            'executed': self.executed,
+            'queued': self.queued,
+            'rejected': self.rejected,
+            'timed_out': self.timed_out,
+            'max_in_flight': self.max_in_flight,
+            'max_queued': self.max_queued,
+            'avg_wait': self.total_wait / self.executed if self.executed
+                else None,
+        }
+
+
+_limiters = {}
+
+
+def get_concurrency_limiter(cls, collection):
+    """
+    Limiter of operations with collection, if model enables it (shared by
+    all models, that use the collection):
+
+        class Options:
+            concurrency_limit = {'max_concurrent': 20, 'max_queue': 200,
+                'queue_timeout': 0.5}
+    """
+    settings = getattr(cls._options, 'concurrency_limit', None)
+    if not settings:
+        return None
+    limiter = _limiters.get(collection)
+    if limiter is None:
+        limiter = _limiters.setdefault(collection,
+            ConcurrencyLimiter(collection, **settings))
+    return limiter
+
+
+class DeferredQueue(object):
+    """
+    Bounded in-process queue of calls, executed in background by
+    `workers` coroutines on IOLoop. `put` waits while `maxsize` calls
+    are queued (backpressure), but not longer than `put_timeout` seconds:
+    then the call is executed inline. So deferred calls, that put other
+    calls into the same queue, can't wait forever for workers, which wait
+    for them. Failed calls are retried `retries` times after
+    `retry_delay` seconds, then logged and dropped.
+    """
+
+    def __init__(self, maxsize=1000, workers=4, retries=3, retry_delay=0.5,
+            put_timeout=1):
+        self.maxsize = maxsize
+        self.workers = workers
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.put_timeout = put_timeout
+        self._queue = deque()
+        self._getters = deque()
+        self._putters = deque()
+        self._drain_waiters = []
+        self._workers = []
+        self._active = 0
+        self._unfinished = 0
+        self._stopping = False
+        self.max_depth = 0
+        self.processed = 0
+        self.failed = 0
+        self.retried = 0
+        self.inline = 0
+        self.total_wait = 0.0
+        self.total_latency = 0.0
+
+    @property
+    def depth(self):
+        return len(self._queue)
+
+    def full(self):
+        return bool(self.maxsize) and len(self._queue) >= self.maxsize
+
+    def idle(self):
+        return not self._unfinished
+
+    def start(self):
+        self._stopping = False
+        while len(self._workers) < self.workers:
+            future = self._work()
+            self._workers.append(future)
+            future.add_done_callback(self._workers.remove)
+
+    def stop(self):
+        """
+        Stop workers, after they finish calls in progress. Queued calls
+        are kept, workers are started again by `put` or `drain`.
+        """
+        self._stopping = True
+        while self._getters:
+            self._getters.popleft().set_result(None)
+
+    @gen.coroutine
+    def put(self, func, *args, **kwargs):
+        """
+        Enqueue call of coroutine `func`, wait if queue is full. If it is
+        still full after `put_timeout`, execute the call inline.
+        """
+        started_at = time.time()
+        while self.full():
+            future = Future()
+            self._putters.append(future)
+            if self.put_timeout is None:
+                yield future
+                continue
+            timeout = max(0, started_at + self.put_timeout - time.time())
+            try:
+                yield gen.with_timeout(timedelta(seconds=timeout), future)
+            except gen.TimeoutError:
+                if future.done():
+                    continue  # woken up together with timeout
+                self._putters.remove(future)
+                yield self._run_inline(func, args, kwargs)
+                return
+        self.start()
+        item = (func, args, kwargs, time.time())
+        self._unfinished += 1
+        if self._getters:
+            self._getters.popleft().set_result(item)
+        else:
+            self._queue.append(item)
+            self.max_depth = max(self.max_depth, len(self._queue))
+
+    def _get(self):
+        future = Future()
+        if self._queue:
+            future.set_result(self._queue.popleft())
+            if self._putters:
+                self._putters.popleft().set_result(None)
+        else:
+            self._getters.append(future)
+        return future
+
+    @gen.coroutine
+    def _work(self):
+        while not self._stopping:
+            item = yield self._get()
+            if item is None:
+                break
+            self._active += 1
+            try:
+                yield self._run(*item)
+            finally:
+                self._active -= 1
+                self._unfinished -= 1
+                self._wake_drain_waiters()
+
+    @gen.coroutine
+    def _run(self, func, args, kwargs, enqueued_at):
+        self.total_wait += time.time() - enqueued_at
+        for attempt in range(self.retries + 1):
+            try:
+                yield func(*args, **kwargs)
+            except Exception:
+                if attempt == self.retries:
+                    self.failed += 1
+                    l.exception("Deferred call of {0} failed".format(
+                        getattr(func, '__name__', func)))
+                    break
+                self.retried += 1
+                yield gen.Task(ioloop.IOLoop.current().add_timeout,
+                    timedelta(seconds=self.retry_delay))
+            else:
+                self.processed += 1
+                break
+        self.total_latency += time.time() - enqueued_at
+
+    @gen.coroutine
+    def _run_inline(self, func, args, kwargs):
+        l.warning("Deferred queue is full for {0}s, {1} is called inline"
+            .format(self.put_timeout, getattr(func, '__name__', func)))
+        self.inline += 1
+        self._unfinished += 1
+        try:
+            yield self._run(func, args, kwargs, time.time())
+        finally:
+            self._unfinished -= 1
+            self._wake_drain_waiters()
+
+    def _wake_drain_waiters(self):
+        if self.idle():
+            waiters, self._drain_waiters = self._drain_waiters, []
+            for future in waiters:
+                future.set_result(None)
+
+    @gen.coroutine
+    def drain(self, timeout=None):
+        """
+        Wait until all queued calls are executed, e.g. on shutdown.
+        Returns False, if `timeout` seconds passed before that.
+        """
+        if self.idle():
+            raise gen.Return(True)
+        self.start()
+        future = Future()
+        self._drain_waiters.append(future)
+        if timeout is None:
+            yield future
+            raise gen.Return(True)
+        try:
+            yield gen.with_timeout(timedelta(seconds=timeout), future)
+        except gen.TimeoutError:
+            raise gen.Return(False)
+        raise gen.Return(True)
+
+    @property
+    def stats(self):
+        done = self.processed + self.failed
+        return {
+            'depth': self.depth,
+            'max_depth': self.max_depth,
+            'active': self._active,
+            'workers': len(self._workers),
+            'blocked_producers': len(self._putters),
+            'processed': self.processed,
+            'failed': self.failed,
+            'retried': self.retried,
+            'inline': self.inline,
+            'avg_wait': self.total_wait / done if done else None,
+            'avg_latency': self.total_latency / done if done else None,
+        }
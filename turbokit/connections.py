@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+import motor
+from .errors import NotRegistered
+
+DEFAULT_CONNECTION = 'default'
+
+# alias: settings of client
+_connections = {}
+# alias: MotorClient, created on first use and shared by all models
+_clients = {}
+# (alias, name, read preference, write concern): MotorDatabase
+_databases = {}
+# model class: its database
+_model_databases = {}
+
+
+def register_connection(alias=DEFAULT_CONNECTION, uri='mongodb://localhost:27017',
+        database=None, **kwargs):
+    """
+    Register MongoDB connection under `alias`. `database` is the default
+    database name of the alias, `kwargs` are passed to MotorClient.
+    """
+    disconnect(alias)
+    _connections[alias] = {'uri': uri, 'database': database, 'kwargs': kwargs}
+
+
+def disconnect(alias=None):
+    """Close client of `alias` (all clients, if alias is None)"""
+    aliases = [alias] if alias is not None else list(_connections)
+    for a in aliases:
+        client = _clients.pop(a, None)
+        if client is not None:
+            client.disconnect()
+        _connections.pop(a, None)
+    for key in list(_databases):
+        if key[0] in aliases:
+            del _databases[key]
+    _model_databases.clear()
+
+
+def get_client(alias=DEFAULT_CONNECTION):
+    client = _clients.get(alias)
+    if client is None:
+        settings = _get_settings(alias)
+        client = _clients.setdefault(alias,
+            motor.MotorClient(settings['uri'], **settings['kwargs']))
+    return client
+
+
+def _get_settings(alias):
+    try:
+        return _connections[alias]
+    except KeyError:
+        raise NotRegistered(u"Connection '{0}' is not registered, use "
+            u"turbokit.connections.register_connection".format(alias))
+
+
+def get_database(alias=DEFAULT_CONNECTION, name=None, read_preference=None,
+        write_concern=None):
+    """Database of registered connection, configured objects are reused"""
+    name = name or _get_settings(alias)['database']
+    key = (alias, name, read_preference,
+        tuple(sorted((write_concern or {}).items())))
+    db = _databases.get(key)
+    if db is None:
+        db = _databases.setdefault(key, configure_database(
+            get_client(alias)[name], read_preference, write_concern))
+    return db
+
+
+def configure_database(db, read_preference=None, write_concern=None):
+    """
+    Database object with another read preference or write concern,
+    `db` itself is not changed
+    """
+    if read_preference is None and write_concern is None:
+        return db
+    configured = db.connection[db.name]
+    configured.read_preference = db.read_preference \
+        if read_preference is None else read_preference
+    configured.write_concern = db.write_concern \
+        if write_concern is None else write_concern
+    return configured
+
+
+def get_model_database(cls):
+    """
+    Database of the model from its Options, None if neither model
+    declares connection nor default connection is registered:
+
+        class Options:
+            database = 'logs'  # alias or (alias, database name)
+            read_preference = ReadPreference.SECONDARY_PREFERRED
+            write_concern = {'w': 'majority'}
+    """
+    try:
+        return _model_databases[cls]
+    except KeyError:
+        pass
+    database = getattr(cls._options, 'database', None)
+    if database is None and DEFAULT_CONNECTION not in _connections:
+        return None
+    alias, name = DEFAULT_CONNECTION, None
+    if isinstance(database, basestring):
+        alias = database
+    elif database is not None:
+        alias, name = database
+    db = get_database(alias, name,
+        getattr(cls._options, 'read_preference', None),
+        getattr(cls._options, 'write_concern', None))
+    return _model_databases.setdefault(cls, db)
+
+
+def get_related_database(cls, db):
+    """
+    Database of related model `cls` (prefetched, referenced by delete
+    rules, counter caches and snapshots) in operation, started on `db`.
+    Model, that declares `database` in Options, uses its own database,
+    others use `db`.
+    """
+    if getattr(cls._options, 'database', None) is not None:
+        return cls.objects.db
+    return db
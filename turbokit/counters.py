@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+import logging
+from collections import defaultdict, Counter
+from tornado import gen
+from .snapshots import reference_id, reference_key
+from .connections import get_related_database
+from .errors import OperationError
+
+l = logging.getLogger(__name__)
+
+
+class CounterCache(object):
+    """
+    Count of `model` documents, that refer to a document by field
+    `field_name`, kept in `counter` field of the referenced document.
+    Declared as ModelReferenceType(Target, counter_cache='counter').
+    """
+
+    def __init__(self, model, field_name, db_field, ref_field, is_list):
+        self.model = model
+        self.field_name = field_name
+        self.db_field = db_field
+        self.ref_field = ref_field
+        self.is_list = is_list
+
+    @property
+    def target(self):
+        return self.ref_field.model_class
+
+    @property
+    def counter_field(self):
+        field = self.target._fields[self.ref_field.counter_cache]
+        return field.serialized_name or self.ref_field.counter_cache
+
+    def referenced_ids(self, raw_doc):
+        """Ids, referenced by raw document (each one is counted once)"""
+        value = raw_doc.get(self.db_field)
+        if value is None:
+            return set()
+        if self.is_list:
+            return set(reference_id(v) for v in value if v is not None)
+        return set([reference_id(value)])
+
+
+def get_counter_caches(cls, field_name=None):
+    counter_caches = getattr(cls._options, 'counter_caches', [])
+    if field_name is not None:
+        counter_caches = [cc for cc in counter_caches
+            if cc.field_name == field_name]
+    return counter_caches
+
+
+def counter_fields(cls):
+    """Projection with referencing fields, that have counter cache"""
+    return dict((cc.db_field, True) for cc in get_counter_caches(cls))
+
+
+def counter_deltas(cls, old_docs=(), new_docs=()):
+    """
+    Changes of counters, when raw documents `old_docs` are replaced by
+    `new_docs`: {CounterCache: Counter({referenced id: delta})}
+    """
+    deltas = {}
+    for cc in get_counter_caches(cls):
+        delta = Counter()
+        for doc in old_docs:
+            for pk in cc.referenced_ids(doc):
+                delta[pk] -= 1
+        for doc in new_docs:
+            for pk in cc.referenced_ids(doc):
+                delta[pk] += 1
+        deltas[cc] = delta
+    return deltas
+
+
+def _changes_reference(db_field, key):
+    """Whether update of `key` can change id, referenced by `db_field`"""
+    if key == db_field:
+        return True
+    if not key.startswith(db_field + '.'):
+        return False
+    # positional and index parts select items of ListType references
+    rest = [part for part in key[len(db_field) + 1:].split('.')
+        if not (part.isdigit() or part.startswith('$'))]
+    return not rest or rest == ['_id']
+
+
+def check_counter_update(cls, raw_data):
+    """
+    Raise OperationError, if update document can re-point references with
+    counter cache: changed documents are unknown to multi update, so their
+    counters can't be maintained. Replacement of document (no operators)
+    is rejected for any model with counter caches.
+    """
+    counter_caches = get_counter_caches(cls)
+    if not counter_caches:
+        return
+    keys = []
+    for operator, fields in raw_data.iteritems():
+        if not operator.startswith('$'):
+            keys = [cc.db_field for cc in counter_caches]
+            break
+        keys.extend(fields)
+        if operator == '$rename':
+            keys.extend(fields.itervalues())
+    for cc in counter_caches:
+        for key in keys:
+            if _changes_reference(cc.db_field, key):
+                raise OperationError(u"Update of {0}.{1} would leave counter "
+                    u"{2}.{3} stale, use save() to change it".format(
+                        cls.__name__, cc.field_name, cc.target.__name__,
+                        cc.counter_field))
+
+
+@gen.coroutine
+def update_counters(db, cls, old_docs=(), new_docs=()):
+    """
+    Apply changes of counters with one `$inc` multi update per referenced
+    model and delta value.
+    """
+    for cc, delta in counter_deltas(cls, old_docs, new_docs).iteritems():
+        ids_by_delta = defaultdict(list)
+        for pk, value in delta.iteritems():
+            if value:
+                ids_by_delta[value].append(pk)
+        target_db = get_related_database(cc.target, db)
+        for value, ids in ids_by_delta.iteritems():
+            yield cc.target.objects.set_db(target_db).update({'_id': {'$in': ids}},
+                {'$inc': {cc.counter_field: value}}, multi=True)
+
+
+@gen.coroutine
+def rebuild_counter_cache(db, cls, field_name=None):
+    """
+    Recalculate counters, maintained for references of `cls` (only for
+    `field_name`, if it is given), from actual documents.
+    """
+    for cc in get_counter_caches(cls, field_name):
+        field = '$' + cc.db_field
+        ref_key = '$' + reference_key(cls, cc.db_field)
+        pipeline = [{'$match': {cc.db_field: {'$ne': None}}}]
+        if cc.is_list:
+            pipeline += [
+                {'$unwind': field},
+                {'$group': {'_id': {'doc': '$_id', 'ref': ref_key}}},
+                {'$group': {'_id': '$_id.ref', 'count': {'$sum': 1}}},
+            ]
+        else:
+            pipeline.append({'$group': {'_id': ref_key, 'count': {'$sum': 1}}})
+        result = yield cls.objects.set_db(db).aggregate(pipeline)
+        ids_by_count = defaultdict(list)
+        for row in result:
+            ids_by_count[row['count']].append(row['_id'])
+        target_objects = cc.target.objects.set_db(
+            get_related_database(cc.target, db))
+        yield target_objects.update({}, {'$set': {cc.counter_field: 0}},
+            multi=True)
+        for count, ids in ids_by_count.iteritems():
+            yield target_objects.update({'_id': {'$in': ids}},
+                {'$set': {cc.counter_field: count}}, multi=True)
+        l.info("Counter {0}.{1} is rebuilt for {2} documents".format(
+            cc.target.__name__, cc.counter_field,
+            sum(len(ids) for ids in ids_by_count.itervalues())))
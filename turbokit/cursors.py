@@ -3,6 +3,12 @@ import logging
 from tornado import gen
 from schematics.types import compound
 from .types import ModelReferenceType
+from .retry import with_retry
+from .cache import get_document_cache, get_query_cache, make_query_key
+from .concurrency import coalesced, get_single_flight
+from .memory import get_in_memory_collection
+from .hydration import should_offload, hydrate, hydrate_async
+from .connections import get_related_database
 
 l = logging.getLogger(__name__)
 
@@ -47,11 +53,13 @@ class PrefetchRelatedMixin(object):
                 ids_expanded = list(set([item for sublist in ids for item in sublist]))
             else:
                 ids_expanded = ids
-            cursor = self.db[pr_field.model_class._options.namespace]\
-                .find({"_id": {"$in": ids_expanded}})
-            pr_data_list = yield cursor.to_list(None)
-            pr_model_list = map(lambda d: pr_field.model_class(d, from_mongo=True),
-                                pr_data_list)
+            pr_data_list = yield self._fetch_related_data(pr_field.model_class,
+                ids_expanded)
+            if should_offload(pr_field.model_class, len(pr_data_list)):
+                pr_model_list = yield hydrate_async(pr_field.model_class,
+                    pr_data_list)
+            else:
+                pr_model_list = hydrate(pr_field.model_class, pr_data_list)
             if pr_child_field_names:
                 # fetch child related fields recursively
                 pr_model_list = yield self.fetch_related_objects(pr_model_list,
@@ -68,14 +76,68 @@ class PrefetchRelatedMixin(object):
                 setattr(m, pr_field_name, f_values_is)
         raise gen.Return(objects_list)
 
+    @gen.coroutine
+    def _fetch_related_data(self, model_class, ids):
+        """
+        Raw documents of `model_class` by ids. If the model has document
+        cache, only ids missing in cache are queried.
+        """
+        collection = model_class._options.namespace
+        db = get_related_database(model_class, self.db)
+        memory = get_in_memory_collection(model_class)
+        if memory is not None:
+            data_list = memory.find(db, {'_id': {'$in': list(ids)}})
+            if data_list is not None:
+                raise gen.Return(data_list)
+        cache = get_document_cache(model_class)
+        data_list = []
+        if cache is not None:
+            missing_ids = []
+            for pk in set(ids):
+                doc = cache.get(db, pk) if pk is not None else None
+                if doc is None:
+                    missing_ids.append(pk)
+                else:
+                    data_list.append(doc)
+            ids = missing_ids
+            if not ids:
+                raise gen.Return(data_list)
+        version = cache.version if cache is not None else None
+        cursor = db[collection].find({"_id": {"$in": ids}})
+        fetched = yield with_retry(model_class, collection, 'prefetch_related',
+            self._cursor_to_list(cursor))
+        if cache is not None:
+            for doc in fetched:
+                cache.set(db, doc, version)
+        raise gen.Return(data_list + fetched)
+
+    @staticmethod
+    def _cursor_to_list(cursor):
+        """
+        Function for `with_retry`: first call uses given cursor, retries
+        use its clones, as failed cursor can't be iterated again.
+        """
+        cursors = [cursor]
+
+        def to_list():
+            c = cursors.pop() if cursors else cursor.clone()
+            return c.to_list(None)
+        return to_list
+
 
 class AsyncManagerCursor(PrefetchRelatedMixin):
 
-    def __init__(self, cls, cursor, db=None, **kwargs):
+    def __init__(self, cls, cursor, db=None, query=None, fields=None, **kwargs):
         super(AsyncManagerCursor, self).__init__(cls, cursor, db=None, **kwargs)
         self.cursor = cursor
         self.cls = cls
         self.db = db
+        # cursor spec, used as a key of query cache
+        self.query = query
+        self.fields = fields
+        self._sort = None
+        self._skip = 0
+        self._limit = 0
 
     @property
     def fetch_next(self):
@@ -87,19 +149,66 @@ class AsyncManagerCursor(PrefetchRelatedMixin):
 
     def sort(self, *args, **kwargs):
         self.cursor = self.cursor.sort(*args, **kwargs)
+        self._sort = (self._sort or ()) + (args, kwargs)
         return self
 
-    def skip(self, *args, **kwargs):
-        self.cursor = self.cursor.skip(*args, **kwargs)
+    def skip(self, skip):
+        self.cursor = self.cursor.skip(skip)
+        self._skip = skip
         return self
 
-    def limit(self, *args, **kwargs):
-        self.cursor = self.cursor.limit(*args, **kwargs)
+    def limit(self, limit):
+        self.cursor = self.cursor.limit(limit)
+        self._limit = limit
         return self
 
+    def get_read_key(self, *extra):
+        """
+        Key of cursor spec, None if cursor was not created by
+        AsyncManager.filter or the model neither coalesces reads nor
+        caches queries (so the key is not built for nothing)
+        """
+        if self.query is None or (get_single_flight(self.cls) is None
+                and get_query_cache(self.cls) is None):
+            return None
+        return make_query_key(self.db, self.cursor.collection.name, self.query,
+            self.fields, self._sort, self._skip, self._limit, *extra)
+
+    def get_cache_key(self, *extra):
+        """Key of query cache, None if cursor can't be cached"""
+        if get_query_cache(self.cls) is None:
+            return None
+        return self.get_read_key(*extra)
+
+    def find_in_memory(self):
+        """
+        Raw documents from in memory copy of collection, None if it can't
+        answer the query
+        """
+        memory = get_in_memory_collection(self.cls)
+        if memory is None or self.query is None:
+            return None
+        return memory.find(self.db, self.query, self.fields, self._sort,
+            self._skip, self._limit)
+
     @gen.coroutine
     def count(self, with_limit_and_skip=True):
-        response = yield self.cursor.count(with_limit_and_skip=with_limit_and_skip)
+        memory = get_in_memory_collection(self.cls)
+        if memory is not None and self.query is not None:
+            docs = memory.find(self.db, self.query, self.fields,
+                skip=self._skip if with_limit_and_skip else 0,
+                limit=self._limit if with_limit_and_skip else 0)
+            if docs is not None:
+                raise gen.Return(len(docs))
+        read_key = self.get_read_key('count', with_limit_and_skip)
+        cache_key = read_key if get_query_cache(self.cls) else None
+        response = get_query_cache(self.cls).get(cache_key) if cache_key else None
+        if response is None:
+            response = yield coalesced(self.cls, read_key, with_retry,
+                self.cls, self.cursor.collection.name, 'count',
+                self.cursor.count, with_limit_and_skip=with_limit_and_skip)
+            if cache_key:
+                get_query_cache(self.cls).set(cache_key, response)
         raise gen.Return(response)
 
     @gen.coroutine
@@ -107,9 +216,12 @@ class AsyncManagerCursor(PrefetchRelatedMixin):
         result = None
         if isinstance(index, slice):
             self.cursor = self.cursor[index]
+            self._skip = index.start or 0
+            self._limit = index.stop - self._skip if index.stop is not None else 0
             result = yield self.all()
         elif isinstance(index, (int, long)):
             self.cursor = self.cursor[index:index+1]
+            self._skip, self._limit = index, 1
             result = yield self.all()
             result = result[0]
         else:
@@ -119,7 +231,21 @@ class AsyncManagerCursor(PrefetchRelatedMixin):
 
     @gen.coroutine
     def all(self):
-        response = yield self.cursor.to_list(None)
-        results = [self.cls(d, from_mongo=True) for d in response]
-        results_with_related = yield self.fetch_related_objects(results)
-        raise gen.Return(results_with_related)
+        response = self.find_in_memory()
+        read_key = self.get_read_key('all') if response is None else None
+        cache_key = read_key if get_query_cache(self.cls) else None
+        if cache_key:
+            response = get_query_cache(self.cls).get(cache_key)
+        if response is None:
+            response = yield coalesced(self.cls, read_key, with_retry,
+                self.cls, self.cursor.collection.name, 'all',
+                self._cursor_to_list(self.cursor))
+            if cache_key:
+                get_query_cache(self.cls).set(cache_key, response)
+        if should_offload(self.cls, len(response)):
+            results = yield hydrate_async(self.cls, response)
+        else:
+            results = hydrate(self.cls, response)
+        if self._prefetch_related:
+            results = yield self.fetch_related_objects(results)
+        raise gen.Return(results)
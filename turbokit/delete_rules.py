@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+import logging
+from collections import namedtuple
+from tornado import gen
+from .types import DO_NOTHING, NULLIFY, CASCADE, DENY, PULL
+from .utils import _document_registry
+from .snapshots import reference_key
+from .connections import get_related_database
+
+l = logging.getLogger(__name__)
+
+RULE_NAMES = {
+    DO_NOTHING: 'DO_NOTHING',
+    NULLIFY: 'NULLIFY',
+    CASCADE: 'CASCADE',
+    DENY: 'DENY',
+    PULL: 'PULL',
+}
+# DENY must be checked before anything is modified, CASCADE goes last,
+# so referencing documents are already nullified/pulled when it recurses
+RULE_ORDER = (DENY, NULLIFY, PULL, CASCADE)
+
+_graph = None
+
+
+def ordered_delete_rules(model):
+    """
+    List of (referencing model, field name, rule) registered for `model`,
+    sorted in execution order.
+    """
+    delete_rules = getattr(model._options, 'delete_rules', {})
+    rules = [(parent_cls, field_name, rule)
+        for (parent_cls, field_name), rule in delete_rules.iteritems()]
+    rules.sort(key=lambda r: (RULE_ORDER.index(r[2]), r[0].__name__, r[1]))
+    return rules
+
+
+def get_delete_rules_graph():
+    """
+    Graph is built once and then reused, until new delete rule is registered.
+    Call it at application startup to get cycles reported early.
+    """
+    global _graph
+    if _graph is None:
+        _graph = DeleteRulesGraph(_document_registry)
+    return _graph
+
+
+def reset_delete_rules_graph():
+    global _graph
+    _graph = None
+
+
+PlanStep = namedtuple('PlanStep', 'model field_name rule count depth')
+
+
+class RemovePlan(object):
+    """
+    Result of dry-run removal. Each step tells, how many documents of
+    `model` would be touched by `rule`, declared on `field_name`.
+    The first step is the removal itself (field_name and rule are None).
+    """
+
+    def __init__(self, steps=None):
+        self.steps = steps or []
+
+    @property
+    def denied(self):
+        return any(s.rule == DENY and s.count > 0 for s in self.steps)
+
+    @property
+    def total(self):
+        return sum(s.count for s in self.steps if s.rule != DENY)
+
+    def __iter__(self):
+        return iter(self.steps)
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __repr__(self):
+        return "<RemovePlan: {0}>".format(", ".join(
+            "{0}.{1} {2}: {3}".format(s.model.__name__, s.field_name,
+                RULE_NAMES.get(s.rule), s.count) for s in self.steps))
+
+
+class DeleteRulesGraph(object):
+    """
+    Reverse reference graph over all registered models: edge goes from
+    referenced model to the model, that refers to it, and holds the
+    delete rule of that reference.
+    """
+    # ids in one `$in` of remove plan, keeps queries below BSON size limit
+    batch_size = 10000
+
+    def __init__(self, registry):
+        self.edges = {}
+        for model in set(registry.values()):
+            rules = ordered_delete_rules(model)
+            if rules:
+                self.edges[model] = rules
+        self.cycles = self.find_cascade_cycles()
+        for cycle in self.cycles:
+            l.warning("CASCADE delete rules make a cycle: {0}".format(
+                " -> ".join(m.__name__ for m in cycle)))
+
+    def rules_for(self, model):
+        return self.edges.get(model, [])
+
+    def cascade_children(self, model):
+        return [parent_cls for parent_cls, _, rule in self.rules_for(model)
+            if rule == CASCADE]
+
+    def find_cascade_cycles(self):
+        cycles = []
+        visited = set()
+        for start in sorted(self.edges, key=lambda m: m.__name__):
+            if start in visited:
+                continue
+            stack = [(start, iter(self.cascade_children(start)))]
+            path = [start]
+            while stack:
+                model, children = stack[-1]
+                visited.add(model)
+                for child in children:
+                    if child in path:
+                        cycles.append(path[path.index(child):] + [child])
+                    elif child not in visited:
+                        stack.append((child, iter(self.cascade_children(child))))
+                        path.append(child)
+                        break
+                else:
+                    stack.pop()
+                    path.pop()
+        return cycles
+
+    def cascade_order(self, model):
+        """
+        Models, that can be affected by removal of `model` documents,
+        in order they are reached by the delete rules.
+        """
+        order = [model]
+        i = 0
+        while i < len(order):
+            for parent_cls, _, _ in self.rules_for(order[i]):
+                if parent_cls not in order:
+                    order.append(parent_cls)
+            i += 1
+        return order
+
+    @gen.coroutine
+    def plan(self, db, model, query):
+        """
+        Walk delete rules the same way `AsyncManager.remove` does, but only
+        count documents. Only ids are loaded for CASCADE levels, as they
+        are needed for the next level; cycles are stopped by already
+        visited ids. Ids are sent by batches of `batch_size`.
+        """
+        ids = yield self._find_ids(db, model, query)
+        steps = [PlanStep(model, None, None, len(ids), 0)]
+        visited = dict((m, set()) for m in self.cascade_order(model))
+        visited[model].update(ids)
+        queue = [(model, ids, 1)]
+        while queue:
+            referenced, ref_ids, depth = queue.pop(0)
+            if not ref_ids:
+                continue
+            for parent_cls, field_name, rule in self.rules_for(referenced):
+                key = reference_key(parent_cls, field_name)
+                parent_db = get_related_database(parent_cls, db)
+                if rule == CASCADE or len(ref_ids) > self.batch_size:
+                    # distinct ids: document can refer to several batches
+                    parent_ids = yield self._find_referencing_ids(parent_db,
+                        parent_cls, key, ref_ids)
+                    if rule == CASCADE:
+                        parent_ids = [pk for pk in parent_ids
+                            if pk not in visited[parent_cls]]
+                        visited[parent_cls].update(parent_ids)
+                        queue.append((parent_cls, parent_ids, depth + 1))
+                    count = len(parent_ids)
+                else:
+                    count = yield parent_db[parent_cls._options.namespace]\
+                        .find({key: {"$in": ref_ids}}).count()
+                steps.append(PlanStep(parent_cls, field_name, rule, count, depth))
+        raise gen.Return(RemovePlan(steps))
+
+    @gen.coroutine
+    def _find_referencing_ids(self, db, model, key, ids):
+        """Distinct ids of `model` documents, that refer to any of `ids`"""
+        found, seen = [], set()
+        for start in range(0, len(ids), self.batch_size):
+            batch = ids[start:start + self.batch_size]
+            batch_ids = yield self._find_ids(db, model, {key: {"$in": batch}})
+            for pk in batch_ids:
+                if pk not in seen:
+                    seen.add(pk)
+                    found.append(pk)
+        raise gen.Return(found)
+
+    @gen.coroutine
+    def _find_ids(self, db, model, query):
+        cursor = db[model._options.namespace].find(query, fields={"_id": True})
+        docs = yield cursor.to_list(None)
+        raise gen.Return([d["_id"] for d in docs])
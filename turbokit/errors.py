@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+from pymongo.errors import ConnectionFailure
 
 
 class NotRegistered(Exception):
@@ -11,3 +12,37 @@ class OperationError(Exception):
 
 class NoDBSpecified(Exception):
     pass
+
+
+class CircuitOpen(ConnectionFailure):
+    """
+    Raised without touching database, while circuit breaker of collection
+    is open. It is a ConnectionFailure, so it can be handled the same way.
+    """
+    pass
+
+
+class LimitExceeded(ConnectionFailure):
+    """
+    Raised without touching database, when too many operations of
+    collection are already running and waiting (or waiting took too long).
+    It is not retried.
+    """
+    pass
+
+
+class SignalError(Exception):
+    """
+    Raised by concurrent signal dispatch, when some receivers failed.
+    `errors` is a list of (receiver, exception), `results` is a list of
+    (receiver, result) of receivers, that succeeded.
+    """
+
+    def __init__(self, signal, errors, results):
+        self.signal = signal
+        self.errors = errors
+        self.results = results
+        super(SignalError, self).__init__(u"{0} of {1} receivers failed: {2}"
+            .format(len(errors), signal, u"; ".join(
+                u"{0}: {1!r}".format(getattr(r, '__name__', r), e)
+                for r, e in errors)))
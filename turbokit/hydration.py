@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+import time
+import logging
+from tornado import gen
+
+l = logging.getLogger(__name__)
+
+
+class HydrationStats(object):
+    """
+    Time, that conversion of documents of one collection took on IOLoop
+    thread. While it runs, no other request is served.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.documents = 0
+        self.offloaded = 0
+        self.chunked = 0
+        self.blocking_total = 0.0
+        self.blocking_max = 0.0
+
+    def record(self, documents, blocking):
+        self.calls += 1
+        self.documents += documents
+        self.blocking_total += blocking
+        if blocking > self.blocking_max:
+            self.blocking_max = blocking
+
+    def record_block(self, blocking):
+        """One chunk of offloaded conversion, executed on IOLoop thread"""
+        self.blocking_total += blocking
+        if blocking > self.blocking_max:
+            self.blocking_max = blocking
+
+    @property
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'documents': self.documents,
+            'offloaded': self.offloaded,
+            'chunked': self.chunked,
+            'blocking_total': self.blocking_total,
+            'blocking_max': self.blocking_max,
+        }
+
+
+_hydration_stats = {}
+
+
+def get_hydration_stats(cls):
+    collection = cls._options.namespace
+    stats = _hydration_stats.get(collection)
+    if stats is None:
+        stats = _hydration_stats.setdefault(collection,
+            HydrationStats(collection))
+    return stats
+
+
+def get_hydration_settings(cls):
+    """
+    Offloading of big conversions, if model enables it:
+
+        class Options:
+            hydration = {'threshold': 1000, 'chunk_size': 200,
+                'executor': ThreadPoolExecutor(4)}
+
+    Batches of at least `threshold` documents are converted by `executor`
+    (anything with concurrent.futures `submit`). Without executor they are
+    converted on IOLoop by chunks of `chunk_size`, other callbacks run
+    between chunks.
+    """
+    settings = getattr(cls._options, 'hydration', None)
+    if not settings:
+        return None
+    settings = dict(settings)
+    settings.setdefault('threshold', 1000)
+    settings.setdefault('chunk_size', 200)
+    settings.setdefault('executor', None)
+    return settings
+
+
+def should_offload(cls, count):
+    settings = get_hydration_settings(cls)
+    return settings is not None and count >= settings['threshold']
+
+
+def _hydrate(cls, raw_docs):
+    return [cls(d, from_mongo=True) for d in raw_docs]
+
+
+def _serialize(docs):
+    return [doc.to_mongo() for doc in docs]
+
+
+def hydrate(cls, raw_docs):
+    """Model instances from raw documents, converted on IOLoop thread"""
+    started_at = time.time()
+    result = _hydrate(cls, raw_docs)
+    get_hydration_stats(cls).record(len(raw_docs), time.time() - started_at)
+    return result
+
+
+def serialize(cls, docs):
+    """Raw documents of model instances, converted on IOLoop thread"""
+    started_at = time.time()
+    result = _serialize(docs)
+    get_hydration_stats(cls).record(len(docs), time.time() - started_at)
+    return result
+
+
+@gen.coroutine
+def _offload(cls, func, args, items):
+    settings = get_hydration_settings(cls)
+    stats = get_hydration_stats(cls)
+    stats.calls += 1
+    stats.documents += len(items)
+    if settings['executor'] is not None:
+        stats.offloaded += 1
+        result = yield settings['executor'].submit(func, *(args + (items,)))
+        raise gen.Return(result)
+    stats.chunked += 1
+    result = []
+    chunk_size = settings['chunk_size']
+    for start in range(0, len(items), chunk_size):
+        if start:
+            yield gen.moment
+        started_at = time.time()
+        result.extend(func(*(args + (items[start:start + chunk_size],))))
+        stats.record_block(time.time() - started_at)
+    raise gen.Return(result)
+
+
+def hydrate_async(cls, raw_docs):
+    """
+    Future of model instances from raw documents, converted by executor
+    or by chunks (see `get_hydration_settings`)
+    """
+    return _offload(cls, _hydrate, (cls,), raw_docs)
+
+
+def serialize_async(cls, docs):
+    """Future of raw documents of model instances, see `hydrate_async`"""
+    return _offload(cls, _serialize, (), docs)
@@ -9,11 +9,41 @@ from schematics.models import Model as SchematicsModel
 from pymongo.errors import OperationFailure
 from .cursors import AsyncManagerCursor, PrefetchRelatedMixin
 from .types import NULLIFY, CASCADE, DENY, PULL
-from .errors import OperationError
-from .signals import pre_remove, post_remove
+from .errors import OperationError, NoDBSpecified
+from .signals import (pre_save, post_save, pre_remove, post_remove,
+    pre_bulk_insert, post_bulk_insert, pre_bulk_remove, post_bulk_remove,
+    pre_bulk_update, post_bulk_update)
+from .delete_rules import ordered_delete_rules, get_delete_rules_graph
+from .retry import with_retry
+from .cache import (get_document_cache, get_query_cache, id_from_query,
+    bump_generation, uses_generation, make_query_key)
+from .concurrency import (coalesced, get_single_flight,
+    get_concurrency_limiter)
+from .counters import (update_counters, rebuild_counter_cache,
+    check_counter_update)
+from .snapshots import (fill_snapshots, process_reference_query,
+    reference_key)
+from .memory import get_in_memory_collection, ids_from_query
+from .views import refresh_view, get_view_settings, get_view_state
+from .connections import (get_model_database, get_database,
+    configure_database, get_related_database)
+from .hydration import (should_offload, serialize, serialize_async,
+    get_hydration_stats)
 
 l = logging.getLogger(__name__)
 
+# name of helper method: (mongodb operator, value is an item of ListType)
+ATOMIC_OPERATORS = {
+    'inc': ('$inc', False),
+    'push': ('$push', True),
+    'add_to_set': ('$addToSet', True),
+    'pull': ('$pull', True),
+    'pop': ('$pop', False),
+    'set_on_insert': ('$setOnInsert', False),
+    'max': ('$max', False),
+    'min': ('$min', False),
+}
+
 
 class AsyncManager(PrefetchRelatedMixin):
 
@@ -21,7 +51,7 @@ class AsyncManager(PrefetchRelatedMixin):
         super(AsyncManager, self).__init__(cls, collection, db=db, **kwargs)
         self.collection = collection
         self.cls = cls
-        self.db = db
+        self._db = db
         if fields is None:
             fields = {}
         self.fields = fields
@@ -43,7 +73,7 @@ class AsyncManager(PrefetchRelatedMixin):
             else:
                 # _fields contains all False values, just update
                 _fields.update(exclude_fields)
-        return AsyncManager(self.cls, self.collection, self.db, _fields)
+        return AsyncManager(self.cls, self.collection, self._db, _fields)
 
     def only(self, *fields):
         # TODO only also self.cls._serializables
@@ -61,7 +91,17 @@ class AsyncManager(PrefetchRelatedMixin):
                 for exclude_field in _fields:
                     only_fields.pop(exclude_field, None)
                 _fields = only_fields
-        return AsyncManager(self.cls, self.collection, self.db, _fields)
+        return AsyncManager(self.cls, self.collection, self._db, _fields)
+
+    @property
+    def db(self):
+        """
+        Database, given by `set_db`, or database of the model from
+        registered connections (see turbokit.connections)
+        """
+        if self._db is not None:
+            return self._db
+        return get_model_database(self.cls)
 
     def set_db(self, db):
         """
@@ -70,39 +110,158 @@ class AsyncManager(PrefetchRelatedMixin):
         """
         return AsyncManager(self.cls, self.collection, db)
 
+    def related_objects(self, cls):
+        """Manager of related model `cls` for operation of this manager"""
+        return cls.objects.set_db(get_related_database(cls, self.db))
+
+    def using(self, alias, name=None):
+        """Manager, that works with database of another connection alias"""
+        db = get_database(alias, name,
+            getattr(self.cls._options, 'read_preference', None),
+            getattr(self.cls._options, 'write_concern', None))
+        return AsyncManager(self.cls, self.collection, db, self.fields,
+            prefetch_related=self._prefetch_related)
+
+    def with_options(self, read_preference=None, write_concern=None):
+        """
+        Manager with another read preference or write concern for the
+        following queries, for example:
+
+            yield Model.objects.with_options(
+                read_preference=ReadPreference.PRIMARY).get({'id': pk})
+        """
+        db = self.db
+        if db is None:
+            raise NoDBSpecified
+        return AsyncManager(self.cls, self.collection,
+            configure_database(db, read_preference, write_concern),
+            self.fields, prefetch_related=self._prefetch_related)
+
     @gen.coroutine
     def get(self, query, return_raw=False):
-        # TODO: add reconnects here and in other methods
         query = self.process_query(query)
         params = self.get_find_extra_params()
-        response = yield self.db[self.collection].find_one(query, **params)
+        memory = get_in_memory_collection(self.cls)
+        docs = memory.find(self.db, query, self.fields, limit=1) \
+            if memory else None
+        cache = get_document_cache(self.cls)
+        cached_id = id_from_query(query) \
+            if cache and not self.fields and docs is None else None
+        response = cache.get(self.db, cached_id) if cached_id else None
+        if docs is not None:
+            response = docs[0] if docs else None
+        elif response is None:
+            version = cache.version if cached_id else None
+            read_key = make_query_key(self.db, self.collection, 'get', query,
+                self.fields) if get_single_flight(self.cls) else None
+            response = yield coalesced(self.cls, read_key, with_retry,
+                self.cls, self.collection, 'get',
+                self.db[self.collection].find_one, query, **params)
+            if cached_id and response:
+                cache.set(self.db, response, version)
         if return_raw:
             result = response
         elif response:
-            m = self.cls(response, from_mongo=True)
-            results_with_related = yield self.fetch_related_objects([m])
-            result = results_with_related[0]
+            result = self.cls(response, from_mongo=True)
+            if self._prefetch_related:
+                results_with_related = yield self.fetch_related_objects([result])
+                result = results_with_related[0]
         else:
             result = None
         raise gen.Return(result)
 
     @gen.coroutine
-    def update(self, query, raw_data, upsert=False, multi=False):
+    def update(self, query, raw_data, upsert=False, multi=False,
+            check_counters=True):
+        """
+        Update with raw data. References with counter cache can't be
+        changed here (OperationError), pass check_counters=False to do it
+        anyway and rebuild counters later.
+        """
+        if check_counters:
+            check_counter_update(self.cls, raw_data)
         query = self.process_query(query)
-        result = yield self.db[self.collection].update(query, raw_data,
-            upsert=upsert, multi=multi)
+        if pre_bulk_update.has_receivers(self.cls):
+            yield pre_bulk_update.send(self.cls, query=query, update=raw_data,
+                multi=multi)
+        try:
+            result = yield with_retry(self.cls, self.collection, 'update',
+                self.db[self.collection].update, query, raw_data,
+                upsert=upsert, multi=multi, write=True)
+        finally:
+            self.invalidate_cache(query)
         if result['ok'] != 1:
             # TODO how to catch this exception?
             raise OperationFailure(result, code=result['ok'])
+        if post_bulk_update.has_receivers(self.cls):
+            yield post_bulk_update.send(self.cls, query=query, update=raw_data,
+                multi=multi, result=result)
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def patch(self, query, raw_data, **kwargs):
+        """
+        Apply partial raw data (for example, body of PATCH request) with
+        single update, document is not loaded:
+
+            yield Model.objects.set_db(db).patch({'id': pk}, json_data)
+
+        Returns None, if raw data contains nothing to update.
+        """
+        data = self.cls.get_data_for_patch(raw_data)
+        if not data:
+            raise gen.Return(None)
+        result = yield self.update(query, data, **kwargs)
+        raise gen.Return(result)
+
+    def inc(self, query, data, **kwargs):
+        """
+        Atomic $inc for all documents matched by query (use multi=True
+        for more than one document). Same for other atomic helpers below,
+        values are converted by the fields of the model.
+        """
+        return self.atomic_update(query, 'inc', data, **kwargs)
+
+    def push(self, query, data, **kwargs):
+        return self.atomic_update(query, 'push', data, **kwargs)
+
+    def add_to_set(self, query, data, **kwargs):
+        return self.atomic_update(query, 'add_to_set', data, **kwargs)
+
+    def pull(self, query, data, **kwargs):
+        return self.atomic_update(query, 'pull', data, **kwargs)
+
+    def pop(self, query, data, **kwargs):
+        return self.atomic_update(query, 'pop', data, **kwargs)
+
+    def set_on_insert(self, query, data, **kwargs):
+        return self.atomic_update(query, 'set_on_insert', data, **kwargs)
+
+    def max(self, query, data, **kwargs):
+        return self.atomic_update(query, 'max', data, **kwargs)
+
+    def min(self, query, data, **kwargs):
+        return self.atomic_update(query, 'min', data, **kwargs)
+
+    @gen.coroutine
+    def atomic_update(self, query, operator, data, **kwargs):
+        native_data = self.cls.get_native_data_for_operator(operator, data)
+        raw_data = {ATOMIC_OPERATORS[operator][0]:
+            self.cls.get_data_for_operator(operator, native_data)}
+        result = yield self.update(query, raw_data, **kwargs)
         raise gen.Return(result)
 
     @gen.coroutine
-    def insert(self, doc_or_docs, load_bulk=False, **kwargs):
+    def insert(self, doc_or_docs, load_bulk=False, document_signals=False,
+            **kwargs):
         """bulk insert documents
 
         :param doc_or_docs: a document or list of documents to be inserted
         :param load_bulk (optional): If True returns the list of document
             instances
+        :param document_signals (optional): If True, pre_save and post_save
+            are sent for every document, besides pre_bulk_insert and
+            post_bulk_insert
 
         By default returns  ObjectIds, set ``load_bulk`` to True to
         return document instances.
@@ -113,13 +272,50 @@ class AsyncManager(PrefetchRelatedMixin):
         else:
             return_one = True
             docs = [doc_or_docs]
-        raw = []
+        client_side_ids = self.cls.use_client_side_ids()
+        if pre_bulk_insert.has_receivers(self.cls):
+            yield pre_bulk_insert.send(self.cls, documents=docs)
+        if document_signals and pre_save.has_receivers(self.cls):
+            for doc in docs:
+                yield pre_save.send(self.cls, document=doc)
+        yield fill_snapshots(self.db, docs)
         for doc in docs:
             if not isinstance(doc, self.cls):
                 raise OperationError(u"Some documents inserted aren't "
-                    "instances of {0}".self.cls)
-            raw.append(doc.to_mongo())
-        ids = yield self.db[self.collection].insert(raw, **kwargs)
+                    "instances of {0}".format(self.cls))
+            if client_side_ids:
+                doc.assign_id()
+        if should_offload(self.cls, len(docs)):
+            raw = yield serialize_async(self.cls, docs)
+        else:
+            raw = serialize(self.cls, docs)
+        attempts = []
+
+        def insert_raw():
+            # on retry some documents can be already inserted,
+            # continue with others and ignore duplicates of them
+            kw = dict(kwargs)
+            if attempts and client_side_ids:
+                kw['continue_on_error'] = True
+            attempts.append(True)
+            return self.db[self.collection].insert(raw, **kw)
+        try:
+            ids = yield with_retry(self.cls, self.collection, 'insert',
+                insert_raw, write=True, ignore_duplicate_id=client_side_ids)
+        finally:
+            # pymongo assigns _id to raw documents before sending them
+            self.invalidate_cache(
+                inserted_ids=[data.get('_id') for data in raw])
+        if ids is None:
+            ids = [doc.pk for doc in docs]
+        for doc, pk in zip(docs, ids):
+            doc._id = pk
+        yield update_counters(self.db, self.cls, new_docs=raw)
+        if document_signals and post_save.has_receivers(self.cls):
+            for doc in docs:
+                yield post_save.send(self.cls, document=doc)
+        if post_bulk_insert.has_receivers(self.cls):
+            yield post_bulk_insert.send(self.cls, documents=docs)
         if not load_bulk:
             result = return_one and ids[0] or ids
         else:
@@ -127,64 +323,99 @@ class AsyncManager(PrefetchRelatedMixin):
         raise gen.Return(result)
 
     @gen.coroutine
-    def remove(self, query, docs_tobe_deleted=None, **kwargs):
+    def remove(self, query, docs_tobe_deleted=None, document_signals=True,
+            **kwargs):
+        """
+        Remove documents, applying delete rules. pre_bulk_remove and
+        post_bulk_remove are sent once with all documents, pre_remove and
+        post_remove are sent for every document, unless document_signals
+        is False.
+        """
         query = self.process_query(query)
         if not docs_tobe_deleted:
             # TODO use next or fetch with skip and limit
             docs_tobe_deleted = yield self.filter(query).all()
+        if pre_bulk_remove.has_receivers(self.cls):
+            yield pre_bulk_remove.send(self.cls, documents=docs_tobe_deleted)
         for doc in docs_tobe_deleted:
-            yield pre_remove.send(doc.__class__, document=doc)
-            delete_rules = getattr(doc._options, 'delete_rules', {})
+            if document_signals and pre_remove.has_receivers(doc.__class__):
+                yield pre_remove.send(doc.__class__, document=doc)
+            delete_rules = ordered_delete_rules(doc.__class__)
             # check DENY rule first. If even one deny rule is matched,
             # deny entire remove action
-            for rule_entry in delete_rules:
-                parent_doc_cls, parent_field_name = rule_entry
-                rule = delete_rules[rule_entry]
+            for parent_doc_cls, parent_field_name, rule in delete_rules:
                 if rule == DENY:
-                    cnt = yield parent_doc_cls.objects.set_db(self.db).filter(
+                    cnt = yield self.related_objects(parent_doc_cls).filter(
                         {parent_field_name: doc.pk}).count()
                     if cnt > 0:
                         raise OperationError(
                             "Could not delete document ({0}.{1} refers to it)"
                             .format(parent_doc_cls.__name__, parent_field_name))
             # now check other delete rules
-            for rule_entry in delete_rules:
-                parent_doc_cls, parent_field_name = rule_entry
-                rule = delete_rules[rule_entry]
+            for parent_doc_cls, parent_field_name, rule in delete_rules:
                 l.debug('processing delete rule {0} for {1}'.format(rule, parent_doc_cls.__name__))
                 if rule == NULLIFY:
-                    parent_doc_cls.objects.set_db(self.db).update(
+                    yield self.related_objects(parent_doc_cls).update(
                         {parent_field_name: doc.pk},
-                        {"$unset": {parent_field_name: ""}}, multi=True)
+                        {"$unset": {parent_field_name: ""}}, multi=True,
+                        check_counters=False)
                 elif rule == CASCADE:
-                    parent_doc_cls.objects.set_db(self.db).remove(
+                    yield self.related_objects(parent_doc_cls).remove(
                         {parent_field_name: doc.pk})
                 elif rule == PULL:
-                    parent_doc_cls.objects.set_db(self.db).update(
+                    if reference_key(parent_doc_cls, parent_field_name) \
+                            != parent_field_name:
+                        pull_value = {"_id": doc.pk}  # snapshot reference
+                    else:
+                        pull_value = doc.pk
+                    yield self.related_objects(parent_doc_cls).update(
                         {parent_field_name: doc.pk},
-                        {"$pull": {parent_field_name: doc.pk}},
-                        multi=True)
+                        {"$pull": {parent_field_name: pull_value}},
+                        multi=True, check_counters=False)
 
-        result = yield self.db[self.collection].remove(query, **kwargs)
+        try:
+            result = yield with_retry(self.cls, self.collection, 'remove',
+                self.db[self.collection].remove, query, write=True,
+                idempotent=True, **kwargs)
+        finally:
+            self.invalidate_cache(ids=[doc.pk for doc in docs_tobe_deleted])
         if result['ok'] != 1:
             # TODO how to catch this exception?
             raise OperationFailure(result, code=result['ok'])
-        for doc in docs_tobe_deleted:
-            yield post_remove.send(doc.__class__, document=doc)
+        yield update_counters(self.db, self.cls,
+            old_docs=[doc.to_mongo() for doc in docs_tobe_deleted])
+        if document_signals:
+            for doc in docs_tobe_deleted:
+                if post_remove.has_receivers(doc.__class__):
+                    yield post_remove.send(doc.__class__, document=doc)
+        if post_bulk_remove.has_receivers(self.cls):
+            yield post_bulk_remove.send(self.cls, documents=docs_tobe_deleted)
         raise gen.Return(result)
 
+    @gen.coroutine
+    def plan_remove(self, query):
+        """
+        Dry run of `remove`: nothing is deleted, returns `RemovePlan` with
+        amount of documents, that every delete rule would touch.
+        """
+        query = self.process_query(query)
+        plan = yield get_delete_rules_graph().plan(self.db, self.cls, query)
+        raise gen.Return(plan)
+
     @gen.coroutine
     def all(self):
         params = self.get_find_extra_params()
         cursor = self.db[self.collection].find({}, **params)
         results = yield AsyncManagerCursor(self.cls, cursor, self.db,
+            query={}, fields=self.fields,
             prefetch_related=self._prefetch_related).all()
         raise gen.Return(results)
 
     @gen.coroutine
     def count(self, with_limit_and_skip=True):
         cursor = self.db[self.collection].find({})
-        result = yield AsyncManagerCursor(self.cls, cursor, self.db).count(
+        result = yield AsyncManagerCursor(self.cls, cursor, self.db,
+            query={}).count(
             with_limit_and_skip=with_limit_and_skip)
         raise gen.Return(result)
 
@@ -194,7 +425,8 @@ class AsyncManager(PrefetchRelatedMixin):
         With server version >= 2.5.1, pass cursor={} to retrieve unlimited
         aggregation results with a CommandCursor
         """
-        result = yield self.db[self.collection].aggregate(pipeline, **kwargs)
+        result = yield with_retry(self.cls, self.collection, 'aggregate',
+            self.db[self.collection].aggregate, pipeline, **kwargs)
         if 'cursor' not in kwargs:
             if result['ok'] != 1:
                 # TODO how to catch this exception?
@@ -203,7 +435,7 @@ class AsyncManager(PrefetchRelatedMixin):
         raise gen.Return(result)
 
     def prefetch_related(self, *args):
-        return AsyncManager(self.cls, self.collection, self.db,
+        return AsyncManager(self.cls, self.collection, self._db,
             prefetch_related=self._prefetch_related | set(args))
 
     def filter(self, query):
@@ -211,8 +443,88 @@ class AsyncManager(PrefetchRelatedMixin):
         params = self.get_find_extra_params()
         cursor = self.db[self.collection].find(query, **params)
         return AsyncManagerCursor(self.cls, cursor, self.db,
+            query=query, fields=self.fields,
             prefetch_related=self._prefetch_related)
 
+    def invalidate_cache(self, query=None, ids=None, inserted_ids=None):
+        """
+        Drop cached documents, that can be changed by query (entire cache,
+        if query is not a lookup by _id) or have given ids.
+        Cached query results of the collection are dropped in any case.
+        In memory copy reads again changed and `inserted_ids` documents.
+        """
+        if uses_generation(self.collection):
+            bump_generation(self.collection)
+        memory = get_in_memory_collection(self.cls)
+        if memory is not None:
+            if query is not None:
+                memory.invalidate(ids_from_query(query))
+            else:
+                memory.invalidate(list(ids or []) + list(inserted_ids or []))
+        cache = get_document_cache(self.cls)
+        if cache is None:
+            return
+        if query is not None:
+            _id = id_from_query(query)
+            if _id is None:
+                cache.clear()
+                return
+            ids = [_id]
+        for _id in ids or []:
+            if _id is not None:
+                cache.invalidate(self.db, _id)
+
+    def cache_stats(self):
+        cache = get_document_cache(self.cls)
+        return cache.stats if cache else None
+
+    def query_cache_stats(self):
+        cache = get_query_cache(self.cls)
+        return cache.stats if cache else None
+
+    @gen.coroutine
+    def load_in_memory(self):
+        """
+        Load collection of the model with `in_memory` option into memory
+        and keep it fresh
+        """
+        memory = get_in_memory_collection(self.cls)
+        if memory is None:
+            raise OperationError(u"{0} has no in_memory option".format(self.cls))
+        yield memory.start(self.db)
+
+    def memory_stats(self):
+        memory = get_in_memory_collection(self.cls)
+        return memory.stats if memory else None
+
+    @gen.coroutine
+    def rebuild_counters(self, field_name=None):
+        """
+        Recalculate counter caches, declared on references of the model
+        """
+        yield rebuild_counter_cache(self.db, self.cls, field_name)
+
+    @gen.coroutine
+    def refresh_view(self):
+        """Refresh materialized view, declared by the model"""
+        yield refresh_view(self.db, self.cls)
+
+    def view_stats(self):
+        get_view_settings(self.cls)
+        return get_view_state(self.cls).stats
+
+    def coalesce_stats(self):
+        flight = get_single_flight(self.cls)
+        return flight.stats if flight else None
+
+    def concurrency_stats(self):
+        limiter = get_concurrency_limiter(self.cls, self.collection)
+        return limiter.stats if limiter else None
+
+    def hydration_stats(self):
+        """Time, spent by conversion of documents on IOLoop thread"""
+        return get_hydration_stats(self.cls).stats
+
     def process_query(self, query):
         for pk_name in ['id', 'pk']:
             if pk_name in query:
@@ -224,7 +536,7 @@ class AsyncManager(PrefetchRelatedMixin):
                 else:
                     query['_id'] = _id
                 break
-        return query
+        return process_reference_query(self.cls, query)
 
     def get_find_extra_params(self):
         params = {}
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+import time
+import logging
+from copy import deepcopy
+from bson import BSON
+from tornado import gen, ioloop
+from .retry import with_retry
+
+l = logging.getLogger(__name__)
+
+
+class InMemoryCollection(object):
+    """
+    Copy of entire collection in memory of the process with indexes on
+    declared fields. Copy is reloaded every `refresh_interval` seconds.
+    Documents, written through TurboKit, are read again by ids and applied
+    to the copy (multi updates by other queries reload entire collection);
+    until that queries go to database, so writes are visible immediately.
+
+    Only queries, that consist of equality and `$in` conditions on top
+    level fields, are answered from memory (indexed fields and `_id`
+    select documents, other fields are checked one by one). Everything
+    else (projections, operators, dotted keys) goes to database.
+    """
+
+    def __init__(self, cls, indexes=(), refresh_interval=None):
+        self.cls = cls
+        self.index_fields = tuple(indexes)
+        self.refresh_interval = refresh_interval
+        self.docs = {}
+        self.positions = {}
+        self.indexes = {}
+        self.sizes = {}
+        self._next_position = 0
+        self.db_name = None
+        self.size = 0
+        self.loaded_at = None
+        self.load_duration = None
+        self.loads = 0
+        self.hits = 0
+        self.fallbacks = 0
+        self.fetches = 0
+        self._version = 0
+        self._loaded_version = None
+        self._loading = False
+        self._stale_ids = set()
+        self._fetching = set()
+        self._db = None
+        self._callback = None
+
+    @gen.coroutine
+    def start(self, db):
+        """Load collection and reload it periodically, if interval is set"""
+        self._db = db
+        yield self.load(db)
+        if self.refresh_interval and self._callback is None:
+            self._callback = ioloop.PeriodicCallback(self.refresh,
+                self.refresh_interval * 1000)
+            self._callback.start()
+
+    def stop(self):
+        if self._callback is not None:
+            self._callback.stop()
+            self._callback = None
+
+    @gen.coroutine
+    def load(self, db):
+        if self._loading:
+            return
+        self._loading = True
+        try:
+            # writes, made during loading, make it stale again
+            version = self._version
+            stale_ids = set(self._stale_ids)
+            started_at = time.time()
+            collection = self.cls._options.namespace
+            raw_docs = yield with_retry(self.cls, collection, 'in_memory',
+                lambda: db[collection].find().to_list(None))
+            self._build(raw_docs)
+            self._stale_ids -= stale_ids
+            self.db_name = db.name
+            self.loaded_at = time.time()
+            self.load_duration = self.loaded_at - started_at
+            self.loads += 1
+            self._loaded_version = version
+        finally:
+            self._loading = False
+        if self._loaded_version != self._version:
+            yield self.load(db)
+
+    @gen.coroutine
+    def refresh(self):
+        try:
+            yield self.load(self._db)
+        except Exception:
+            l.exception("Failed to load {0} into memory".format(
+                self.cls.__name__))
+
+    def invalidate(self, ids=None):
+        """
+        Collection is changed: documents with `ids` are read again, without
+        ids (or while collection is loading) entire collection is reloaded.
+        """
+        if ids is None or None in ids or self._loading or self._db is None:
+            self._version += 1
+            if self._db is not None:
+                ioloop.IOLoop.current().add_callback(self.refresh)
+            return
+        if not ids:
+            return
+        if not self._stale_ids and not self._fetching:
+            ioloop.IOLoop.current().add_callback(self.fetch_stale)
+        self._stale_ids.update(ids)
+
+    @gen.coroutine
+    def fetch_stale(self):
+        """Read changed documents in one query and apply them to the copy"""
+        if self._fetching:
+            return
+        collection = self.cls._options.namespace
+        db = self._db
+        while self._stale_ids:
+            ids, self._stale_ids = self._stale_ids, set()
+            self._fetching = ids
+            try:
+                raw_docs = yield with_retry(self.cls, collection, 'in_memory',
+                    lambda: db[collection].find(
+                        {'_id': {'$in': list(ids)}}).to_list(None))
+            except Exception:
+                l.exception("Failed to read changed {0} documents".format(
+                    self.cls.__name__))
+                self._stale_ids.update(ids)
+                self._fetching = set()
+                self._version += 1
+                yield self.refresh()
+                return
+            self._fetching = set()
+            if self.db_name == db.name:
+                self._apply(ids, raw_docs)
+                self.fetches += 1
+
+    def _build(self, raw_docs):
+        self.docs, self.positions, self.sizes = {}, {}, {}
+        self.indexes = dict((f, {}) for f in self.index_fields)
+        self.size = 0
+        self._next_position = 0
+        for doc in raw_docs:
+            self._add(doc)
+
+    def _add(self, doc):
+        pk = doc['_id']
+        self.docs[pk] = doc
+        if pk not in self.positions:
+            # new documents go last, as in natural order of collection
+            self.positions[pk] = self._next_position
+            self._next_position += 1
+        self.sizes[pk] = len(BSON.encode(doc))
+        self.size += self.sizes[pk]
+        for field, index in self.indexes.iteritems():
+            for value in _index_values(doc.get(field)):
+                index.setdefault(value, set()).add(pk)
+
+    def _discard(self, pk):
+        doc = self.docs.pop(pk, None)
+        if doc is None:
+            return
+        self.size -= self.sizes.pop(pk)
+        for field, index in self.indexes.iteritems():
+            for value in _index_values(doc.get(field)):
+                pks = index[value]
+                pks.discard(pk)
+                if not pks:
+                    del index[value]
+
+    def _apply(self, ids, raw_docs):
+        """Replace documents `ids` by actual ones (missing are removed)"""
+        for pk in ids:
+            self._discard(pk)
+        for doc in raw_docs:
+            self._add(doc)
+        for pk in ids:
+            if pk not in self.docs:
+                self.positions.pop(pk, None)
+
+    def can_serve(self, db):
+        return self._loaded_version == self._version \
+            and not self._stale_ids and not self._fetching \
+            and self.db_name == db.name
+
+    def find(self, db, query, fields=None, sort=None, skip=0, limit=0):
+        """
+        Copies of raw documents, matching the query, or None, if the query
+        can't be answered from memory.
+        """
+        ids = None
+        sort_keys = _sort_keys(sort)
+        if self.can_serve(db) and not fields \
+                and not any('.' in key for key, _ in sort_keys):
+            ids = self._match(query)
+        if ids is None:
+            self.fallbacks += 1
+            return None
+        self.hits += 1
+        docs = [self.docs[pk] for pk in
+            sorted(ids, key=lambda pk: self.positions[pk])]
+        for key, direction in reversed(sort_keys):
+            docs.sort(key=lambda d: d.get(key), reverse=direction < 0)
+        if skip:
+            docs = docs[skip:]
+        if limit:
+            docs = docs[:limit]
+        return deepcopy(docs)
+
+    def _match(self, query):
+        candidates = None
+        checks = []
+        for key, value in query.iteritems():
+            if isinstance(value, dict):
+                if value.keys() != ['$in']:
+                    return None
+                values = value['$in']
+            else:
+                values = [value]
+            try:
+                values = set(values)
+            except TypeError:
+                return None
+            if key == '_id':
+                ids = set(pk for pk in values if pk in self.docs)
+            elif key in self.indexes:
+                index = self.indexes[key]
+                ids = set()
+                for v in values:
+                    ids.update(index.get(v, ()))
+            elif '.' in key or key.startswith('$'):
+                return None
+            else:
+                checks.append((key, values))
+                continue
+            candidates = ids if candidates is None else candidates & ids
+        if candidates is None:
+            candidates = self.docs.iterkeys()
+        return [pk for pk in candidates
+            if all(_matches(self.docs[pk].get(k), v) for k, v in checks)]
+
+    @property
+    def stats(self):
+        return {
+            'documents': len(self.docs),
+            'size': self.size,
+            'loads': self.loads,
+            'loaded_at': self.loaded_at,
+            'load_duration': self.load_duration,
+            'lag': time.time() - self.loaded_at if self.loaded_at else None,
+            'fresh': self._loaded_version == self._version
+                and not self._stale_ids and not self._fetching,
+            'fetches': self.fetches,
+            'hits': self.hits,
+            'fallbacks': self.fallbacks,
+        }
+
+
+def ids_from_query(query):
+    """Ids, if query is a lookup by `_id` (value or `$in`), None otherwise"""
+    if query is None or query.keys() != ['_id']:
+        return None
+    value = query['_id']
+    if isinstance(value, dict):
+        if value.keys() != ['$in']:
+            return None
+        return list(value['$in'])
+    return [value]
+
+
+def _index_values(value):
+    values = value if isinstance(value, list) else [value]
+    for v in values:
+        try:
+            hash(v)
+        except TypeError:
+            continue
+        yield v
+
+
+def _matches(value, values):
+    for v in _index_values(value):
+        if v in values:
+            return True
+    return False
+
+
+def _sort_keys(sort):
+    """Sort keys of the last `sort` call of cursor: [(key, direction)]"""
+    if not sort:
+        return []
+    args, kwargs = sort[-2:]
+    key_or_list = args[0] if args else kwargs.get('key_or_list')
+    direction = args[1] if len(args) > 1 else kwargs.get('direction')
+    if isinstance(key_or_list, basestring):
+        return [(key_or_list, direction or 1)]
+    return list(key_or_list)
+
+
+_in_memory_collections = {}
+
+
+def get_in_memory_collection(cls):
+    """
+    In memory copy of `cls` collection, if model enables it:
+
+        class Options:
+            in_memory = {'indexes': ('code',), 'refresh_interval': 60}
+    """
+    settings = getattr(cls._options, 'in_memory', None)
+    if not settings:
+        return None
+    collection = cls._options.namespace
+    memory = _in_memory_collections.get(collection)
+    if memory is None:
+        memory = _in_memory_collections.setdefault(collection,
+            InMemoryCollection(cls, **settings))
+    return memory
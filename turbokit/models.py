@@ -1,11 +1,10 @@
 # -*- coding: utf-8 -*-
 import logging
-import motor
 import pytz
 
 from datetime import timedelta
 from tornado import gen, ioloop
-from pymongo.errors import ConnectionFailure
+from bson.objectid import ObjectId
 from schematics.models import (
     ModelMeta as SchematicsModelMeta,
     Model as SchematicsModel,
@@ -15,11 +14,19 @@ from schematics.types.compound import ListType
 from copy import deepcopy
 
 from .utils import _document_registry
-from .transforms import to_mongo, to_primitive, convert
+from .transforms import (to_mongo, to_primitive, convert, field_to_mongo,
+    patch_to_mongo)
 from .types import ObjectIdType, ModelReferenceType, DO_NOTHING
-from .managers import AsyncManager
+from .managers import AsyncManager, ATOMIC_OPERATORS
 from .signals import pre_save, post_save
-from .errors import NoDBSpecified
+from .delete_rules import reset_delete_rules_graph
+from .retry import (with_retry, get_retry_policy, RECONNECT_TRIES,
+    RECONNECT_TIMEOUT)
+from .snapshots import (snapshot_references, fill_snapshots,
+    schedule_propagation)
+from .counters import (CounterCache, get_counter_caches, counter_fields,
+    update_counters)
+from .errors import NoDBSpecified, OperationError
 
 l = logging.getLogger(__name__)
 MAX_FIND_LIST_LEN = 100
@@ -89,6 +96,8 @@ class ModelMeta(BaseModelMeta):
         if not attrs['_options'].namespace:
             attrs['_options'].namespace = name.replace("Model", "").lower()
         cls.set_delete_rules(attrs, new_class)
+        cls.set_counter_caches(attrs, new_class)
+        cls.set_snapshot_references(attrs, new_class)
         setattr(new_class, "objects", AsyncManager(new_class, attrs['_options'].namespace))
 
     @classmethod
@@ -101,6 +110,27 @@ class ModelMeta(BaseModelMeta):
                     field.model_class.register_delete_rule(new_class,
                                                      field_name, delete_rule)
 
+    @classmethod
+    def set_counter_caches(cls, attrs, new_class):
+        counter_caches = []
+        for field_name, field in attrs['_fields'].iteritems():
+            is_list = isinstance(field, ListType)
+            ref_field = field.field if is_list else field
+            if isinstance(ref_field, ModelReferenceType) \
+                    and getattr(ref_field, 'counter_cache', None):
+                counter_caches.append(CounterCache(new_class, field_name,
+                    field.serialized_name or field_name, ref_field, is_list))
+        attrs['_options'].counter_caches = counter_caches
+
+    @classmethod
+    def set_snapshot_references(cls, attrs, new_class):
+        references = snapshot_references(new_class)
+        attrs['_options'].snapshot_references = references
+        for ref in references:
+            referrers = getattr(ref.target._options, 'snapshot_referrers', [])
+            referrers.append(ref)
+            ref.target._options.snapshot_referrers = referrers
+
 
 class SerializationMixin(object):
 
@@ -185,8 +215,10 @@ class BaseModel(SerializationMixin, SchematicsModel):
     """
     __metaclass__ = ModelMeta
 
-    RECONNECT_TRIES = 5  # TODO: Move to connection
-    RECONNECT_TIMEOUT = 2  # in seconds
+    # deprecated, declare `retry_policy` in Options (see turbokit.retry);
+    # overridden values are still turned into retry policy of the model
+    RECONNECT_TRIES = RECONNECT_TRIES
+    RECONNECT_TIMEOUT = RECONNECT_TIMEOUT
 
     _id = ObjectIdType(serialized_name='id')
 
@@ -197,7 +229,11 @@ class BaseModel(SerializationMixin, SchematicsModel):
 
     @property
     def db(self):
-        return getattr(self, '_db', None)
+        """Database of instance or of the model (see turbokit.connections)"""
+        db = getattr(self, '_db', None)
+        if db is None:
+            db = self.objects.db
+        return db
 
     def set_db(self, db):
         self._db = db
@@ -213,6 +249,19 @@ class BaseModel(SerializationMixin, SchematicsModel):
     def pk(self):
         return self._id
 
+    def assign_id(self):
+        """
+        Generate ObjectId on client side, if instance has no one yet.
+        So it can be referenced before it is saved.
+        """
+        if self._id is None:
+            self._id = ObjectId()
+        return self._id
+
+    @classmethod
+    def use_client_side_ids(cls):
+        return getattr(cls._options, 'client_side_ids', False)
+
     @classmethod
     def get_collection(cls):
         return cls._options.namespace
@@ -221,6 +270,27 @@ class BaseModel(SerializationMixin, SchematicsModel):
     def check_collection(cls, collection):
         return collection or cls.get_collection()
 
+    @classmethod
+    def reconnect_amount(cls):
+        """Deprecated: attempts, allowed by retry policy of the model"""
+        return xrange(get_retry_policy(cls).max_retries + 1)
+
+    @classmethod
+    @gen.coroutine
+    def check_reconnect_tries_and_wait(cls, reconnect_number, func_name):
+        """
+        Deprecated: True, if retries of retry policy are exhausted,
+        otherwise waits its delay before the next attempt
+        """
+        policy = get_retry_policy(cls)
+        if reconnect_number >= policy.max_retries:
+            raise gen.Return(True)
+        delay = policy.get_delay(reconnect_number)
+        l.warning("ConnectionFailure #{0} in {1}.{2}. Waiting {3} seconds"
+            .format(reconnect_number + 1, cls.__name__, func_name, delay))
+        yield gen.Task(ioloop.IOLoop.current().add_timeout,
+            timedelta(seconds=delay))
+
     @gen.coroutine
     def remove(self, db, collection=None):
         """
@@ -237,26 +307,48 @@ class BaseModel(SerializationMixin, SchematicsModel):
             obj = ExampleModel({"first_name": "Vasya"})
             yield obj.save(self.db)
         """
-        yield pre_save.send(self.__class__, document=self)
+        if pre_save.has_receivers(self.__class__):
+            yield pre_save.send(self.__class__, document=self)
         self.validate()
         db = db or self.db
         if not db:
             raise NoDBSpecified
+        if self.use_client_side_ids():
+            self.assign_id()
         c = self.check_collection(collection)
+        yield fill_snapshots(db, [self])
         data = self.get_data_for_save(ser)
         result = None
-        for i in self.reconnect_amount():
-            try:
-                result = yield db[c].save(data)
-            except ConnectionFailure as e:
-                exceed = yield self.check_reconnect_tries_and_wait(i, 'save')
-                if exceed:
-                    raise e
+        old_docs = []
+        try:
+            if get_counter_caches(self.__class__) and self.pk:
+                # previous references are returned by the replace itself, so
+                # concurrent saves can't both count the same change; repeated
+                # attempt would return written document, so it isn't
+                # retried as idempotent
+                old = yield with_retry(self.__class__, c, 'save',
+                    db[c].find_and_modify, {'_id': self.pk}, data,
+                    upsert=True, fields=counter_fields(self.__class__),
+                    write=True)
+                old_docs = [old] if old else []
             else:
-                if result:
-                    self._id = result
-                yield post_save.send(self.__class__, document=self)
-                raise gen.Return(self)  # `save` always should return saved instance, not None
+                # with _id (assigned above for client side ids) save
+                # replaces the document, so it can be repeated
+                result = yield with_retry(self.__class__, c, 'save',
+                    db[c].save, data, write=True, idempotent=bool(self.pk))
+        finally:
+            # pymongo assigns _id of new document to data
+            self.objects.set_db(db).invalidate_cache(
+                ids=[self.pk or data.get('_id')])
+        if result:
+            self._id = result
+        yield update_counters(db, self.__class__, old_docs, [data])
+        schedule_propagation(db, self, data)
+        # next save propagates only changes made after this one
+        self._initial = data
+        if post_save.has_receivers(self.__class__):
+            yield post_save.send(self.__class__, document=self)
+        raise gen.Return(self)  # `save` always should return saved instance, not None
 
     @gen.coroutine
     def insert(self, db=None, collection=None, ser=None, **kwargs):
@@ -265,26 +357,30 @@ class BaseModel(SerializationMixin, SchematicsModel):
         If object with such _id is already in database, then
         pymongo.errors.DuplicateKeyError will be raised.
         If object has no _id, then object will be inserted and _id will be
-        assigned.
+        assigned. With `client_side_ids = True` in model Options _id is
+        assigned before insertion, so retries after ConnectionFailure
+        can't create duplicates.
 
         Example:
             obj = ExampleModel({"first_name": "Vasya"})
             yield obj.insert()
         """
         db = db or self.db
+        client_side_ids = self.use_client_side_ids()
+        if client_side_ids:
+            self.assign_id()
         c = self.check_collection(collection)
+        yield fill_snapshots(db, [self])
         data = self.get_data_for_save(ser)
-        for i in self.reconnect_amount():
-            try:
-                result = yield motor.Op(db[c].insert, data, **kwargs)
-            except ConnectionFailure as e:
-                exceed = yield self.check_reconnect_tries_and_wait(i, 'insert')
-                if exceed:
-                    raise e
-            else:
-                if result:
-                    self._id = result
-                return
+        try:
+            result = yield with_retry(self.__class__, c, 'insert', db[c].insert,
+                data, write=True, ignore_duplicate_id=client_side_ids, **kwargs)
+        finally:
+            self.objects.set_db(db).invalidate_cache(
+                ids=[self.pk or data.get('_id')])
+        if result:
+            self._id = result
+        yield update_counters(db, self.__class__, new_docs=[data])
 
     @gen.coroutine
     def update(self, db, data, raw=False, **kwargs):
@@ -294,22 +390,160 @@ class BaseModel(SerializationMixin, SchematicsModel):
             data, **kwargs)
         raise gen.Return(result)
 
+    def inc(self, db, data, **kwargs):
+        """
+        Atomically increment fields, both in database and in current instance.
+        Example:
+            yield obj.inc(self.db, {"views": 1})
+        """
+        return self.atomic_update(db, 'inc', data, **kwargs)
+
+    def push(self, db, data, **kwargs):
+        """
+        Append value to ListType field. If list or tuple is given, all its
+        items are appended.
+        """
+        return self.atomic_update(db, 'push', data, **kwargs)
+
+    def add_to_set(self, db, data, **kwargs):
+        return self.atomic_update(db, 'add_to_set', data, **kwargs)
+
+    def pull(self, db, data, **kwargs):
+        return self.atomic_update(db, 'pull', data, **kwargs)
+
+    def pop(self, db, data, **kwargs):
+        """
+        Remove last (value 1) or first (value -1) item of ListType field.
+        """
+        return self.atomic_update(db, 'pop', data, **kwargs)
+
+    def set_on_insert(self, db, data, **kwargs):
+        """
+        Makes sense only with upsert, so it is always used here.
+        """
+        kwargs['upsert'] = True
+        return self.atomic_update(db, 'set_on_insert', data, **kwargs)
+
+    def max(self, db, data, **kwargs):
+        return self.atomic_update(db, 'max', data, **kwargs)
+
+    def min(self, db, data, **kwargs):
+        return self.atomic_update(db, 'min', data, **kwargs)
+
+    @gen.coroutine
+    def atomic_update(self, db, operator, data, **kwargs):
+        """
+        Apply one of ATOMIC_OPERATORS to current document in database and
+        repeat the same change in current instance, so there is no need to
+        read document again.
+        """
+        db = db or self.db
+        if not db:
+            raise NoDBSpecified
+        native_data = self.get_native_data_for_operator(operator, data)
+        result = yield self.objects.set_db(db).update({"_id": self.pk},
+            {ATOMIC_OPERATORS[operator][0]:
+                self.get_data_for_operator(operator, native_data)},
+            **kwargs)
+        if operator != 'set_on_insert' or not result.get('updatedExisting'):
+            self._apply_operator(operator, native_data)
+        raise gen.Return(result)
+
     @classmethod
-    def reconnect_amount(cls):
-        return xrange(cls.RECONNECT_TRIES + 1)
+    def get_native_data_for_operator(cls, operator, data):
+        """
+        Convert values of atomic operator to python objects using fields
+        of this model.
+        """
+        if operator not in ATOMIC_OPERATORS:
+            raise OperationError(u"Unknown atomic operator {0}".format(operator))
+        is_item = ATOMIC_OPERATORS[operator][1]
+        native_data = {}
+        for field_name, value in data.iteritems():
+            field = cls._get_field_for_operator(field_name, is_item)
+            if operator in ('inc', 'pop'):
+                native_data[field_name] = value
+            elif is_item and isinstance(value, (list, tuple)):
+                native_data[field_name] = [cls._to_native_for_operator(field, v)
+                    for v in value]
+            else:
+                native_data[field_name] = \
+                    cls._to_native_for_operator(field, value)
+        return native_data
+
+    @staticmethod
+    def _to_native_for_operator(field, value):
+        if isinstance(field, ModelReferenceType):
+            # instance keeps the same value, that goes to mongo: reference
+            # as id (or snapshot), not referenced model instance
+            value = field_to_mongo(field, value)
+        return field.to_native(value)
 
     @classmethod
-    @gen.coroutine
-    def check_reconnect_tries_and_wait(cls, reconnect_number, func_name):
-        if reconnect_number >= cls.RECONNECT_TRIES:
-            raise gen.Return(True)
-        else:
-            timeout = cls.RECONNECT_TIMEOUT
-            l.warning("ConnectionFailure #{0} in {1}.{2}. Waiting {3} seconds"
-                .format(
-                    reconnect_number + 1, cls.__name__, func_name, timeout))
-            io_loop = ioloop.IOLoop.instance()
-            yield gen.Task(io_loop.add_timeout, timedelta(seconds=timeout))
+    def get_data_for_operator(cls, operator, native_data):
+        """
+        Prepare result of `get_native_data_for_operator` to be send to
+        mongo: field names are replaced with serialized names and values
+        are converted by field's `to_mongo`.
+        """
+        is_item = ATOMIC_OPERATORS[operator][1]
+        data = {}
+        for field_name, value in native_data.iteritems():
+            field = cls._get_field_for_operator(field_name, is_item)
+            key = cls._fields[field_name].serialized_name or field_name
+            if operator in ('inc', 'pop'):
+                data[key] = value
+            elif is_item and isinstance(value, list):
+                values = [field_to_mongo(field, v) for v in value]
+                if operator == 'pull':
+                    data[key] = {"$in": values}
+                else:
+                    data[key] = {"$each": values}
+            else:
+                data[key] = field_to_mongo(field, value)
+        return data
+
+    @classmethod
+    def _get_field_for_operator(cls, field_name, is_item):
+        try:
+            field = cls._fields[field_name]
+        except KeyError:
+            raise OperationError(u"{0} has no field {1}".format(
+                cls.__name__, field_name))
+        if is_item:
+            if not isinstance(field, ListType):
+                raise OperationError(u"{0}.{1} is not a ListType".format(
+                    cls.__name__, field_name))
+            field = field.field
+        return field
+
+    def _apply_operator(self, operator, native_data):
+        for field_name, value in native_data.iteritems():
+            current = self._data.get(field_name)
+            is_many = isinstance(value, list)
+            if operator == 'inc':
+                current = (current or 0) + value
+            elif operator == 'push':
+                current = list(current or []) + (value if is_many else [value])
+            elif operator == 'add_to_set':
+                current = list(current or [])
+                for v in (value if is_many else [value]):
+                    if v not in current:
+                        current.append(v)
+            elif operator == 'pull':
+                values = value if is_many else [value]
+                current = [v for v in current or [] if v not in values]
+            elif operator == 'pop':
+                current = list(current or [])
+                if current:
+                    current.pop(-1 if value > 0 else 0)
+            elif operator == 'set_on_insert':
+                current = value
+            elif operator == 'max':
+                current = value if current is None or value > current else current
+            elif operator == 'min':
+                current = value if current is None or value < current else current
+            self._data[field_name] = current
 
     def get_data_for_save(self, ser=None):
         """
@@ -320,7 +554,7 @@ class BaseModel(SerializationMixin, SchematicsModel):
         return data
 
     @classmethod
-    def _flatten_data(cls, data, nested=None, new_data=None):
+    def _flatten_data(cls, data, prefix='', new_data=None):
         """
         Transforms data with nested dict:
         {
@@ -334,7 +568,8 @@ class BaseModel(SerializationMixin, SchematicsModel):
                 {'k7': 'v7'},
             ]
         }
-        Into flatten data (TODO: flatten dict in list also, can be issues):
+        Into flatten data (dicts in lists are kept as is, use
+        `get_data_for_patch` to address list items):
         {
             'k1': 'v1',
             'k2.k3': 'v3',
@@ -347,22 +582,11 @@ class BaseModel(SerializationMixin, SchematicsModel):
         """
         if new_data is None:
             new_data = {}
-        if nested:
-            nested_data = nested[0]
-            root_key = nested[1]
-            for k, v in nested_data.iteritems():
-                nested_key = ".".join((root_key, k))
-                if isinstance(v, dict):
-                    new_data.update(cls._flatten_data(data, nested=[v, nested_key]))
-                else:
-                    new_data[nested_key] = v
-        else:
-            for k, v in data.iteritems():
-                if isinstance(v, dict):
-                    new_data.update(
-                        cls._flatten_data(data, nested=[v, k], new_data=new_data))
-                else:
-                    new_data[k] = v
+        for k, v in data.iteritems():
+            if isinstance(v, dict):
+                cls._flatten_data(v, prefix + k + '.', new_data)
+            else:
+                new_data[prefix + k] = v
         return new_data
 
     @classmethod
@@ -371,11 +595,27 @@ class BaseModel(SerializationMixin, SchematicsModel):
             data = cls._flatten_data(data)
         return data
 
+    @classmethod
+    def get_data_for_patch(cls, raw_data):
+        """
+        Validated update document for partial raw data, see
+        `transforms.patch_to_mongo`. Returns None, if there is nothing
+        to update.
+        """
+        set_data, unset_data = patch_to_mongo(cls, raw_data)
+        data = {}
+        if set_data:
+            data["$set"] = set_data
+        if unset_data:
+            data["$unset"] = unset_data
+        return data or None
+
     @classmethod
     def register_delete_rule(cls, cls_tobe_deleted, field_name, rule):
         delete_rules = getattr(cls._options, 'delete_rules', {})
         delete_rules[(cls_tobe_deleted, field_name)] = rule
         cls._options.delete_rules = delete_rules
+        reset_delete_rules_graph()
 
     @classmethod
     @gen.coroutine
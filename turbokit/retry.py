@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+import time
+import random
+import logging
+from datetime import timedelta
+from tornado import gen, ioloop
+from pymongo.errors import ConnectionFailure, OperationFailure, DuplicateKeyError
+from .errors import CircuitOpen, LimitExceeded
+from .concurrency import get_concurrency_limiter
+
+l = logging.getLogger(__name__)
+
+# Server errors, that happen while replica set elects new primary
+RETRYABLE_CODES = frozenset([
+    91,  # ShutdownInProgress
+    189,  # PrimarySteppedDown
+    10107,  # NotMaster
+    11600,  # InterruptedAtShutdown
+    11602,  # InterruptedDueToReplStateChange
+    13435,  # NotMasterNoSlaveOk
+    13436,  # NotMasterOrSecondary
+])
+
+
+class RetryPolicy(object):
+    """
+    Describes, how database operation is retried:
+    exponential backoff (`base_delay` * `multiplier` ** attempt, but not
+    more than `max_delay`) with random `jitter` part, at most
+    `max_retries` retries and no retry, that would end after `deadline`
+    seconds since the first attempt.
+
+    Writes are retried only with `retry_writes=True`: after ambiguous
+    network error `$inc` or `$push` could be applied twice.
+
+    Declare it in model Options to override the default one:
+
+        class Options:
+            retry_policy = RetryPolicy(max_retries=2, deadline=1)
+    """
+
+    def __init__(self, max_retries=5, base_delay=0.1, max_delay=2,
+            multiplier=2, jitter=0.5, deadline=5, retry_writes=False,
+            retryable_errors=(ConnectionFailure,),
+            retryable_codes=RETRYABLE_CODES):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.deadline = deadline
+        self.retry_writes = retry_writes
+        self.retryable_errors = tuple(retryable_errors)
+        self.retryable_codes = frozenset(retryable_codes)
+
+    def is_retryable(self, exc, write=False):
+        if write and not self.retry_writes:
+            return False
+        if isinstance(exc, (CircuitOpen, LimitExceeded)):
+            return False
+        if isinstance(exc, self.retryable_errors):
+            return True
+        if isinstance(exc, OperationFailure):
+            return exc.code in self.retryable_codes
+        return False
+
+    def get_delay(self, attempt):
+        delay = min(self.max_delay, self.base_delay * self.multiplier ** attempt)
+        return delay * (1 - self.jitter * random.random())
+
+
+class NoRetryPolicy(RetryPolicy):
+    def __init__(self):
+        super(NoRetryPolicy, self).__init__(max_retries=0)
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+# deprecated: retries, configured by model attributes before RetryPolicy
+RECONNECT_TRIES = 5
+RECONNECT_TIMEOUT = 2  # in seconds
+
+
+def is_duplicate_id_error(exc):
+    return isinstance(exc, DuplicateKeyError) and '_id_' in str(exc)
+
+
+class CircuitBreaker(object):
+    """
+    Stops sending operations to collection after `failure_threshold`
+    retryable failures in a row: during next `reset_timeout` seconds
+    `CircuitOpen` is raised immediately. After that one trial operation
+    is let through, its result closes or opens the circuit again.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=5):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_progress = False
+        self.rejected = 0
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return self.CLOSED
+        if time.time() - self.opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def before_call(self):
+        state = self.state
+        if state == self.CLOSED:
+            return
+        if state == self.HALF_OPEN and not self.trial_in_progress:
+            self.trial_in_progress = True
+            return
+        self.rejected += 1
+        raise CircuitOpen(u"Circuit for {0} is open, {1} failures in a row"
+            .format(self.name, self.failures))
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_progress = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.trial_in_progress or self.failures >= self.failure_threshold:
+            if self.opened_at is None or self.trial_in_progress:
+                l.warning("Circuit for {0} is opened after {1} failures".format(
+                    self.name, self.failures))
+            self.opened_at = time.time()
+            self.trial_in_progress = False
+
+    def release(self):
+        """Trial operation finished with not retryable error"""
+        self.trial_in_progress = False
+
+
+DEFAULT_CIRCUIT_BREAKER = {'failure_threshold': 5, 'reset_timeout': 5}
+_circuit_breakers = {}
+
+
+_legacy_retry_policies = {}
+
+
+def get_retry_policy(cls):
+    """
+    Policy from model Options. Models, that still override deprecated
+    RECONNECT_TRIES or RECONNECT_TIMEOUT, get policy with the same number
+    of retries and fixed delay, that retries writes too (as before).
+    """
+    policy = getattr(cls._options, 'retry_policy', None)
+    if policy is not None:
+        return policy
+    tries = getattr(cls, 'RECONNECT_TRIES', RECONNECT_TRIES)
+    timeout = getattr(cls, 'RECONNECT_TIMEOUT', RECONNECT_TIMEOUT)
+    if (tries, timeout) == (RECONNECT_TRIES, RECONNECT_TIMEOUT):
+        return DEFAULT_RETRY_POLICY
+    key = (tries, timeout)
+    policy = _legacy_retry_policies.get(key)
+    if policy is None:
+        policy = _legacy_retry_policies.setdefault(key, RetryPolicy(
+            max_retries=tries, base_delay=timeout, max_delay=timeout,
+            multiplier=1, jitter=0, deadline=float('inf'), retry_writes=True))
+    return policy
+
+
+def get_circuit_breaker(cls, collection):
+    """
+    Circuit breaker is shared by all models, that use the collection.
+    Set `circuit_breaker = None` in model Options to disable it, or dict
+    with CircuitBreaker arguments to configure.
+    """
+    settings = getattr(cls._options, 'circuit_breaker', DEFAULT_CIRCUIT_BREAKER)
+    if not settings:
+        return None
+    breaker = _circuit_breakers.get(collection)
+    if breaker is None:
+        breaker = _circuit_breakers.setdefault(collection,
+            CircuitBreaker(collection, **settings))
+    return breaker
+
+
+@gen.coroutine
+def with_retry(cls, collection, operation, func, *args, **kwargs):
+    """
+    Call `func` (it must start new operation and return its future on
+    every call) according to retry policy and circuit breaker of `cls`.
+    Pass write=True for operations, that modify data.
+    With ignore_duplicate_id=True duplicate key error on `_id` during retry
+    means, that previous attempt has reached the server, so it is treated
+    as success and None is returned (inserts with client side ids).
+    Such writes and writes with idempotent=True (full replace by `_id`)
+    have the same result, when applied twice, so they are retried even
+    without `retry_writes`.
+    """
+    write = kwargs.pop('write', False)
+    ignore_duplicate_id = kwargs.pop('ignore_duplicate_id', False)
+    idempotent = kwargs.pop('idempotent', False) or ignore_duplicate_id
+    policy = get_retry_policy(cls)
+    breaker = get_circuit_breaker(cls, collection)
+    limiter = get_concurrency_limiter(cls, collection)
+    deadline = time.time() + policy.deadline
+    attempt = 0
+    while True:
+        if breaker:
+            breaker.before_call()
+        try:
+            if limiter:
+                result = yield limiter.run(func, *args, **kwargs)
+            else:
+                result = yield func(*args, **kwargs)
+        except Exception as e:
+            if attempt > 0 and ignore_duplicate_id and is_duplicate_id_error(e):
+                l.info("{0}.{1}: documents were inserted by previous attempt"
+                    .format(cls.__name__, operation))
+                if breaker:
+                    breaker.record_success()
+                raise gen.Return(None)
+            if not policy.is_retryable(e, write=write and not idempotent):
+                if breaker:
+                    breaker.release()
+                raise
+            if breaker:
+                breaker.record_failure()
+            delay = policy.get_delay(attempt)
+            if attempt >= policy.max_retries or time.time() + delay > deadline \
+                    or (breaker and breaker.state == breaker.OPEN):
+                raise
+            attempt += 1
+            l.warning("{0} #{1} in {2}.{3}. Waiting {4:.2f} seconds".format(
+                e.__class__.__name__, attempt, cls.__name__, operation, delay))
+            yield gen.Task(ioloop.IOLoop.current().add_timeout,
+                timedelta(seconds=delay))
+        else:
+            if breaker:
+                breaker.record_success()
+            raise gen.Return(result)
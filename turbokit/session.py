@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+from tornado import gen
+from schematics.types.compound import ListType
+from .types import ModelReferenceType
+from .errors import NoDBSpecified
+from .retry import with_retry
+from .signals import pre_save, post_save, pre_bulk_save, post_bulk_save
+from .snapshots import fill_snapshots, schedule_propagation
+from .counters import get_counter_caches, counter_fields, update_counters
+
+
+def referenced_models(cls):
+    """Models, referenced by fields of `cls`"""
+    models = set()
+    for field in cls._fields.itervalues():
+        field = field.field if isinstance(field, ListType) else field
+        if isinstance(field, ModelReferenceType):
+            models.add(field.model_class)
+    return models
+
+
+def dependency_order(models):
+    """
+    `models` ordered so, that referenced models go before models, that
+    refer to them. Models of reference cycles keep the given order.
+    """
+    models = list(models)
+    ordered, visiting = [], set()
+
+    def visit(cls):
+        if cls in ordered or cls in visiting:
+            return
+        visiting.add(cls)
+        for ref in referenced_models(cls):
+            if ref in models:
+                visit(ref)
+        visiting.discard(cls)
+        ordered.append(cls)
+    for cls in models:
+        visit(cls)
+    return ordered
+
+
+class Session(object):
+    """
+    Unit of work: collects new, changed and removed instances, then
+    `flush` writes them with one bulk operation per model and kind of
+    change, instead of a round trip per instance:
+
+        session = Session(db)
+        session.add(post)  # new instance, inserted
+        session.add(user)  # loaded instance, replaced if it was changed
+        session.remove(comment)
+        yield session.flush()
+
+    Models are inserted and updated in order of references (referenced
+    first), removed in reverse order. Batch signals are sent per model:
+    pre/post_bulk_insert, pre/post_bulk_save (changed instances) and
+    pre/post_bulk_remove; with `document_signals=True` pre_save/post_save
+    are sent for every written instance too.
+    """
+
+    def __init__(self, db=None, document_signals=False):
+        self.db = db
+        self.document_signals = document_signals
+        self._added = []
+        self._removed = []
+
+    def add(self, instance):
+        """Insert `instance` (if it has no id) or save its changes on flush"""
+        if not self._contains(self._added, instance):
+            self._discard(self._removed, instance)
+            self._added.append(instance)
+
+    def add_all(self, instances):
+        for instance in instances:
+            self.add(instance)
+
+    def remove(self, instance):
+        if not self._contains(self._removed, instance):
+            self._discard(self._added, instance)
+            self._removed.append(instance)
+
+    def __contains__(self, instance):
+        return self._contains(self._added, instance) \
+            or self._contains(self._removed, instance)
+
+    @staticmethod
+    def _contains(instances, instance):
+        return any(i is instance for i in instances)
+
+    @staticmethod
+    def _discard(instances, instance):
+        instances[:] = [i for i in instances if i is not instance]
+
+    @property
+    def new(self):
+        return [i for i in self._added if i.pk is None]
+
+    @property
+    def dirty(self):
+        """Instances with id, that are written, if they were changed"""
+        return [i for i in self._added if i.pk is not None]
+
+    @property
+    def removed(self):
+        return list(self._removed)
+
+    def clear(self):
+        self._added = []
+        self._removed = []
+
+    def get_manager(self, cls):
+        manager = cls.objects.set_db(self.db) if self.db else cls.objects
+        if manager.db is None:
+            raise NoDBSpecified
+        return manager
+
+    @gen.coroutine
+    def flush(self):
+        """
+        Write all collected changes, returns amount of inserted, updated,
+        removed and skipped (unchanged) instances
+        """
+        stats = {'inserted': 0, 'updated': 0, 'removed': 0, 'skipped': 0}
+        new, dirty = self.new, self.dirty
+        for instance in new + dirty:
+            instance.validate()
+        # ids are known before writes, so new instances can refer each other
+        for instance in new:
+            instance.assign_id()
+        new_ids = set(id(i) for i in new)
+        by_model = self._group(new + dirty)
+        for cls in dependency_order(by_model):
+            manager = self.get_manager(cls)
+            instances = by_model[cls]
+            to_insert = [i for i in instances if id(i) in new_ids]
+            if to_insert:
+                yield manager.insert(to_insert,
+                    document_signals=self.document_signals)
+                for instance in to_insert:
+                    instance._initial = instance.get_data_for_save()
+                stats['inserted'] += len(to_insert)
+            updated = yield self._save_changed(manager,
+                [i for i in instances if id(i) not in new_ids])
+            stats['updated'] += updated
+            stats['skipped'] += len(instances) - len(to_insert) - updated
+        removed = self._group([i for i in self._removed if i.pk is not None])
+        for cls in reversed(dependency_order(removed)):
+            instances = removed[cls]
+            yield self.get_manager(cls).remove(
+                {'_id': {'$in': [i.pk for i in instances]}}, instances)
+            stats['removed'] += len(instances)
+        self.clear()
+        raise gen.Return(stats)
+
+    @staticmethod
+    def _group(instances):
+        by_model = {}
+        for instance in instances:
+            by_model.setdefault(instance.__class__, []).append(instance)
+        return by_model
+
+    @gen.coroutine
+    def _save_changed(self, manager, instances):
+        """
+        Replace changed documents of one model with one bulk operation,
+        returns amount of replaced documents
+        """
+        cls, db, collection = manager.cls, manager.db, manager.collection
+        yield fill_snapshots(db, instances)
+        changed = []
+        for instance in instances:
+            data = instance.get_data_for_save()
+            if data != instance._initial:
+                changed.append((instance, data))
+        if not changed:
+            raise gen.Return(0)
+        documents = [instance for instance, _ in changed]
+        if pre_bulk_save.has_receivers(cls):
+            yield pre_bulk_save.send(cls, documents=documents)
+        if self.document_signals and pre_save.has_receivers(cls):
+            for instance in documents:
+                yield pre_save.send(cls, document=instance)
+        # receivers of pre signals could change documents
+        changed = [(instance, instance.get_data_for_save())
+            for instance in documents]
+        ids = [instance.pk for instance in documents]
+        old_docs = []
+        if get_counter_caches(cls):
+            # previous references are needed to update counters
+            old_docs = yield with_retry(cls, collection, 'session',
+                lambda: db[collection].find({'_id': {'$in': ids}},
+                    fields=counter_fields(cls)).to_list(None))
+
+        def execute():
+            bulk = db[collection].initialize_unordered_bulk_op()
+            for instance, data in changed:
+                bulk.find({'_id': instance.pk}).upsert().replace_one(data)
+            return bulk.execute()
+        try:
+            yield with_retry(cls, collection, 'session', execute, write=True,
+                idempotent=True)
+        finally:
+            manager.invalidate_cache(ids=ids)
+        yield update_counters(db, cls, old_docs, [d for _, d in changed])
+        for instance, data in changed:
+            schedule_propagation(db, instance, data)
+            instance._initial = data
+        if self.document_signals and post_save.has_receivers(cls):
+            for instance in documents:
+                yield post_save.send(cls, document=instance)
+        if post_bulk_save.has_receivers(cls):
+            yield post_bulk_save.send(cls, documents=documents)
+        raise gen.Return(len(changed))
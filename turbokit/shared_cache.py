@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+import os
+import hmac
+import time
+import logging
+from datetime import timedelta
+from collections import defaultdict
+from tornado import ioloop
+from multiprocessing import current_process, AuthenticationError
+from multiprocessing.connection import (Client, CHALLENGE, WELCOME, FAILURE,
+    MESSAGE_LENGTH)
+from multiprocessing.managers import BaseManager, convert_to_error
+from .cache import CacheStorage, LRUCache
+
+l = logging.getLogger(__name__)
+
+
+class CacheTimeout(Exception):
+    pass
+
+# calls, that drop cached data; when they are lost, other processes can
+# serve stale data, so all caches are cleared after reconnection
+INVALIDATIONS = frozenset(['delete', 'clear', 'bump_generation'])
+
+# errors of connection to cache server, caches degrade to misses on them
+CONNECTION_ERRORS = (EnvironmentError, EOFError, AuthenticationError,
+    CacheTimeout)
+
+
+class CacheServer(object):
+    """Storages and generations, kept in the cache server process"""
+
+    def __init__(self):
+        self.storages = {}
+        self.generations = defaultdict(int)
+
+    def create(self, name, max_size, ttl):
+        if name not in self.storages:
+            self.storages[name] = LRUCache(max_size=max_size, ttl=ttl)
+
+    def get(self, name, key, default=None):
+        return self.storages[name].get(key, default)
+
+    def set(self, name, key, value):
+        self.storages[name].set(key, value)
+
+    def delete(self, name, key):
+        self.storages[name].delete(key)
+
+    def clear(self, name):
+        self.storages[name].clear()
+
+    def stats(self, name):
+        return self.storages[name].stats
+
+    def clear_all(self):
+        for storage in self.storages.itervalues():
+            storage.clear()
+
+    def get_generation(self, collection):
+        return self.generations[collection]
+
+    def bump_generation(self, collection):
+        self.generations[collection] += 1
+        return self.generations[collection]
+
+
+_server = None
+
+
+def _get_server():
+    global _server
+    if _server is None:
+        _server = CacheServer()
+    return _server
+
+
+class CacheManager(BaseManager):
+    pass
+
+CacheManager.register('get_server', callable=_get_server)
+
+
+def start_cache_server(address, authkey=None):
+    """
+    Start cache server process, listening on Unix socket `address`.
+    Returns CacheManager, call its `shutdown()` to stop the server.
+    """
+    if os.path.exists(address):
+        os.unlink(address)
+    manager = CacheManager(address=address,
+        authkey=authkey or current_process().authkey)
+    manager.start()
+    return manager
+
+
+class ServerConnection(object):
+    """
+    Connection to CacheServer object of cache server. Speaks protocol of
+    multiprocessing managers, but every receive waits at most `timeout`
+    seconds, so hung server can't block the IOLoop.
+    """
+
+    def __init__(self, address, authkey, timeout):
+        self.timeout = timeout
+        conn = self._connect(address, authkey)
+        try:
+            # one request per connection: the server creates the object
+            self.id, _ = self._request(conn,
+                (None, 'create', ('get_server',), {}))
+        finally:
+            conn.close()
+        self.conn = self._connect(address, authkey)
+        try:
+            self._request(self.conn,
+                (None, 'accept_connection', ('turbokit',), {}))
+        except BaseException:
+            self.conn.close()
+            raise
+
+    def _connect(self, address, authkey):
+        conn = Client(address)
+        try:
+            self._answer_challenge(conn, authkey)
+            self._deliver_challenge(conn, authkey)
+        except BaseException:
+            conn.close()
+            raise
+        return conn
+
+    def _recv_bytes(self, conn):
+        if not conn.poll(self.timeout):
+            raise CacheTimeout("No answer in {0}s".format(self.timeout))
+        return conn.recv_bytes(256)
+
+    def _answer_challenge(self, conn, authkey):
+        message = self._recv_bytes(conn)
+        if not message.startswith(CHALLENGE):
+            raise AuthenticationError("Unexpected challenge")
+        conn.send_bytes(hmac.new(authkey, message[len(CHALLENGE):]).digest())
+        if self._recv_bytes(conn) != WELCOME:
+            raise AuthenticationError("Digest was rejected")
+
+    def _deliver_challenge(self, conn, authkey):
+        message = os.urandom(MESSAGE_LENGTH)
+        conn.send_bytes(CHALLENGE + message)
+        if self._recv_bytes(conn) != hmac.new(authkey, message).digest():
+            conn.send_bytes(FAILURE)
+            raise AuthenticationError("Digest received was wrong")
+        conn.send_bytes(WELCOME)
+
+    def _request(self, conn, request):
+        conn.send(request)
+        if not conn.poll(self.timeout):
+            raise CacheTimeout("No answer in {0}s".format(self.timeout))
+        kind, result = conn.recv()
+        if kind != '#RETURN':
+            raise convert_to_error(kind, result)
+        return result
+
+    def call(self, method, *args):
+        return self._request(self.conn, (self.id, method, args, {}))
+
+    def close(self):
+        self.conn.close()
+
+
+class SharedStorage(CacheStorage):
+    def __init__(self, backend, name):
+        self.backend = backend
+        self.name = name
+
+    def get(self, key, default=None):
+        return self.backend.call('get', self.name, key, default, default=default)
+
+    def set(self, key, value):
+        self.backend.call('set', self.name, key, value)
+
+    def delete(self, key):
+        self.backend.call('delete', self.name, key)
+
+    def clear(self):
+        self.backend.call('clear', self.name)
+
+    @property
+    def stats(self):
+        return self.backend.call('stats', self.name, default={})
+
+
+class SharedCacheBackend(object):
+    """
+    Backend, that keeps caches in cache server. Connection is opened
+    lazily and reopened in forked process, so backend can be set before
+    `fork_processes`. Calls are synchronous and go over local socket, but
+    wait for the server at most `timeout` seconds. If server is unavailable
+    or doesn't answer in time, caches behave as empty, and the server
+    isn't called again for `retry_interval` seconds. Invalidations can't
+    be lost silently: if any of them failed, all caches of the server are
+    cleared as soon as it is available again.
+    """
+
+    def __init__(self, address, authkey=None, timeout=0.05, retry_interval=5):
+        self.address = address
+        self.authkey = authkey or current_process().authkey
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self._server = None
+        self._pid = None
+        self._storages = []
+        self._unavailable_until = 0
+        self._invalidations_lost = False
+        self._recovery_scheduled = False
+
+    @property
+    def server(self):
+        if self._server is None or self._pid != os.getpid():
+            self._server = ServerConnection(self.address, self.authkey,
+                self.timeout)
+            self._pid = os.getpid()
+            for args in self._storages:
+                self._server.call('create', *args)
+        return self._server
+
+    @property
+    def available(self):
+        return time.time() >= self._unavailable_until
+
+    def call(self, method, *args, **kwargs):
+        if self.available:
+            try:
+                self._clear_lost()
+                return self.server.call(method, *args)
+            except CONNECTION_ERRORS as e:
+                self._fail(e)
+        if method in INVALIDATIONS:
+            self._invalidations_lost = True
+            self._schedule_recovery()
+        return kwargs.get('default')
+
+    def _clear_lost(self):
+        if self._invalidations_lost:
+            self.server.call('clear_all')
+            self._invalidations_lost = False
+            l.warning("Caches of server {0} are cleared after lost "
+                "invalidations".format(self.address))
+
+    def _schedule_recovery(self):
+        """Clear caches after retry interval, even if no calls are made"""
+        if not self._recovery_scheduled:
+            self._recovery_scheduled = True
+            ioloop.IOLoop.current().add_timeout(
+                timedelta(seconds=self.retry_interval), self._recover)
+
+    def _recover(self):
+        self._recovery_scheduled = False
+        if self._invalidations_lost and self.available:
+            try:
+                self._clear_lost()
+            except CONNECTION_ERRORS as e:
+                self._fail(e)
+        if self._invalidations_lost:
+            self._schedule_recovery()
+
+    def _fail(self, error):
+        l.warning("Cache server {0} is unavailable: {1}".format(
+            self.address, error))
+        self._reset()
+        self._unavailable_until = time.time() + self.retry_interval
+
+    def _reset(self):
+        # connection is out of sync after timeout, late answer is dropped
+        if self._server is not None and self._pid == os.getpid():
+            self._server.close()
+        self._server = None
+
+    def create_storage(self, name, max_size=1000, ttl=60):
+        self._storages.append((name, max_size, ttl))
+        self.call('create', name, max_size, ttl)
+        return SharedStorage(self, name)
+
+    def get_generation(self, collection):
+        return self.call('get_generation', collection, default=0)
+
+    def bump_generation(self, collection):
+        self.call('bump_generation', collection)
@@ -1,14 +1,35 @@
 # -*- coding: utf-8 -*-
-from blinker import Namespace as BlinkerNamespace, Signal as BlinkerSignal
-from blinker._utilities import lazy_property
+from blinker import Namespace as BlinkerNamespace, Signal as BlinkerSignal, ANY
+from itertools import count
+from blinker.base import ANY_ID, WeakTypes
+from blinker._utilities import lazy_property, hashable_identity
 from tornado import gen
+from .errors import SignalError
+from .concurrency import DeferredQueue
 
 
 class AsyncSignal(BlinkerSignal):
     """
     Copy of blinker.Signal, but call receivers in async mode.
     Asserted that all receivers are wrapped with tornado.gen.coroutine
+
+    Receivers are called in order of their priority (higher first).
+    With `concurrent=True` receivers of the same priority run in parallel,
+    next priority group starts, when the previous one is finished.
+
+    Receivers, connected with `deferred=True`, are not awaited: the call
+    is put into deferred queue (see `set_deferred_queue`) and executed
+    in background, its result is None.
     """
+    def __init__(self, doc=None, concurrent=False):
+        super(AsyncSignal, self).__init__(doc)
+        self.concurrent = concurrent
+        self._priorities = {}
+        self._deferred = set()
+        self._connections = count()
+        # sender id: receiver ids grouped by priority
+        self._groups_cache = {}
+
     @lazy_property
     def receiver_connected(self):
         raise NotImplementedError()
@@ -17,12 +38,82 @@ class AsyncSignal(BlinkerSignal):
     def receiver_disconnected(self):
         raise NotImplementedError()
 
+    def connect(self, receiver, sender=ANY, weak=True, priority=0,
+            deferred=False):
+        """
+        The same as blinker.Signal.connect, `priority` defines order of
+        receivers, receivers of one priority are independent.
+        """
+        receiver_id = hashable_identity(receiver)
+        self._priorities[receiver_id] = (priority, next(self._connections))
+        if deferred:
+            self._deferred.add(receiver_id)
+        else:
+            self._deferred.discard(receiver_id)
+        self._groups_cache = {}
+        return super(AsyncSignal, self).connect(receiver, sender=sender,
+            weak=weak)
+
+    def _disconnect(self, receiver_id, sender_id):
+        super(AsyncSignal, self)._disconnect(receiver_id, sender_id)
+        self._groups_cache = {}
+        if sender_id == ANY_ID:
+            self._priorities.pop(receiver_id, None)
+            self._deferred.discard(receiver_id)
+
+    def _cleanup_sender(self, sender_ref):
+        super(AsyncSignal, self)._cleanup_sender(sender_ref)
+        self._groups_cache = {}
+
+    def has_receivers(self, sender):
+        """
+        True if some receivers are connected for `sender`. It is cheap, so
+        `send` can be skipped, when nothing would be called.
+        """
+        return bool(self.receivers) and bool(self._receiver_id_groups(sender))
+
+    def _receiver_id_groups(self, sender):
+        """
+        Ids of receivers for `sender`, grouped by priority (higher first),
+        in order of connection. Cached until receivers are changed.
+        """
+        sender_id = hashable_identity(sender)
+        groups = self._groups_cache.get(sender_id)
+        if groups is None:
+            ids = self._by_sender.get(ANY_ID, set()) \
+                | self._by_sender.get(sender_id, set())
+            by_priority = {}
+            for receiver_id in ids:
+                priority, seq = self._priorities.get(receiver_id, (0, 0))
+                by_priority.setdefault(priority, []).append((seq, receiver_id))
+            groups = [[i for _, i in sorted(by_priority[p])]
+                for p in sorted(by_priority, reverse=True)]
+            self._groups_cache[sender_id] = groups
+        return groups
+
+    def priority_groups(self, sender):
+        """Live receivers for `sender`, grouped by priority, higher first"""
+        result = []
+        for ids in self._receiver_id_groups(sender):
+            group = []
+            for receiver_id in ids:
+                receiver = self.receivers.get(receiver_id)
+                if isinstance(receiver, WeakTypes):
+                    receiver = receiver()
+                    if receiver is None:
+                        self._disconnect(receiver_id, ANY_ID)
+                if receiver is not None:
+                    group.append(receiver)
+            if group:
+                result.append(group)
+        return result
+
     @gen.coroutine
     def send(self, *sender, **kwargs):
         """Emit this signal on behalf of *sender*, passing on \*\*kwardf.
 
         Returns a list of 2-tuples, pairing receivers with their return
-        value. The ordering of receiver notification is undefined.
+        value. Receivers are notified in order of their priority.
 
         :param \*sender: Any object or ``None``.  If omitted, synonymous
           with ``None``.  Only accepts one positional argument.
@@ -40,21 +131,53 @@ class AsyncSignal(BlinkerSignal):
                             '%s given' % len(sender))
         else:
             sender = sender[0]
-        if not self.receivers:
-            results = []
-        else:
-            results = []
-            for receiver in self.receivers_for(sender):
-                result = yield receiver(sender, **kwargs)
-                results.append((receiver, result))
+        results = []
+        if self.receivers:
+            for group in self.priority_groups(sender):
+                if self.concurrent and len(group) > 1:
+                    yield self._send_concurrently(group, sender, kwargs,
+                        results)
+                    continue
+                for receiver in group:
+                    result = yield self._call(receiver, sender, kwargs)
+                    results.append((receiver, result))
         raise gen.Return(results)
 
+    def _call(self, receiver, sender, kwargs):
+        """Future of receiver call, deferred one resolves to None"""
+        if self._deferred and hashable_identity(receiver) in self._deferred:
+            return get_deferred_queue().put(receiver, sender, **kwargs)
+        return receiver(sender, **kwargs)
+
+    @gen.coroutine
+    def _send_concurrently(self, receivers, sender, kwargs, results):
+        """
+        Run receivers in parallel and wait for all of them. Failures are
+        raised together as SignalError.
+        """
+        @gen.coroutine
+        def call(receiver):
+            try:
+                result = yield self._call(receiver, sender, kwargs)
+            except Exception as e:
+                raise gen.Return((receiver, None, e))
+            raise gen.Return((receiver, result, None))
+        errors = []
+        outcomes = yield [call(r) for r in receivers]
+        for receiver, result, error in outcomes:
+            if error is None:
+                results.append((receiver, result))
+            else:
+                errors.append((receiver, error))
+        if errors:
+            raise SignalError(self, errors, results)
+
 
 class AsyncNamedSignal(AsyncSignal):
     """Copy of blinker.NamedSignal, but use AsyncSignal"""
 
-    def __init__(self, name, doc=None):
-        AsyncSignal.__init__(self, doc)
+    def __init__(self, name, doc=None, concurrent=False):
+        AsyncSignal.__init__(self, doc, concurrent=concurrent)
 
         #: The name of this signal.
         self.name = name
@@ -67,7 +190,7 @@ class AsyncNamedSignal(AsyncSignal):
 class AsyncNamespace(BlinkerNamespace):
     """Copy of blinker.Namespace, but use AsyncNamedSignal"""
 
-    def signal(self, name, doc=None):
+    def signal(self, name, doc=None, concurrent=False):
         """Return the :class:`AsyncNamedSignal` *name*, creating it if required.
 
         Repeated calls to this function will return the same signal object.
@@ -76,7 +199,28 @@ class AsyncNamespace(BlinkerNamespace):
         try:
             return self[name]
         except KeyError:
-            return self.setdefault(name, AsyncNamedSignal(name, doc))
+            return self.setdefault(name, AsyncNamedSignal(name, doc,
+                concurrent=concurrent))
+
+
+_deferred_queue = None
+
+
+def get_deferred_queue():
+    """Queue of deferred receivers, created on first use"""
+    global _deferred_queue
+    if _deferred_queue is None:
+        _deferred_queue = DeferredQueue()
+    return _deferred_queue
+
+
+def set_deferred_queue(queue):
+    """
+    Use `queue` (turbokit.concurrency.DeferredQueue) for deferred
+    receivers. Calls, left in the previous queue, are not moved.
+    """
+    global _deferred_queue
+    _deferred_queue = queue
 
 
 _signals = AsyncNamespace()
@@ -85,3 +229,13 @@ pre_save = _signals.signal('pre_save')
 post_save = _signals.signal('post_save')
 pre_remove = _signals.signal('pre_remove')
 post_remove = _signals.signal('post_remove')
+# sent once per AsyncManager.insert/remove/update call
+pre_bulk_insert = _signals.signal('pre_bulk_insert')
+post_bulk_insert = _signals.signal('post_bulk_insert')
+pre_bulk_remove = _signals.signal('pre_bulk_remove')
+post_bulk_remove = _signals.signal('post_bulk_remove')
+pre_bulk_update = _signals.signal('pre_bulk_update')
+post_bulk_update = _signals.signal('post_bulk_update')
+# sent by turbokit.session.Session for changed documents
+pre_bulk_save = _signals.signal('pre_bulk_save')
+post_bulk_save = _signals.signal('post_bulk_save')
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+import logging
+from tornado import gen
+from schematics.types.compound import ListType
+from .types import ModelReferenceType, SnapshotObjectId
+from .retry import with_retry
+from .connections import get_related_database
+
+l = logging.getLogger(__name__)
+
+# propagations, running in background
+_pending = set()
+
+
+class SnapshotReference(object):
+    """Field of `model`, that stores snapshot of referenced document"""
+
+    def __init__(self, model, field_name, db_field, ref_field, is_list):
+        self.model = model
+        self.field_name = field_name
+        self.db_field = db_field
+        self.ref_field = ref_field
+        self.is_list = is_list
+
+    @property
+    def target(self):
+        return self.ref_field.model_class
+
+    @property
+    def names(self):
+        return self.ref_field.snapshot
+
+
+def snapshot_references(cls):
+    """Snapshot references, declared by fields of `cls`"""
+    references = []
+    for field_name, field in cls._fields.iteritems():
+        is_list = isinstance(field, ListType)
+        ref_field = field.field if is_list else field
+        if isinstance(ref_field, ModelReferenceType) \
+                and getattr(ref_field, 'snapshot', None):
+            references.append(SnapshotReference(cls, field_name,
+                field.serialized_name or field_name, ref_field, is_list))
+    return references
+
+
+def get_snapshot_references(cls):
+    return getattr(cls._options, 'snapshot_references', [])
+
+
+def get_snapshot_referrers(cls):
+    """Snapshot references of other models, that point to `cls`"""
+    return getattr(cls._options, 'snapshot_referrers', [])
+
+
+def reference_key(cls, field_name):
+    """Key to query by id of referenced document"""
+    for ref in get_snapshot_references(cls):
+        if ref.field_name == field_name or ref.db_field == field_name:
+            return ref.db_field + '._id'
+    return field_name
+
+
+def reference_id(value):
+    """Id of referenced document from raw value: id or snapshot"""
+    if isinstance(value, dict) and '_id' in value:
+        return value['_id']
+    return value
+
+
+def process_reference_query(cls, query):
+    """
+    Replace lookups by snapshot references {'user': id} with lookups by
+    id of the snapshot {'user._id': id}
+    """
+    for ref in get_snapshot_references(cls):
+        if ref.db_field not in query:
+            continue
+        value = query[ref.db_field]
+        if isinstance(value, dict) \
+                and not all(k.startswith('$') for k in value):
+            continue  # lookup by entire subdocument
+        if hasattr(value, 'pk'):
+            value = value.pk
+        del query[ref.db_field]
+        query[ref.db_field + '._id'] = value
+    return query
+
+
+@gen.coroutine
+def fill_snapshots(db, instances):
+    """
+    Load snapshots for references of `instances`, that are given as ids
+    without snapshot, with one query per field.
+    """
+    if not instances:
+        return
+    for ref in get_snapshot_references(instances[0].__class__):
+        ids = set()
+        for instance in instances:
+            for value in _values(ref, instance):
+                if _needs_snapshot(value):
+                    ids.add(value)
+        if not ids:
+            continue
+        target = ref.target
+        fields = dict(((target._fields[name].serialized_name or name), True)
+            for name in ref.names)
+        collection = target._options.namespace
+        target_db = get_related_database(target, db)
+        docs = yield with_retry(target, collection, 'snapshot',
+            lambda: target_db[collection].find({'_id': {'$in': list(ids)}},
+                fields=fields).to_list(None))
+        snapshots = {}
+        for doc in docs:
+            snapshots[doc['_id']] = dict((name,
+                doc.get(target._fields[name].serialized_name or name))
+                for name in ref.names)
+
+        def with_snapshot(value):
+            if _needs_snapshot(value) and value in snapshots:
+                return SnapshotObjectId(value, snapshots[value])
+            return value
+        for instance in instances:
+            value = getattr(instance, ref.field_name)
+            if ref.is_list and value:
+                setattr(instance, ref.field_name, map(with_snapshot, value))
+            elif not ref.is_list:
+                setattr(instance, ref.field_name, with_snapshot(value))
+
+
+def _values(ref, instance):
+    value = getattr(instance, ref.field_name)
+    if ref.is_list:
+        return value or []
+    return [value]
+
+
+def _needs_snapshot(value):
+    return value is not None and not isinstance(value, SnapshotObjectId) \
+        and not hasattr(value, 'pk')
+
+
+def changed_snapshot_values(instance, data):
+    """
+    {referrer: values of its snapshot fields}, that must be propagated
+    after `instance` is saved as raw `data`. Referrers, whose snapshot
+    fields have the same values as the loaded document had, are skipped.
+    """
+    changes = {}
+    initial = getattr(instance, '_initial', None) or {}
+    for ref in get_snapshot_referrers(instance.__class__):
+        values = {}
+        changed = False
+        for name in ref.names:
+            key = instance._fields[name].serialized_name or name
+            values[name] = data.get(key)
+            if key not in initial or initial[key] != values[name]:
+                changed = True
+        if changed:
+            changes[ref] = values
+    return changes
+
+
+@gen.coroutine
+def propagate_snapshots(db, pk, changes):
+    """
+    Update snapshots of document `pk` in referencing documents.
+    For ListType references only the first matching item of each
+    document is updated (positional operator).
+    """
+    for ref, values in changes.iteritems():
+        prefix = ref.db_field + ('.$.' if ref.is_list else '.')
+        yield ref.model.objects.set_db(
+            get_related_database(ref.model, db)).update(
+            {ref.db_field + '._id': pk},
+            {'$set': dict((prefix + name, value)
+                for name, value in values.iteritems())},
+            multi=True)
+
+
+def schedule_propagation(db, instance, data):
+    """Propagate changed snapshots of saved `instance` in background"""
+    changes = changed_snapshot_values(instance, data)
+    if not changes:
+        return
+
+    @gen.coroutine
+    def propagate():
+        try:
+            yield propagate_snapshots(db, instance.pk, changes)
+        except Exception:
+            l.exception("Failed to propagate snapshots of {0} {1}".format(
+                instance.__class__.__name__, instance.pk))
+    future = propagate()
+    _pending.add(future)
+    future.add_done_callback(_pending.discard)
+
+
+@gen.coroutine
+def wait_for_propagation():
+    """Wait until snapshots, being propagated in background, are updated"""
+    while _pending:
+        yield list(_pending)
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
+from schematics.exceptions import BaseError, ModelValidationError
 from schematics.transforms import (wholelist, allow_none, import_loop,
     export_loop as schematics_export_loop)
+from schematics.types.compound import ModelType, ListType, DictType
 from .types import LocaleDateTimeType
 
 
@@ -90,6 +92,24 @@ def to_mongo(cls, instance_or_dict, role=None, raise_error_on_role=True,
     return data
 
 
+def field_to_mongo(field, value, context=None):
+    """
+    Prepare single value of `field` to be send to mongodb, the same way
+    `to_mongo` does it for entire model
+    """
+    def field_converter(field, value):
+        if hasattr(field, 'to_mongo'):
+            return field.to_mongo(value, context=context)
+        return field.to_primitive(value, context=context)
+    field_converter.to_mongo = True
+
+    if value is None:
+        return value
+    if hasattr(field, 'export_loop'):
+        return field.export_loop(value, field_converter)
+    return field_converter(field, value)
+
+
 def to_primitive(cls, instance_or_dict, role=None, raise_error_on_role=True,
                  context=None, timezone=None):
     """
@@ -125,3 +145,83 @@ def convert(cls, instance_or_dict, context=None, partial=True, strict=False,
     data = import_loop(cls, instance_or_dict, field_converter, context=context,
                        partial=partial, strict=strict, mapping=mapping)
     return data
+
+
+def patch_to_mongo(cls, raw_data, context=None):
+    """
+    Convert partial data (body of PATCH request) into dotted-path
+    ($set, $unset) documents in one pass, without loading the document:
+
+        {'title': 'x', 'nested': {'a': 1}, 'items': {'2': {'b': None}}}
+
+    becomes
+
+        ({'title': 'x', 'nested.a': 1}, {'items.2.b': ''})
+
+    Dicts for ModelType and DictType are patched by their keys, dict with
+    integer keys for ListType(ModelType(...)) patches items by position,
+    any other value (including list) replaces the stored value.
+    Every value is converted and validated by its field, all errors are
+    raised together as ModelValidationError keyed by dotted path.
+    """
+    set_data, unset_data, errors = {}, {}, {}
+    stack = [(cls, raw_data, '')]
+    while stack:
+        model_cls, data, prefix = stack.pop()
+        for field_name, field in model_cls._fields.iteritems():
+            serialized_name = field.serialized_name or field_name
+            if serialized_name in data:
+                value = data[serialized_name]
+            elif field_name in data:
+                value = data[field_name]
+            else:
+                continue
+            if field_name == '_id':
+                continue  # _id can't be changed
+            key = prefix + serialized_name
+            if value is None:
+                if field.required:
+                    errors[key] = [field.messages['required']]
+                else:
+                    unset_data[key] = ""
+            elif isinstance(field, ModelType) and isinstance(value, dict):
+                stack.append((field.model_class, value, key + '.'))
+            elif isinstance(field, ListType) and isinstance(value, dict) \
+                    and isinstance(field.field, ModelType):
+                for index, item in value.iteritems():
+                    try:
+                        index = int(index)
+                    except (TypeError, ValueError):
+                        errors[key] = [u"List index must be an integer, "
+                            "got {0}".format(index)]
+                        continue
+                    item_key = "{0}.{1}".format(key, index)
+                    if item is None:
+                        unset_data[item_key] = ""
+                    elif isinstance(item, dict):
+                        stack.append((field.field.model_class, item, item_key + '.'))
+                    else:
+                        _patch_value(field.field, item, item_key, context,
+                            set_data, errors)
+            elif isinstance(field, DictType) and isinstance(value, dict):
+                for k, item in value.iteritems():
+                    item_key = "{0}.{1}".format(key, k)
+                    if item is None:
+                        unset_data[item_key] = ""
+                    else:
+                        _patch_value(field.field, item, item_key, context,
+                            set_data, errors)
+            else:
+                _patch_value(field, value, key, context, set_data, errors)
+    if errors:
+        raise ModelValidationError(errors)
+    return set_data, unset_data
+
+
+def _patch_value(field, value, key, context, set_data, errors):
+    try:
+        value = field.to_native(value)
+        field.validate(value)
+        set_data[key] = field_to_mongo(field, value, context=context)
+    except BaseError as exc:
+        errors[key] = exc.messages
@@ -6,6 +6,7 @@ from schematics.contrib.mongo import ObjectIdType as SchematicsObjectIdType
 from schematics.exceptions import ValidationError, ConversionError
 from schematics.transforms import export_loop
 from schematics.types import TypeMeta, BaseType, DateTimeType
+from schematics.types.serializable import Serializable
 from bson.objectid import ObjectId
 from .utils import import_base_model, get_simple_model, get_model
 
@@ -42,6 +43,30 @@ class ObjectIdWithLen(ObjectId):
         return 1
 
 
+class SnapshotObjectId(ObjectId):
+    """
+    Id of referenced document together with snapshot of some of its
+    fields, they are available as attributes: event.user.name
+    """
+
+    def __init__(self, oid=None, snapshot=None):
+        super(SnapshotObjectId, self).__init__(oid)
+        self.snapshot = snapshot or {}
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['snapshot'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __getstate__(self):
+        return (super(SnapshotObjectId, self).__getstate__(), self.snapshot)
+
+    def __setstate__(self, state):
+        super(SnapshotObjectId, self).__setstate__(state[0])
+        self.snapshot = state[1]
+
+
 class ModelReferenceMeta(TypeMeta):
     def __new__(cls, name, bases, attrs):
         """
@@ -75,9 +100,18 @@ class ModelReferenceType(ObjectIdType):
           * CASCADE     - Deletes the documents associated with the reference.
           * DENY        - Prevent the deletion of the reference object.
           * PULL        - Pull the reference from a ListType of references
+
+        Use `counter_cache` to keep count of referencing documents in the
+        given field of referenced document (it is maintained by `save`,
+        `insert` and `remove`).
+
+        Use `snapshot` (tuple of field names) to store these fields of
+        referenced document together with its id: {"_id": ..., "name": ...}
         """
         self._model_class = field
         self.reverse_delete_rule = reverse_delete_rule
+        self.counter_cache = kwargs.pop("counter_cache", None)
+        self.snapshot = tuple(kwargs.pop("snapshot", None) or ())
 
         validators = kwargs.pop("validators", [])
         self.strict = kwargs.pop("strict", True)
@@ -119,14 +153,34 @@ class ModelReferenceType(ObjectIdType):
 
     def to_mongo(self, value, context=None):
         if isinstance(value, import_base_model()):
+            if self.snapshot:
+                return self.make_snapshot(value)
             value = value.pk
+        if self.snapshot:
+            data = {'_id': ObjectId(value) if value is not None else None}
+            data.update(getattr(value, 'snapshot', {}))
+            return data
         return ObjectIdWithLen(value)
 
     def to_native(self, value, context=None):
         if isinstance(value, import_base_model()):
             return value
+        if isinstance(value, dict) and '_id' in value:
+            snapshot = dict((k, v) for k, v in value.iteritems() if k != '_id')
+            value = value['_id']
+            if self.snapshot:
+                return SnapshotObjectId(value, snapshot)
         return super(ModelReferenceType, self).to_native(value, context=context)
 
+    def make_snapshot(self, model_instance):
+        """Value to be stored in mongo for snapshot reference"""
+        raw_data = model_instance.to_mongo()
+        data = {'_id': model_instance.pk}
+        for name in self.snapshot:
+            field = self.model_class._fields[name]
+            data[name] = raw_data.get(field.serialized_name or name)
+        return data
+
     def export_loop(self, model_instance, field_converter,
                     role=None, print_none=False):
         if not isinstance(model_instance, self.model_class) or\
@@ -294,3 +348,68 @@ class LocaleDateTimeType(DateTimeType):
         if dt_value.tzinfo != self.owner_model.get_database_timezone():
             dt_value = dt_value.astimezone(self.owner_model.get_database_timezone())
         return dt_value
+
+
+class MemoizedSerializable(Serializable):
+    """
+    Serializable, that keeps computed value in the instance. Value is
+    computed again only when any of `depends_on` fields has changed since
+    the last computation.
+    """
+
+    def __init__(self, func, depends_on, **kwargs):
+        if not depends_on:
+            raise TypeError(u"depends_on of {0} is empty".format(
+                func.__name__))
+        super(MemoizedSerializable, self).__init__(func, **kwargs)
+        self.depends_on = tuple(depends_on)
+
+    def __get__(self, instance, cls):
+        if instance is None:
+            return self
+        state = self.get_state(instance)
+        memo = instance.__dict__.setdefault('_memoized', {})
+        name = self.func.__name__
+        if name in memo and memo[name][0] == state:
+            return memo[name][1]
+        value = self.func(instance)
+        memo[name] = (state, value)
+        return value
+
+    def get_state(self, instance):
+        """
+        Values of dependencies, as they would be sent to mongo: new lists
+        and dicts, so in-place changes are noticed, and ids of referenced
+        models instead of (not copied) instances
+        """
+        from .transforms import field_to_mongo
+        state = []
+        for name in self.depends_on:
+            value = instance._data.get(name)
+            field = instance._fields.get(name)
+            state.append(field_to_mongo(field, value) if field else value)
+        return tuple(state)
+
+
+def memoized_serializable(depends_on, **kwargs):
+    """
+    The same as schematics `serializable`, but computed value is cached
+    in the instance until fields, it depends on, are changed:
+
+        @memoized_serializable(depends_on=('amount', 'tax_rate'))
+        def total(self):
+            return self.amount * (1 + self.tax_rate)
+
+    `depends_on` is required: every access compares converted values of
+    these fields, for all fields it would cost as much as `to_mongo`.
+    """
+    if callable(depends_on):
+        raise TypeError(u"memoized_serializable of {0} needs depends_on"
+            .format(depends_on.__name__))
+
+    def wrapper(func):
+        return MemoizedSerializable(func, depends_on,
+            type=kwargs.pop('type', BaseType()),
+            serialized_name=kwargs.pop('serialized_name', None),
+            serialize_when_none=kwargs.pop('serialize_when_none', True))
+    return wrapper
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+import time
+import logging
+from tornado import gen, ioloop
+from .errors import OperationError
+
+l = logging.getLogger(__name__)
+
+
+class ViewState(object):
+    def __init__(self):
+        self.refreshes = 0
+        self.failures = 0
+        self.refreshed_at = None
+        self.duration = None
+        self.in_progress = False
+
+    @property
+    def stats(self):
+        return {
+            'refreshes': self.refreshes,
+            'failures': self.failures,
+            'refreshed_at': self.refreshed_at,
+            'duration': self.duration,
+            'age': time.time() - self.refreshed_at
+                if self.refreshed_at else None,
+        }
+
+
+_view_states = {}
+
+
+def get_view_settings(cls):
+    """
+    Materialized view is declared in model Options:
+
+        class Options:
+            materialized_view = {
+                'source': Event,  # model, whose collection is aggregated
+                'pipeline': [{'$group': {'_id': '$user', 'count': {'$sum': 1}}}],
+                'refresh_interval': 60,  # seconds, optional
+            }
+
+    Result of pipeline replaces the model collection on every refresh.
+    """
+    settings = getattr(cls._options, 'materialized_view', None)
+    if not settings:
+        raise OperationError(u"{0} is not a materialized view".format(cls))
+    return settings
+
+
+def get_view_state(cls):
+    return _view_states.setdefault(cls._options.namespace, ViewState())
+
+
+@gen.coroutine
+def refresh_view(db, cls):
+    """
+    Run pipeline of the view with `$out` stage into collection of `cls`.
+    `$out` replaces collection atomically, so readers see either old or
+    new result.
+    """
+    settings = get_view_settings(cls)
+    state = get_view_state(cls)
+    pipeline = list(settings['pipeline']) + [{'$out': cls._options.namespace}]
+    started_at = time.time()
+    state.in_progress = True
+    try:
+        yield settings['source'].objects.set_db(db).aggregate(pipeline)
+    except Exception:
+        state.failures += 1
+        raise
+    else:
+        state.refreshes += 1
+        state.refreshed_at = time.time()
+        state.duration = state.refreshed_at - started_at
+    finally:
+        state.in_progress = False
+        cls.objects.set_db(db).invalidate_cache(query={})
+    l.debug("View {0} is refreshed in {1:.3f} seconds".format(
+        cls.__name__, state.duration))
+
+
+class ViewScheduler(object):
+    """
+    Refreshes materialized views on IOLoop every `refresh_interval`
+    seconds. Refresh is skipped, if the previous one is still running.
+    """
+
+    def __init__(self, db, models, refresh_on_start=True, io_loop=None):
+        self.db = db
+        self.models = [m for m in models
+            if get_view_settings(m).get('refresh_interval')]
+        self.refresh_on_start = refresh_on_start
+        self.io_loop = io_loop or ioloop.IOLoop.current()
+        self._callbacks = []
+
+    def start(self):
+        for model in self.models:
+            interval = get_view_settings(model)['refresh_interval']
+            callback = ioloop.PeriodicCallback(self._refresh_callback(model),
+                interval * 1000, io_loop=self.io_loop)
+            callback.start()
+            self._callbacks.append(callback)
+            if self.refresh_on_start:
+                self.io_loop.add_callback(self._refresh_callback(model))
+
+    def stop(self):
+        for callback in self._callbacks:
+            callback.stop()
+        self._callbacks = []
+
+    def _refresh_callback(self, model):
+        @gen.coroutine
+        def refresh():
+            if get_view_state(model).in_progress:
+                l.warning("Refresh of view {0} is skipped, previous one is "
+                    "still running".format(model.__name__))
+                return
+            try:
+                yield refresh_view(self.db, model)
+            except Exception:
+                l.exception("Refresh of view {0} failed".format(model.__name__))
+        return refresh